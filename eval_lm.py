@@ -29,7 +29,7 @@ def main(args):
 
     # Load ensemble
     print('| loading model(s) from {}'.format(args.path))
-    models, _ = utils.load_ensemble_for_inference(args.path.split(':'), task)
+    models, model_args = utils.load_ensemble_for_inference(args.path.split(':'), task)
 
     # Optimize ensemble for generation and set the source and dest dicts on the model (required by scorer)
     for model in models:
@@ -46,6 +46,11 @@ def main(args):
         max_positions=models[0].max_positions(),
         num_shards=args.num_shards,
         shard_id=args.shard_id,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        cache_dir=args.data if args.cache_batches else None,
+        batch_cost=data.batch_cost_from_args(args, model_args),
+        fingerprint=task.dataset_fingerprint(args.gen_subset),
         ignore_invalid_inputs=True,
     ).next_epoch_itr(shuffle=False)
 
@@ -50,7 +50,7 @@ class AdaptiveLoss(FairseqCriterion):
                 loss += F.cross_entropy(logits[i], target[i], size_average=False, ignore_index=self.padding_idx,
                                         reduce=reduce)
 
-        sample_size = sample['target'].size(0) if self.args.sentence_avg else sample['ntokens']
+        sample_size = sample['nsentences'] if self.args.sentence_avg else sample['ntokens']
         logging_output = {
             'loss': utils.item(loss.data) if reduce else loss.data,
             'ntokens': sample['ntokens'],
@@ -7,9 +7,13 @@
 
 from .dictionary import Dictionary
 from .fairseq_dataset import FairseqDataset
-from .indexed_dataset import IndexedDataset, IndexedInMemoryDataset, IndexedRawTextDataset  # noqa: F401
+from .concat_dataset import ConcatDataset
+from .indexed_dataset import (  # noqa: F401
+    IndexedDataset, IndexedInMemoryDataset, IndexedLazyRawTextDataset, IndexedMMapDataset,
+    IndexedRawTextDataset,
+)
 from .language_pair_dataset import LanguagePairDataset
 from .monolingual_dataset import MonolingualDataset
 from .token_block_dataset import TokenBlockDataset
 
-from .data_utils import EpochBatchIterator
+from .data_utils import batch_cost_from_args, EpochBatchIterator
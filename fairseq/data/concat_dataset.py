@@ -0,0 +1,110 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import numpy as np
+
+from . import data_utils, FairseqDataset
+
+
+class ConcatDataset(FairseqDataset):
+    """Concatenation of datasets, which can be resampled without copies.
+
+    Dataset ``i`` occupies ``int(len(datasets[i]) * sample_ratios[i])``
+    virtual indices: an integer ratio repeats the dataset, and the fractional
+    part of a ratio adds a random subset of its items, drawn once with *seed*
+    (so ratios below 1 keep the same subset in every epoch, and datasets
+    built with the same sizes, ratios and seed keep the same items). Indices
+    are located with :func:`np.searchsorted` on the cumulative virtual sizes.
+
+    Args:
+        datasets: list of datasets to concatenate
+        sample_ratios: sampling ratio of each dataset, or a single ratio for
+            all of them (default: 1)
+        seed: seed of the subsets drawn for fractional ratios (default: 1)
+    """
+
+    def __init__(self, datasets, sample_ratios=1, seed=1):
+        super().__init__()
+        assert len(datasets) > 0, 'datasets should not be an empty iterable'
+        self.datasets = list(datasets)
+        if isinstance(sample_ratios, (int, float)):
+            sample_ratios = [sample_ratios] * len(self.datasets)
+        if len(sample_ratios) != len(self.datasets):
+            raise ValueError('expected {} sample ratios, got {}'.format(len(self.datasets), len(sample_ratios)))
+        self.sample_ratios = sample_ratios
+        self.real_sizes = np.array([len(ds) for ds in self.datasets], dtype=np.int64)
+        self.virtual_sizes = np.array([
+            int(size * ratio) for size, ratio in zip(self.real_sizes, sample_ratios)
+        ], dtype=np.int64)
+        if ((self.virtual_sizes > 0) & (self.real_sizes == 0)).any():
+            raise ValueError('cannot sample from an empty dataset')
+        self.cumulative_sizes = np.cumsum(self.virtual_sizes)
+        # items of the last, partial repeat of each dataset, in their original order
+        self.full_sizes = self.virtual_sizes - self.virtual_sizes % np.maximum(self.real_sizes, 1)
+        rng = np.random.RandomState(seed)
+        partial = [
+            np.sort(rng.choice(real, virtual - full, replace=False))
+            for real, virtual, full in zip(self.real_sizes, self.virtual_sizes, self.full_sizes)
+        ]
+        self.partial_offsets = np.cumsum([0] + [len(p) for p in partial[:-1]])
+        self.partial_indices = np.concatenate(partial).astype(np.int64)
+        self.sizes = np.concatenate([
+            np.asarray(ds.sizes)[self._sample_indices(np.arange(size), np.full(size, i))]
+            for i, (ds, size) in enumerate(zip(self.datasets, self.virtual_sizes))
+        ])
+
+    def __len__(self):
+        return int(self.cumulative_sizes[-1])
+
+    def locate(self, index):
+        """Map (an array of) virtual indices to the index of the dataset and
+        the index of the item within that dataset."""
+        dataset_idx = np.searchsorted(self.cumulative_sizes, index, side='right')
+        if np.any(dataset_idx >= len(self.datasets)) or np.any(np.asarray(index) < 0):
+            raise IndexError('index out of range')
+        offset = index - (self.cumulative_sizes[dataset_idx] - self.virtual_sizes[dataset_idx])
+        return dataset_idx, self._sample_indices(offset, dataset_idx)
+
+    def _sample_indices(self, offset, dataset_idx):
+        sample_idx = offset % np.maximum(self.real_sizes[dataset_idx], 1)
+        partial = offset >= self.full_sizes[dataset_idx]
+        if np.ndim(offset) == 0:
+            if partial:
+                sample_idx = self.partial_indices[self.partial_offsets[dataset_idx] + sample_idx]
+        elif partial.any():
+            sample_idx[partial] = self.partial_indices[
+                self.partial_offsets[dataset_idx[partial]] + sample_idx[partial]
+            ]
+        return sample_idx
+
+    def __getitem__(self, index):
+        dataset_idx, sample_idx = self.locate(index)
+        return self.datasets[dataset_idx][sample_idx]
+
+    def __getitems__(self, indices):
+        dataset_idx, sample_idx = self.locate(np.asarray(indices, dtype=np.int64))
+        items = [None] * len(dataset_idx)
+        for i in np.unique(dataset_idx):
+            positions = np.flatnonzero(dataset_idx == i)
+            for pos, item in zip(positions, data_utils.fetch_items(self.datasets[i], sample_idx[positions])):
+                items[pos] = item
+        return items
+
+    def collater(self, samples):
+        return self.datasets[0].collater(samples)
+
+    def get_dummy_batch(self, num_tokens, max_positions):
+        return self.datasets[0].get_dummy_batch(num_tokens, max_positions)
+
+    def num_tokens(self, index):
+        return self.sizes[index]
+
+    def ordered_indices(self):
+        return np.argsort(self.sizes, kind='mergesort')
+
+    def valid_size(self, index, max_positions):
+        return self.sizes[index] <= max_positions
@@ -6,13 +6,16 @@
 # can be found in the PATENTS file in the same directory.
 
 import contextlib
+import functools
+import hashlib
 import itertools
 import os
+import threading
 
 import numpy as np
 import torch
 
-from . import FairseqDataset
+from . import FairseqDataset, indexed_dataset
 
 
 def infer_language_pair(path):
@@ -25,25 +28,148 @@ def infer_language_pair(path):
     return src, dst
 
 
+def dataset_files(path, raw_text=False):
+    """Files backing the (raw text or binary) dataset at *path*."""
+    if raw_text:
+        return [path]
+    return [indexed_dataset.index_file_path(path), indexed_dataset.data_file_path(path)]
+
+
+def fingerprint(files, *settings):
+    """Hash the path, size and modification time of *files*, and *settings*."""
+    h = hashlib.sha1()
+    for f in files:
+        st = os.stat(f)
+        h.update(repr((os.path.abspath(f), st.st_size, st.st_mtime_ns)).encode())
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+
+def save_array(path, array):
+    """Save *array* to the ``.npy`` file *path*. The array is written to a
+    unique temporary file which is then renamed, so that concurrent writers
+    never expose a partial file."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def fetch_items(dataset, indices):
+    """Fetch the items at *indices* from *dataset*, with a single call to its
+    ``__getitems__`` method if it provides one."""
+    getitems = getattr(dataset, '__getitems__', None)
+    if getitems:
+        return getitems(indices)
+    return [dataset[i] for i in indices]
+
+
+def gather_ranges(starts, ends):
+    """Concatenate the index ranges ``[starts[i], ends[i])``.
+
+    Returns the concatenated indices and the length of each range, such that
+    ``array[indices]`` gathers all ranges of *array* with a single fancy
+    indexing operation.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths), lengths
+
+
+def split_items(flat, lengths):
+    """Split a 1d array into a list of tensors of the given *lengths*, which
+    are views of a single tensor."""
+    if len(lengths) == 0:
+        return []
+    return list(torch.from_numpy(flat).split(lengths.tolist()))
+
+
+class CompactBatches(object):
+    """A sequence of batches stored as one flat index array and an offsets
+    array: batch ``i`` is ``indices[offsets[i]:offsets[i + 1]]``.
+
+    Batches are returned as views of *indices*, and reordering the batches
+    (see :func:`permute`) only permutes batch ids.
+
+    Args:
+        indices: 1d array of example indices, batch after batch
+        offsets: 1d array with the start of each batch in *indices*, followed
+            by ``len(indices)``
+        order: optional array of batch ids, in the order they are returned
+    """
+
+    def __init__(self, indices, offsets, order=None):
+        self.indices = indices
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def from_batches(cls, batches):
+        offsets = np.zeros(len(batches) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in batches], out=offsets[1:])
+        if len(batches) > 0:
+            indices = np.concatenate(batches).astype(np.int64, copy=False)
+        else:
+            indices = np.empty(0, dtype=np.int64)
+        return cls(indices, offsets)
+
+    def permute(self, order):
+        """Return a view of the batches in the given order of batch ids."""
+        if self.order is not None:
+            order = self.order[order]
+        return CompactBatches(self.indices, self.offsets, order)
+
+    @property
+    def batch_ids(self):
+        """The ids of the batches, in the order they are returned."""
+        if self.order is None:
+            return np.arange(len(self.offsets) - 1)
+        return self.order
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.order is None else len(self.order)
+
+    def __getitem__(self, i):
+        if self.order is not None:
+            i = self.order[i]
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class ShardedIterator(object):
-    """A sharded wrapper around an iterable (padded to length)."""
+    """A sharded wrapper around an iterable (padded to length).
+
+    The first *offset* elements of the shard are skipped without being
+    produced when *iterable* is a sequence.
+    """
 
-    def __init__(self, iterable, num_shards, shard_id, fill_value=None):
+    def __init__(self, iterable, num_shards, shard_id, fill_value=None, offset=0):
         if shard_id < 0 or shard_id >= num_shards:
             raise ValueError('shard_id must be between 0 and num_shards')
 
         self._sharded_len = len(iterable) // num_shards
         if len(iterable) % num_shards > 0:
             self._sharded_len += 1
+        self.offset = min(offset, self._sharded_len)
 
+        start = shard_id + self.offset * num_shards
+        if hasattr(iterable, '__getitem__'):
+            # index sequences directly instead of stepping over other shards
+            shard = map(iterable.__getitem__, range(start, len(iterable), num_shards))
+        else:
+            shard = itertools.islice(iterable, start, len(iterable), num_shards)
         self.itr = itertools.zip_longest(
-            range(self._sharded_len),
-            itertools.islice(iterable, shard_id, len(iterable), num_shards),
+            range(self.offset, self._sharded_len),
+            shard,
             fillvalue=fill_value,
         )
 
     def __len__(self):
-        return self._sharded_len
+        return self._sharded_len - self.offset
 
     def __iter__(self):
         return self
@@ -53,51 +179,202 @@ class ShardedIterator(object):
 
 
 class CountingIterator(object):
-    """Wrapper around an iterable that maintains the iteration count."""
+    """Wrapper around an iterable that maintains the iteration count.
 
-    def __init__(self, iterable):
+    *start* is the count of elements already consumed before *iterable*,
+    e.g., when resuming an epoch from a sliced batch sampler.
+    """
+
+    def __init__(self, iterable, start=0):
         self.iterable = iterable
-        self.count = 0
-        self.itr = iter(self)
+        self.start = start
+        self.count = start
+        # iterate the underlying iterable only once, so that iterating this
+        # object again (e.g., after skip) resumes where it left off instead of
+        # restarting the iterable (and its data loading workers); the
+        # iterator is only created on first use, so that building an epoch
+        # iterator does not start the workers
+        self.itr = None
 
     def __len__(self):
-        return len(self.iterable)
+        return self.start + len(self.iterable)
 
     def __iter__(self):
-        for x in self.iterable:
-            self.count += 1
-            yield x
+        return self
 
     def __next__(self):
-        return next(self.itr)
+        if self.itr is None:
+            self.itr = iter(self.iterable)
+        x = next(self.itr)
+        self.count += 1
+        return x
 
     def has_next(self):
         return self.count < len(self)
 
     def skip(self, num_to_skip):
-        next(itertools.islice(self.itr, num_to_skip, num_to_skip), None)
+        next(itertools.islice(self, num_to_skip, num_to_skip), None)
         return self
 
 
-def collate_tokens(values, pad_idx, eos_idx, left_pad, move_eos_to_beginning=False):
+def collate_tokens(values, pad_idx, eos_idx, left_pad, move_eos_to_beginning=False, buffer_pool=None):
     """Convert a list of 1d tensors into a padded 2d tensor."""
-    size = max(v.size(0) for v in values)
-    res = values[0].new(len(values), size).fill_(pad_idx)
-
-    def copy_tensor(src, dst):
-        assert dst.numel() == src.numel()
-        if move_eos_to_beginning:
-            assert src[-1] == eos_idx
-            dst[0] = eos_idx
-            dst[1:] = src[:-1]
+    flat, lengths, dest = _flatten_tokens(values, left_pad)
+    if move_eos_to_beginning:
+        flat = _move_eos_to_beginning(flat, lengths, eos_idx)
+    return _scatter_tokens(flat, dest, (len(values), int(lengths.max())), pad_idx, buffer_pool, 'tokens')
+
+
+def collate_target_tokens(values, pad_idx, eos_idx, left_pad, buffer_pool=None):
+    """Convert a list of 1d target tensors into a padded 2d target tensor and
+    the matching decoder input, in which the end-of-sentence symbol is moved
+    to the beginning. Both tensors are filled from a single concatenation of
+    *values*. Returns ``(target, prev_output_tokens)``."""
+    flat, lengths, dest = _flatten_tokens(values, left_pad)
+    shape = (len(values), int(lengths.max()))
+    target = _scatter_tokens(flat, dest, shape, pad_idx, buffer_pool, 'target')
+    prev_output_tokens = _scatter_tokens(
+        _move_eos_to_beginning(flat, lengths, eos_idx), dest, shape, pad_idx, buffer_pool, 'prev_output_tokens',
+    )
+    return target, prev_output_tokens
+
+
+def pack_sequences(lengths, max_length):
+    """Assign examples to rows of at most *max_length* tokens, first-fit in
+    the given order.
+
+    *lengths* has one row per example and one column per sequence of the
+    example (e.g., source and target). An example goes into the first row in
+    which all of its sequences fit; examples longer than *max_length* get a
+    row of their own.
+
+    Returns the row of each example, the offset of each of its sequences in
+    the row (with the shape of *lengths*) and its segment number in the row,
+    starting at 1.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64).reshape(len(lengths), -1)
+    fill = np.zeros_like(lengths)  # number of tokens of each row
+    count = np.zeros(len(lengths), dtype=np.int64)  # number of examples of each row
+    rows = np.zeros(len(lengths), dtype=np.int64)
+    offsets = np.zeros_like(lengths)
+    num_rows = 0
+    for i, length in enumerate(lengths):
+        fits = np.flatnonzero((fill[:num_rows] + length <= max_length).all(axis=1))
+        if len(fits) > 0:
+            row = fits[0]
         else:
-            dst.copy_(src)
-
-    for i, v in enumerate(values):
-        copy_tensor(v, res[i][size - len(v):] if left_pad else res[i][:len(v)])
+            row = num_rows
+            num_rows += 1
+        rows[i] = row
+        offsets[i] = fill[row]
+        fill[row] += length
+        count[row] += 1
+    segments = np.zeros(len(lengths), dtype=np.int64)
+    if len(lengths) > 0:
+        # examples are numbered in the order in which they were added to a row
+        order = np.lexsort((np.arange(len(rows)), rows))
+        row_starts = np.cumsum(count[:num_rows]) - count[:num_rows]
+        segments[order] = np.arange(len(rows)) - np.repeat(row_starts, count[:num_rows]) + 1
+    return rows, offsets, segments
+
+
+def collate_packed_tokens(values, rows, offsets, segments, pad_idx, buffer_pool=None, name='tokens'):
+    """Convert a list of 1d tensors into a right-padded 2d tensor in which
+    ``values[i]`` starts at column ``offsets[i]`` of row ``rows[i]`` (see
+    :func:`pack_sequences`).
+
+    Returns the tokens and a tensor of the same shape with the segment number
+    of every token, which is 0 for padding."""
+    flat, lengths, dest, shape = _flatten_packed_tokens(values, rows, offsets)
+    tokens = _scatter_tokens(flat, dest, shape, pad_idx, buffer_pool, name)
+    segment_ids = torch.from_numpy(segments).repeat_interleave(lengths)
+    return tokens, _scatter_tokens(segment_ids, dest, shape, 0, buffer_pool, name + '_segments')
+
+
+def collate_packed_target_tokens(values, rows, offsets, segments, pad_idx, eos_idx, buffer_pool=None):
+    """Packed version of :func:`collate_target_tokens`, in which the
+    end-of-sentence symbol is moved to the beginning of each target, so that
+    the decoder input never crosses a segment boundary.
+
+    Returns ``(target, prev_output_tokens, segments)``."""
+    flat, lengths, dest, shape = _flatten_packed_tokens(values, rows, offsets)
+    target = _scatter_tokens(flat, dest, shape, pad_idx, buffer_pool, 'target')
+    prev_output_tokens = _scatter_tokens(
+        _move_eos_to_beginning(flat, lengths, eos_idx), dest, shape, pad_idx, buffer_pool, 'prev_output_tokens',
+    )
+    segment_ids = torch.from_numpy(segments).repeat_interleave(lengths)
+    return target, prev_output_tokens, _scatter_tokens(segment_ids, dest, shape, 0, buffer_pool, 'target_segments')
+
+
+def _flatten_packed_tokens(values, rows, offsets):
+    lengths = torch.LongTensor([v.numel() for v in values])
+    rows, offsets = torch.from_numpy(rows), torch.from_numpy(offsets)
+    width = int((offsets + lengths).max())
+    ends = lengths.cumsum(0)
+    starts = rows * width + offsets
+    dest = torch.arange(int(ends[-1])) + (starts - (ends - lengths)).repeat_interleave(lengths)
+    return torch.cat(values), lengths, dest, (int(rows.max()) + 1, width)
+
+
+def _flatten_tokens(values, left_pad):
+    """Concatenate *values* and compute the position of every token in the
+    flattened padded tensor."""
+    lengths = torch.LongTensor([v.numel() for v in values])
+    size = int(lengths.max())
+    ends = lengths.cumsum(0)
+    row_starts = torch.arange(len(values)) * size
+    if left_pad:
+        row_starts += size - lengths
+    dest = torch.arange(int(ends[-1])) + (row_starts - (ends - lengths)).repeat_interleave(lengths)
+    return torch.cat(values), lengths, dest
+
+
+def _move_eos_to_beginning(flat, lengths, eos_idx):
+    ends = lengths.cumsum(0)
+    assert (lengths > 0).all() and (flat[ends - 1] == eos_idx).all()
+    shifted = flat.roll(1)
+    shifted[ends - lengths] = eos_idx
+    return shifted
+
+
+def _scatter_tokens(flat, dest, shape, pad_idx, buffer_pool, name):
+    if buffer_pool is not None:
+        res = buffer_pool.get(name, shape, flat.dtype)
+    else:
+        res = flat.new(*shape)
+    res.fill_(pad_idx).view(-1)[dest] = flat
     return res
 
 
+class BufferPool(object):
+    """A pool of reusable tensors for collating batches, bucketed by size.
+
+    :func:`get` returns a contiguous view of a buffer whose capacity is the
+    next power of two of the requested number of elements. Each (name,
+    capacity, dtype) bucket cycles through *num_slots* buffers, so a returned
+    tensor is overwritten by the *num_slots*-th following batch of the same
+    bucket; callers must not hold on to more batches than that. Since data
+    loading workers move the tensors they return to shared memory, a pool must
+    only be used when batches are collated in the main process.
+    """
+
+    def __init__(self, num_slots=2):
+        self.num_slots = num_slots
+        self.buckets = {}
+
+    def get(self, name, shape, dtype):
+        numel = int(np.prod(shape))
+        capacity = 1 << max(numel - 1, 0).bit_length()
+        key = (name, capacity, dtype)
+        if key not in self.buckets:
+            self.buckets[key] = ([], itertools.count())
+        buffers, counter = self.buckets[key]
+        slot = next(counter) % self.num_slots
+        if slot == len(buffers):
+            buffers.append(torch.empty(capacity, dtype=dtype))
+        return buffers[slot][:numel].view(*shape)
+
+
 class EpochBatchIterator(object):
     """Iterate over a FairseqDataset and yield batches bucketed by size.
 
@@ -114,12 +391,27 @@ class EpochBatchIterator(object):
         seed: seed for random number generator for reproducibility
         num_shards: shard the data iterator into N shards
         shard_id: which shard of the data iterator to return
+        num_workers: how many subprocesses to use for data loading (0 means
+            the data will be loaded in the main process)
+        prefetch_factor: number of batches loaded in advance by each worker
+        cache_dir: directory in which the batches are cached, keyed by
+            *fingerprint* and the batching arguments (default: no caching)
+        fingerprint: string identifying the dataset, e.g., as returned by
+            FairseqTask.dataset_fingerprint (required for caching)
+        balance_shards: reorder the batches of each epoch so that the batches
+            processed by the shards at the same step have similar costs, see
+            :func:`balance_batches`
+        batch_cost: name of a cost function in :data:`BATCH_COSTS`, or a
+            function of the batch size and of the padded source and target
+            lengths; batches are filled up to a cost of *max_tokens*
+            (default: 'max_tokens', the number of padded tokens)
     """
 
     def __init__(
         self, dataset, max_tokens=None, max_sentences=None, max_positions=None,
         ignore_invalid_inputs=False, required_batch_size_multiple=1, seed=1,
-        num_shards=1, shard_id=0,
+        num_shards=1, shard_id=0, num_workers=0, prefetch_factor=2,
+        cache_dir=None, fingerprint=None, balance_shards=False, batch_cost='max_tokens',
     ):
         assert isinstance(dataset, FairseqDataset)
         self.dataset = dataset
@@ -131,13 +423,23 @@ class EpochBatchIterator(object):
         self.seed = seed
         self.num_shards = num_shards
         self.shard_id = shard_id
-
-        with numpy_seed(self.seed):
-            self.frozen_batches = tuple(self._batch_generator())
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.balance_shards = balance_shards and num_shards > 1
+        self.batch_cost = batch_cost
+        self.batch_cost_fn = BATCH_COSTS[batch_cost] if isinstance(batch_cost, str) else batch_cost
+
+        if cache_dir is not None and fingerprint is not None:
+            self.frozen_batches = self._load_or_build_batches(cache_dir, fingerprint)
+        else:
+            self.frozen_batches = self._build_batches()
 
         self.epoch = 0
         self._cur_epoch_itr = None
         self._next_epoch_itr = None
+        self._next_epoch_batches = None
+        self._batch_costs = None
+        self.step_imbalance = None
 
     def __len__(self):
         return len(self.frozen_batches)
@@ -150,6 +452,9 @@ class EpochBatchIterator(object):
         else:
             self.epoch += 1
             self._cur_epoch_itr = self._get_iterator_for_epoch(self.epoch, shuffle)
+        if shuffle:
+            # shuffle the batches of the next epoch while this one is running
+            self._prefetch_shuffled_batches(self.epoch + 1)
         return self._cur_epoch_itr
 
     def end_of_epoch(self):
@@ -173,74 +478,302 @@ class EpochBatchIterator(object):
         self.epoch = state_dict['epoch']
         itr_pos = state_dict.get('iterations_in_epoch', 0)
         if itr_pos > 0:
-            # fast-forward epoch iterator
-            itr = self._get_iterator_for_epoch(self.epoch, state_dict.get('shuffle', True))
-            if itr_pos < len(itr):
-                self._next_epoch_itr = itr.skip(itr_pos)
+            # fast-forward epoch iterator by slicing the batch sampler, so
+            # that the skipped batches are never loaded or collated
+            itr = self._get_iterator_for_epoch(self.epoch, state_dict.get('shuffle', True), offset=itr_pos)
+            if itr.has_next():
+                self._next_epoch_itr = itr
 
-    def _get_iterator_for_epoch(self, epoch, shuffle):
+    def _get_iterator_for_epoch(self, epoch, shuffle, offset=0):
         if shuffle:
-            # set seed based on the seed and epoch number so that we get
-            # reproducible results when resuming from checkpoints
-            with numpy_seed(self.seed + epoch):
-                batches = list(self.frozen_batches)  # copy
-                np.random.shuffle(batches)
+            batches = self._get_shuffled_batches(epoch)
         else:
             batches = self.frozen_batches
-        return CountingIterator(torch.utils.data.DataLoader(
-            self.dataset,
-            collate_fn=self.dataset.collater,
-            batch_sampler=ShardedIterator(batches, self.num_shards, self.shard_id, fill_value=[]),
-        ))
+        if self.num_shards > 1:
+            costs = self.batch_costs()
+            if self.balance_shards:
+                rng = np.random.RandomState([self.seed, epoch])
+                batches = batches.permute(balance_batches(costs[batches.batch_ids], self.num_shards, rng))
+            self.step_imbalance = shard_imbalance(costs[batches.batch_ids], self.num_shards)
+        if self.num_workers > 0:
+            loader_kwargs = {
+                'num_workers': self.num_workers,
+                'prefetch_factor': self.prefetch_factor,
+                'worker_init_fn': functools.partial(seed_worker, self.seed + epoch),
+            }
+        else:
+            loader_kwargs = {}
+        batch_sampler = ShardedIterator(
+            batches, self.num_shards, self.shard_id, fill_value=[], offset=offset,
+        )
+        return CountingIterator(
+            torch.utils.data.DataLoader(
+                self.dataset,
+                collate_fn=self.dataset.collater,
+                batch_sampler=batch_sampler,
+                **loader_kwargs
+            ),
+            start=batch_sampler.offset,
+        )
+
+    def batch_costs(self):
+        """Return the cost of each frozen batch (see *batch_cost*)."""
+        if self._batch_costs is None:
+            batches = self.frozen_batches
+            if len(batches.indices) > 0:
+                sizes = self._example_sizes(batches.indices)
+                padded_lengths = np.maximum.reduceat(sizes, batches.offsets[:-1], axis=0)
+                self._batch_costs = self.batch_cost_fn(np.diff(batches.offsets), *padded_lengths.T)
+            else:
+                self._batch_costs = np.zeros(len(batches))
+        return self._batch_costs
+
+    def _example_sizes(self, indices):
+        """The sizes of the examples at *indices* that are passed to the
+        batch cost function, as a 2d array with one column per argument."""
+        if self.batch_cost == 'max_tokens':
+            # only the longest sequence of each example matters
+            return np.asarray(self.dataset.num_tokens(indices), dtype=np.int64).reshape(-1, 1)
+        return np.asarray(self.dataset.size(indices), dtype=np.int64)
+
+    def _shuffle_batches(self, epoch):
+        # set seed based on the seed and epoch number so that we get
+        # reproducible results when resuming from checkpoints; a private
+        # RandomState draws the same permutation as seeding the global one
+        # and shuffling a list of batches, and is safe to use from the
+        # background thread
+        order = np.random.RandomState(self.seed + epoch).permutation(len(self.frozen_batches))
+        return self.frozen_batches.permute(order)
+
+    def _prefetch_shuffled_batches(self, epoch):
+        result = {}
+
+        def shuffle():
+            result['batches'] = self._shuffle_batches(epoch)
+
+        thread = threading.Thread(target=shuffle, daemon=True)
+        thread.start()
+        self._next_epoch_batches = (epoch, thread, result)
+
+    def _get_shuffled_batches(self, epoch):
+        if self._next_epoch_batches is not None:
+            prefetched_epoch, thread, result = self._next_epoch_batches
+            self._next_epoch_batches = None
+            if prefetched_epoch == epoch:
+                thread.join()
+                return result['batches']
+        return self._shuffle_batches(epoch)
+
+    def _build_batches(self):
+        with numpy_seed(self.seed):
+            return CompactBatches.from_batches(list(self._batch_generator()))
+
+    def _load_or_build_batches(self, cache_dir, fingerprint):
+        # the frozen batches don't depend on the shard, so all distributed
+        # ranks share (and map) the same cache files
+        key = hashlib.sha1(repr((
+            fingerprint, self.dataset.__class__.__name__, len(self.dataset),
+            self.max_tokens, self.max_sentences, self.max_positions,
+            self.ignore_invalid_inputs, self.bsz_mult, self.seed,
+            self.batch_cost if isinstance(self.batch_cost, str) else self.batch_cost.__name__,
+        )).encode()).hexdigest()
+        prefix = os.path.join(cache_dir, 'batches.{}'.format(key))
+        indices_path, offsets_path = prefix + '.indices.npy', prefix + '.offsets.npy'
+
+        # the offsets are written last, so the indices are complete if they exist
+        if os.path.exists(offsets_path):
+            return CompactBatches(
+                np.load(indices_path, mmap_mode='r'),
+                np.load(offsets_path, mmap_mode='r'),
+            )
+
+        batches = self._build_batches()
+        try:
+            save_array(indices_path, batches.indices)
+            save_array(offsets_path, batches.offsets)
+        except OSError as e:
+            print('| WARNING: could not cache batches in {}: {}'.format(cache_dir, e))
+        return batches
 
     def _batch_generator(self):
-        batch = []
-
-        def is_batch_full(num_tokens):
-            if len(batch) == 0:
-                return False
-            if len(batch) == self.max_sentences:
-                return True
-            if num_tokens > self.max_tokens:
-                return True
-            return False
-
-        sample_len = 0
-        sample_lens = []
-        ignored = []
-        for idx in self.dataset.ordered_indices():
-            if not self.dataset.valid_size(idx, self.max_positions):
-                if self.ignore_invalid_inputs:
-                    ignored.append(idx)
-                    continue
+        indices = self.dataset.ordered_indices()
+        valid = np.asarray(self.dataset.valid_size(indices, self.max_positions), dtype=bool)
+        ignored = indices[~valid]
+        if len(ignored) > 0:
+            if not self.ignore_invalid_inputs:
                 raise Exception((
                     'Size of sample #{} is invalid, max_positions={}, skip this '
                     'example with --skip-invalid-size-inputs-valid-test'
-                ).format(idx, self.max_positions))
-
-            sample_lens.append(self.dataset.num_tokens(idx))
-            sample_len = max(sample_len, sample_lens[-1])
-            num_tokens = (len(batch) + 1) * sample_len
-            if is_batch_full(num_tokens):
-                mod_len = max(
-                    self.bsz_mult * (len(batch) // self.bsz_mult),
-                    len(batch) % self.bsz_mult,
-                )
-                yield batch[:mod_len]
-                batch = batch[mod_len:]
-                sample_lens = sample_lens[mod_len:]
-                sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
-
-            batch.append(idx)
-
-        if len(batch) > 0:
-            yield batch
+                ).format(ignored[0], self.max_positions))
+            indices = indices[valid]
+
+        yield from batch_by_size(
+            indices, self._example_sizes(indices), self.max_tokens,
+            self.max_sentences, self.bsz_mult, batch_cost=self.batch_cost_fn,
+        )
 
         if len(ignored) > 0:
             print((
                 '| WARNING: {} samples have invalid sizes and will be skipped, '
                 'max_positions={}, first few sample ids={}'
-            ).format(len(ignored), self.max_positions, ignored[:10]))
+            ).format(len(ignored), self.max_positions, ignored[:10].tolist()))
+
+
+def balance_batches(costs, num_shards, rng, window=16):
+    """Return an order of batches in which the *num_shards* batches of each
+    step (which are sent to different shards) have similar *costs*.
+
+    Within windows of ``window * num_shards`` consecutive batches, the
+    batches are sorted by cost and grouped into steps, and the steps of each
+    window are shuffled with *rng*.
+    """
+    window *= num_shards
+    order = []
+    for start in range(0, len(costs), window):
+        ids = np.arange(start, min(start + window, len(costs)))
+        ids = ids[np.argsort(-costs[ids], kind='mergesort')]
+        num_steps = len(ids) // num_shards
+        # shuffle the full steps, an incomplete last step stays last
+        steps = rng.permutation(num_steps)
+        ids[:num_steps * num_shards] = ids[:num_steps * num_shards].reshape(num_steps, num_shards)[steps].reshape(-1)
+        order.append(ids)
+    return np.concatenate(order) if len(order) > 0 else np.empty(0, dtype=np.int64)
+
+
+def shard_imbalance(costs, num_shards):
+    """Return the imbalance ratio of each step, when batches with the given
+    *costs* are sent to *num_shards* shards round-robin: the ratio between the
+    largest cost of the step and its mean cost over the shards."""
+    num_steps = -(-len(costs) // num_shards)
+    step_costs = np.zeros(num_steps * num_shards)
+    step_costs[:len(costs)] = costs
+    step_costs = step_costs.reshape(num_steps, num_shards)
+    return step_costs.max(axis=1) / np.maximum(step_costs.mean(axis=1), 1e-9)
+
+
+def batch_by_size(
+    indices, num_tokens, max_tokens=float('Inf'), max_sentences=float('Inf'),
+    required_batch_size_multiple=1, batch_cost=None,
+):
+    """Split *indices* into mini-batches, in order.
+
+    A batch is full when adding the next example would exceed *max_sentences*
+    examples or a cost of *max_tokens*. By default the cost of a batch is its
+    number of padded tokens (batch size times the longest example). Full
+    batches are trimmed to a multiple of *required_batch_size_multiple* and
+    the remainder is carried over into the next batch.
+
+    Args:
+        indices: 1d array of example indices
+        num_tokens: array with the number of tokens of each example in
+            *indices*, either 1d or 2d with one column per sequence of the
+            example (e.g., source and target)
+        batch_cost: function of the batch size and of the padded length of
+            each column of *num_tokens* (i.e., its maximum over the batch),
+            which returns the cost of the batch; it is applied to arrays of
+            candidate batches and must not decrease when examples are added
+            (default: :func:`max_tokens_cost`)
+    """
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        # e.g., every example was filtered out
+        return
+    num_tokens = np.asarray(num_tokens, dtype=np.int64)
+    num_tokens = num_tokens.reshape(len(num_tokens), -1)
+    if batch_cost is None:
+        batch_cost = max_tokens_cost
+    n = len(indices)
+    bsz_mult = required_batch_size_multiple
+    # number of candidates examined at once, adapted to the previous batch
+    # size
+    max_window = int(min(max_sentences, n)) + 1
+    window = min(16, max_window)
+
+    start = 0  # first example of the current batch
+    last = 0  # examples [start, last] are in the current batch
+    while start < n:
+        sample_len = num_tokens[start:last + 1].max(axis=0)
+        full = None
+        k = last + 1
+        while k < n:
+            end = min(k + window, n)
+            sample_lens = np.maximum(np.maximum.accumulate(num_tokens[k:end], axis=0), sample_len)
+            bsz = np.arange(k - start, end - start)  # batch size before adding each candidate
+            is_full = (bsz == max_sentences) | (batch_cost(bsz + 1, *sample_lens.T) > max_tokens)
+            if is_full.any():
+                full = k + is_full.argmax()
+                break
+            sample_len = sample_lens[-1]
+            k = end
+            window = min(2 * window, max_window)
+
+        if full is None:
+            yield indices[start:]
+            return
+
+        bsz = full - start
+        window = min(max(16, 2 * bsz), max_window)
+        mod_len = max(bsz_mult * (bsz // bsz_mult), bsz % bsz_mult)
+        yield indices[start:start + mod_len]
+        start += mod_len
+        last = full
+
+
+def max_tokens_cost(bsz, *lengths):
+    """Batch size times the longest padded sequence."""
+    return bsz * functools.reduce(np.maximum, lengths)
+
+
+def padded_tokens_cost(bsz, src_len, tgt_len):
+    """Number of padded source and target tokens."""
+    return bsz * (src_len + tgt_len)
+
+
+def transformer_cost(bsz, src_len, tgt_len, encoder_embed_dim=512, decoder_embed_dim=512):
+    """Padded source and target tokens, plus the cost of encoder
+    self-attention, decoder self-attention and encoder-decoder attention,
+    which is quadratic in the lengths.
+
+    Per token and layer, the projections and the feed-forward network cost
+    about ``12 * embed_dim ** 2`` multiply-adds and attention over *L*
+    positions about ``2 * L * embed_dim``, hence the attention terms are
+    counted in tokens by dividing them by ``6 * embed_dim`` (see
+    :func:`batch_cost_from_args` for the embedding dimensions of a model).
+    """
+    encoder_attention = src_len * src_len / (6 * encoder_embed_dim)
+    decoder_attention = (tgt_len * tgt_len + src_len * tgt_len) / (6 * decoder_embed_dim)
+    return bsz * (src_len + tgt_len + encoder_attention + decoder_attention)
+
+
+BATCH_COSTS = {
+    'max_tokens': max_tokens_cost,
+    'padded_tokens': padded_tokens_cost,
+    'transformer': transformer_cost,
+}
+
+
+def batch_cost_from_args(args, model_args=None):
+    """Return the *batch_cost* argument of :class:`EpochBatchIterator` for
+    --batch-cost: the name of the cost function, or for the transformer cost,
+    a function of the embedding dimensions of the model, which are read from
+    *model_args* (default: *args*, e.g., after :func:`FairseqTask.build_model`)."""
+    if args.batch_cost != 'transformer':
+        return args.batch_cost
+    model_args = model_args if model_args is not None else args
+    encoder_embed_dim = getattr(model_args, 'encoder_embed_dim', None) or 512
+    decoder_embed_dim = getattr(model_args, 'decoder_embed_dim', None) or encoder_embed_dim
+    cost_fn = functools.partial(
+        transformer_cost, encoder_embed_dim=encoder_embed_dim, decoder_embed_dim=decoder_embed_dim,
+    )
+    # identifies the cost in the batch cache
+    cost_fn.__name__ = 'transformer_cost_{}_{}'.format(encoder_embed_dim, decoder_embed_dim)
+    return cost_fn
+
+
+def seed_worker(seed, worker_id):
+    """Seed the PRNGs of a data loading worker deterministically."""
+    np.random.seed((seed * 1000 + worker_id) % 2 ** 32)
+    torch.manual_seed(seed * 1000 + worker_id)
 
 
 @contextlib.contextmanager
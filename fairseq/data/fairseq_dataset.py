@@ -5,11 +5,24 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import numpy as np
 import torch.utils.data
 
 
 class FairseqDataset(torch.utils.data.Dataset):
-    """A dataset that provides helpers for batching."""
+    """A dataset that provides helpers for batching.
+
+    Batches are built from size metadata only: :func:`num_tokens`,
+    :func:`valid_size` and :func:`ordered_indices` must be answered from
+    precomputed arrays (typically a ``sizes`` NumPy array) and must not fetch
+    any item, so that batching does not read the data.
+
+    Datasets may additionally implement ``__getitems__(indices)``, which
+    returns the list of items at *indices* and should fetch them with as few
+    operations as possible. The data loader uses it to fetch whole batches,
+    and wrapper datasets should forward it with
+    :func:`fairseq.data.data_utils.fetch_items`.
+    """
 
     def __getitem__(self, index):
         raise NotImplementedError
@@ -26,13 +39,31 @@ class FairseqDataset(torch.utils.data.Dataset):
         raise NotImplementedError
 
     def num_tokens(self, index):
-        """Return an example's length (number of tokens), used for batching."""
+        """Return an example's length (number of tokens), used for batching.
+
+        *index* may also be a NumPy array of indices, in which case an array of
+        lengths is returned. Must not fetch the example."""
         raise NotImplementedError
 
+    def size(self, index):
+        """Return an example's source and target lengths, used by batch cost
+        functions. By default, the example is decoded without a source, as in
+        language modeling: the source length is 0 and the target length is
+        the example's length.
+
+        *index* may also be a NumPy array of indices, in which case a
+        ``(len(index), 2)`` array is returned. Must not fetch the example."""
+        num_tokens = np.asarray(self.num_tokens(index))
+        return np.stack([np.zeros_like(num_tokens), num_tokens], axis=-1)
+
     def ordered_indices(self):
-        """Ordered indices for batching."""
+        """Ordered indices for batching, as a NumPy array. Must not fetch any
+        example."""
         raise NotImplementedError
 
     def valid_size(self, index, max_positions):
-        """Check if an example's size is valid according to max_positions."""
+        """Check if an example's size is valid according to max_positions.
+
+        *index* may also be a NumPy array of indices, in which case a boolean
+        array is returned. Must not fetch the example."""
         raise NotImplementedError
@@ -5,13 +5,20 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import collections
+import fcntl
 import os
+import shutil
 import struct
+import weakref
+import zipfile
 
 import numpy as np
 import torch
 
-from fairseq.tokenizer import Tokenizer
+from fairseq.tokenizer import Tokenizer, tokenize_line
+
+from . import data_utils
 
 
 def read_longs(f, n):
@@ -24,6 +31,97 @@ def write_longs(f, a):
     f.write(np.array(a, dtype=np.int64))
 
 
+def memmap_array(path, dtype, offset, n):
+    if n == 0:
+        # empty files (and empty regions) cannot be mapped
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n,))
+
+
+def memmap_longs(path, offset, n):
+    return memmap_array(path, np.int64, offset, n)
+
+
+class SharedMemoryCopy(object):
+    """A copy of the file *path* in shared memory (*shm_dir*), at
+    :attr:`path`.
+
+    The copy is named after the file's path, size and modification time, so
+    that all processes of a node (e.g., distributed ranks) which load the same
+    file share one copy: the first one makes it, while the others wait for it
+    on a lock. Every user holds a shared lock on ``<copy>.lock`` until it
+    calls :func:`close` (or the object is garbage collected, or the process
+    exits); the last one removes the copy and the lock file.
+    """
+
+    def __init__(self, path, shm_dir='/dev/shm'):
+        key = data_utils.fingerprint([path])
+        shm_path = os.path.join(shm_dir, 'fairseq.{}.{}'.format(os.path.basename(path), key[:16]))
+        lock_path = shm_path + '.lock'
+        while True:
+            lock = open(lock_path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if _same_file(lock, lock_path):
+                break
+            # the lock file was removed by the last user of a previous copy
+            lock.close()
+        try:
+            if not os.path.exists(shm_path):
+                _copy_to_shared_memory(path, shm_path)
+        except BaseException:
+            _release_shared_memory_copy(lock, shm_path, os.getpid())
+            raise
+        self.path = shm_path
+        self._finalizer = weakref.finalize(self, _release_shared_memory_copy, lock, shm_path, os.getpid())
+
+    def close(self):
+        self._finalizer()
+
+
+def _copy_to_shared_memory(path, shm_path):
+    shm_dir = os.path.dirname(shm_path)
+    # copies are made one at a time, under a lock on *shm_dir*
+    dir_fd = os.open(shm_dir, os.O_RDONLY)
+    try:
+        fcntl.flock(dir_fd, fcntl.LOCK_EX)
+        if not os.path.exists(shm_path):
+            # leftovers of a process killed while copying
+            for name in os.listdir(shm_dir):
+                if name.startswith(os.path.basename(shm_path) + '.') and name.endswith('.tmp'):
+                    os.remove(os.path.join(shm_dir, name))
+            tmp_path = '{}.{}.tmp'.format(shm_path, os.getpid())
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, shm_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    finally:
+        os.close(dir_fd)
+
+
+def _same_file(f, path):
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _release_shared_memory_copy(lock, shm_path, pid):
+    # forked processes (e.g., data loading workers) share the lock of their
+    # parent, which is not theirs to release
+    if os.getpid() == pid:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass  # still used by other processes
+        else:
+            for p in [shm_path, shm_path + '.lock']:
+                if os.path.exists(p):
+                    os.remove(p)
+    lock.close()
+
+
 dtypes = {
     1: np.uint8,
     2: np.int8,
@@ -32,6 +130,7 @@ dtypes = {
     5: np.int64,
     6: np.float,
     7: np.double,
+    8: np.uint16,
 }
 
 
@@ -41,6 +140,14 @@ def code(dtype):
             return k
 
 
+def best_fitting_dtype(vocab_size=None):
+    """Return the smallest dtype that can store (0-based) ids of a vocabulary
+    of the given size."""
+    if vocab_size is not None and vocab_size <= 2 ** 16:
+        return np.uint16
+    return np.int32
+
+
 def index_file_path(prefix_path):
     return prefix_path + '.idx'
 
@@ -49,24 +156,47 @@ def data_file_path(prefix_path):
     return prefix_path + '.bin'
 
 
+def lines_index_path(path):
+    return path + '.lines.npz'
+
+
 class IndexedDataset(torch.utils.data.Dataset):
-    """Loader for TorchNet IndexedDataset"""
+    """Loader for TorchNet IndexedDataset
+
+    Both index versions are supported:
+        - version 1 stores 1-based (Lua) ids, which are shifted to 0-based ids
+          when *fix_lua_indexing* is set
+        - version 2 stores 0-based ids in the smallest dtype that fits the
+          vocabulary and records the vocabulary size and the total number of
+          tokens in the header; *fix_lua_indexing* is ignored
+    """
 
     def __init__(self, path, fix_lua_indexing=False):
         super().__init__()
         self.fix_lua_indexing = fix_lua_indexing
+        self.read_index(path)
+        self.read_data(path)
+
+    def read_header(self, f):
+        magic = f.read(8)
+        assert magic == b'TNTIDX\x00\x00'
+        self.version, = struct.unpack('<Q', f.read(8))
+        assert self.version in (1, 2), 'unsupported index version: {}'.format(self.version)
+        code, self.element_size = struct.unpack('<QQ', f.read(16))
+        self.dtype = dtypes[code]
+        self.size, self.s = struct.unpack('<QQ', f.read(16))
+        if self.version == 2:
+            self.vocab_size, self.total_tokens = struct.unpack('<QQ', f.read(16))
+            self.fix_lua_indexing = False  # ids are already 0-based
+        else:
+            self.vocab_size, self.total_tokens = None, None
+
+    def read_index(self, path):
         with open(index_file_path(path), 'rb') as f:
-            magic = f.read(8)
-            assert magic == b'TNTIDX\x00\x00'
-            version = f.read(8)
-            assert struct.unpack('<Q', version) == (1,)
-            code, self.element_size = struct.unpack('<QQ', f.read(16))
-            self.dtype = dtypes[code]
-            self.size, self.s = struct.unpack('<QQ', f.read(16))
+            self.read_header(f)
             self.dim_offsets = read_longs(f, self.size + 1)
             self.data_offsets = read_longs(f, self.size + 1)
             self.sizes = read_longs(f, self.s)
-        self.read_data(path)
 
     def read_data(self, path):
         self.data_file = open(data_file_path(path), 'rb', buffering=0)
@@ -78,16 +208,30 @@ class IndexedDataset(torch.utils.data.Dataset):
     def __del__(self):
         self.data_file.close()
 
+    def gather(self, buffer, indices):
+        """Fetch the 1d items at *indices* from *buffer*, the in-memory (or
+        memory-mapped) data, with a single fancy indexing operation."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= self.size):
+            raise IndexError('index out of range')
+        if self.s != self.size:
+            # items with more than one dimension
+            return [self[i] for i in indices]
+        flat_indices, lengths = data_utils.gather_ranges(
+            self.data_offsets[indices], self.data_offsets[indices + 1],
+        )
+        return data_utils.split_items(np.asarray(buffer[flat_indices]).astype(np.int64, copy=False), lengths)
+
     def __getitem__(self, i):
         self.check_index(i)
         tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
         a = np.empty(tensor_size, dtype=self.dtype)
         self.data_file.seek(self.data_offsets[i] * self.element_size)
         self.data_file.readinto(a)
-        item = torch.from_numpy(a).long()
+        item = a.astype(np.int64, copy=False)
         if self.fix_lua_indexing:
             item -= 1  # subtract 1 for 0-based indexing
-        return item
+        return torch.from_numpy(item)
 
     def __len__(self):
         return self.size
@@ -117,9 +261,126 @@ class IndexedInMemoryDataset(IndexedDataset):
     def __getitem__(self, i):
         self.check_index(i)
         tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
-        a = np.empty(tensor_size, dtype=self.dtype)
-        np.copyto(a, self.buffer[self.data_offsets[i]:self.data_offsets[i + 1]])
-        return torch.from_numpy(a).long()
+        a = self.buffer[self.data_offsets[i]:self.data_offsets[i + 1]]
+        return torch.from_numpy(a.astype(np.int64).reshape(tensor_size))
+
+    def __getitems__(self, indices):
+        return self.gather(self.buffer, indices)
+
+
+class IndexedMMapDataset(IndexedDataset):
+    """Loader for TorchNet IndexedDataset, memory-maps the index and data files.
+
+    Nothing is read at construction time: the offsets, sizes and tokens are
+    served from the OS page cache, which is shared by every process (data
+    loading workers, distributed ranks) that maps the same files.
+
+    With *shared_memory*, the data file is first copied to shared memory
+    (see :class:`SharedMemoryCopy`) and mapped from there, so that all
+    processes of a node share one copy of the data that is never evicted.
+    The copy is removed once every process has closed its datasets (and the
+    token streams taken from them).
+    """
+
+    def __init__(self, path, fix_lua_indexing=False, shared_memory=False):
+        self.path = path
+        self.shared_memory = shared_memory
+        super().__init__(path, fix_lua_indexing=fix_lua_indexing)
+
+    def read_index(self, path):
+        with open(index_file_path(path), 'rb') as f:
+            self.read_header(f)
+            offset = f.tell()
+        n = self.size + 1
+        self.dim_offsets = memmap_longs(index_file_path(path), offset, n)
+        self.data_offsets = memmap_longs(index_file_path(path), offset + 8 * n, n)
+        self.sizes = memmap_longs(index_file_path(path), offset + 16 * n, self.s)
+
+    def read_data(self, path):
+        data_path = data_file_path(path)
+        self.shm_copy = None
+        if self.shared_memory:
+            self.shm_copy = SharedMemoryCopy(data_path)
+            data_path = self.shm_copy.path
+        self.data = memmap_array(data_path, self.dtype, 0, self.data_offsets[-1])
+        self.buffer = TokenStream(
+            data_path, self.dtype, len(self.data), shift=-1 if self.fix_lua_indexing else 0,
+            owner=self.shm_copy,
+        )
+
+    def close(self):
+        """Release the shared memory copy of the data, if any."""
+        if self.shm_copy is not None:
+            self.shm_copy.close()
+
+    def __del__(self):
+        pass
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
+        # a view into the mapped file; it is only copied when it has to be
+        # widened to int64 or shifted to 0-based indexing
+        a = self.data[self.data_offsets[i]:self.data_offsets[i + 1]].reshape(tensor_size)
+        if a.dtype != np.int64 or self.fix_lua_indexing:
+            a = a.astype(np.int64)
+            if self.fix_lua_indexing:
+                a -= 1  # subtract 1 for 0-based indexing
+        return torch.from_numpy(a)
+
+    def __getitems__(self, indices):
+        return self.gather(self.buffer, indices)
+
+    def __getstate__(self):
+        # don't pickle the mapped arrays, they are re-mapped when unpickling
+        return {'path': self.path, 'fix_lua_indexing': self.fix_lua_indexing, 'shared_memory': self.shared_memory}
+
+    def __setstate__(self, state):
+        self.__init__(
+            state['path'], fix_lua_indexing=state['fix_lua_indexing'],
+            shared_memory=state.get('shared_memory', False),
+        )
+
+
+class TokenStream(object):
+    """The tokens of a memory-mapped data file as one read-only 1d stream.
+
+    Slices and index arrays taken from the stream are returned as int64
+    arrays with *shift* added (-1 exposes 1-based Lua ids as 0-based ids), and
+    only the pages they touch are read. Pickling the stream (e.g., to send it
+    to data loading workers) only pickles the path; the file is mapped again
+    on first use. The stream keeps *owner* (e.g., the
+    :class:`SharedMemoryCopy` of the file) alive for as long as it is used.
+    """
+
+    def __init__(self, path, dtype, length, shift=0, owner=None):
+        self.path = path
+        self.dtype = dtype
+        self.length = length
+        self.shift = shift
+        self._array = None
+        self._owner = owner
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = memmap_array(self.path, self.dtype, 0, self.length)
+        return self._array
+
+    def __getitem__(self, key):
+        a = np.asarray(self.array[key]).astype(np.int64)
+        if self.shift != 0:
+            a += self.shift
+        return a
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        state['_owner'] = None
+        return state
 
 
 class IndexedRawTextDataset(IndexedDataset):
@@ -166,6 +427,117 @@ class IndexedRawTextDataset(IndexedDataset):
         return os.path.exists(path)
 
 
+def text_lines(f):
+    """Iterate over the lines of a binary file, including their line endings,
+    split on ``\\n``, ``\\r\\n`` and ``\\r`` like a file opened in text mode."""
+    for line in f:
+        stop = len(line) - 2 if line.endswith(b'\r\n') else len(line)
+        start = 0
+        while start < len(line):
+            end = line.find(b'\r', start, stop)
+            if end < 0:
+                yield line[start:]
+                break
+            yield line[start:end + 1]
+            start = end + 1
+
+
+class IndexedLazyRawTextDataset(IndexedRawTextDataset):
+    """Takes a text file as input and binarizes its lines on demand.
+
+    A single pass over the file records the byte offset and the number of
+    tokens of every line, which is cached next to the file in
+    ``<path>.lines.npz`` (if the directory is writable) and reused for as
+    long as the file is unchanged. Lines are read and tokenized in
+    ``__getitem__``; the last *cache_size* tokenized lines are kept in an
+    LRU cache.
+    """
+
+    # bumped whenever the cached line index changes meaning
+    index_version = 1
+
+    def __init__(self, path, dictionary, append_eos=True, reverse_order=False, cache_size=0):
+        self.path = path
+        self.dictionary = dictionary
+        self.append_eos = append_eos
+        self.reverse_order = reverse_order
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.data_file = None
+        self.read_index(path)
+
+    def read_index(self, path):
+        stat = os.stat(path)
+        source = np.array([stat.st_size, stat.st_mtime_ns, self.index_version], dtype=np.int64)
+        cache_path = lines_index_path(path)
+        try:
+            with np.load(cache_path) as index:
+                if np.array_equal(index['source'], source):
+                    self.offsets, sizes = index['offsets'], index['sizes']
+                    self.set_sizes(sizes)
+                    return
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # missing, stale or corrupt cache
+            pass
+
+        offsets, sizes = [0], []
+        with open(path, 'rb') as f:
+            for line in text_lines(f):
+                offsets.append(offsets[-1] + len(line))
+                sizes.append(len(tokenize_line(line.decode('utf-8'))))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        sizes = np.array(sizes, dtype=np.int64)
+        self.set_sizes(sizes)
+
+        tmp_path = cache_path + '.tmp{}.npz'.format(os.getpid())
+        try:
+            np.savez(tmp_path, source=source, offsets=self.offsets, sizes=sizes)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print('| WARNING: could not cache line index of {}: {}'.format(path, e))
+
+    def set_sizes(self, sizes):
+        # the cached sizes do not count the end-of-sentence symbol
+        self.sizes = sizes + 1 if self.append_eos else sizes
+        self.size = len(self.sizes)
+
+    def read_line(self, i):
+        if self.data_file is None:
+            self.data_file = open(self.path, 'rb')
+        self.data_file.seek(self.offsets[i])
+        return self.data_file.read(self.offsets[i + 1] - self.offsets[i]).decode('utf-8')
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+        tokens = Tokenizer.tokenize(
+            self.read_line(i), self.dictionary, add_if_not_exist=False,
+            append_eos=self.append_eos, reverse_order=self.reverse_order,
+        ).long()
+        if self.cache_size > 0:
+            self.cache[i] = tokens
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return tokens
+
+    def get_original_text(self, i):
+        self.check_index(i)
+        return self.read_line(i).rstrip('\r\n')
+
+    def __del__(self):
+        if self.data_file is not None:
+            self.data_file.close()
+
+    def __getstate__(self):
+        # open files are not picklable, each data loading worker reopens it
+        state = self.__dict__.copy()
+        state['data_file'] = None
+        state['cache'] = collections.OrderedDict()
+        return state
+
+
 class IndexedDatasetBuilder(object):
     element_sizes = {
         np.uint8: 1,
@@ -174,32 +546,57 @@ class IndexedDatasetBuilder(object):
         np.int32: 4,
         np.int64: 8,
         np.float: 4,
-        np.double: 8
+        np.double: 8,
+        np.uint16: 2,
     }
 
-    def __init__(self, out_file, dtype=np.int32):
+    def __init__(self, out_file, dtype=np.int32, version=1, vocab_size=None):
+        assert version in (1, 2), 'unsupported index version: {}'.format(version)
+        assert version == 1 or vocab_size is not None, 'version 2 requires vocab_size'
         self.out_file = open(out_file, 'wb')
         self.dtype = dtype
+        self.version = version
+        self.vocab_size = vocab_size
         self.data_offsets = [0]
         self.dim_offsets = [0]
         self.sizes = []
         self.element_size = self.element_sizes[self.dtype]
 
     def add_item(self, tensor):
-        # +1 for Lua compatibility
-        bytes = self.out_file.write(np.array(tensor.numpy() + 1, dtype=self.dtype))
+        if self.version == 1:
+            # +1 for Lua compatibility
+            bytes = self.out_file.write(np.array(tensor.numpy() + 1, dtype=self.dtype))
+        else:
+            bytes = self.out_file.write(np.asarray(tensor.numpy(), dtype=self.dtype))
         self.data_offsets.append(self.data_offsets[-1] + bytes / self.element_size)
         for s in tensor.size():
             self.sizes.append(s)
         self.dim_offsets.append(self.dim_offsets[-1] + len(tensor.size()))
 
+    def merge_file_(self, another_file):
+        """Append the items of another dataset with the same dtype and version."""
+        index = IndexedDataset(another_file)
+        assert index.dtype == self.dtype
+        assert index.version == self.version
+
+        begin = self.data_offsets[-1]
+        self.data_offsets.extend(begin + offset for offset in index.data_offsets[1:].tolist())
+        self.sizes.extend(index.sizes.tolist())
+        begin = self.dim_offsets[-1]
+        self.dim_offsets.extend(begin + offset for offset in index.dim_offsets[1:].tolist())
+
+        with open(data_file_path(another_file), 'rb') as f:
+            shutil.copyfileobj(f, self.out_file)
+
     def finalize(self, index_file):
         self.out_file.close()
         index = open(index_file, 'wb')
         index.write(b'TNTIDX\x00\x00')
-        index.write(struct.pack('<Q', 1))
+        index.write(struct.pack('<Q', self.version))
         index.write(struct.pack('<QQ', code(self.dtype), self.element_size))
         index.write(struct.pack('<QQ', len(self.data_offsets) - 1, len(self.sizes)))
+        if self.version == 2:
+            index.write(struct.pack('<QQ', self.vocab_size, int(self.data_offsets[-1])))
         write_longs(index, self.dim_offsets)
         write_longs(index, self.data_offsets)
         write_longs(index, self.sizes)
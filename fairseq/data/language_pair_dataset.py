@@ -11,43 +11,36 @@ import torch
 from . import data_utils, FairseqDataset
 
 
-def collate(samples, pad_idx, eos_idx, left_pad_source=True, left_pad_target=False):
+def collate(samples, pad_idx, eos_idx, left_pad_source=True, left_pad_target=False, buffer_pool=None):
     if len(samples) == 0:
         return {}
 
-    def merge(key, left_pad, move_eos_to_beginning=False):
-        return data_utils.collate_tokens(
-            [s[key] for s in samples],
-            pad_idx, eos_idx, left_pad, move_eos_to_beginning,
-        )
-
-    id = torch.LongTensor([s['id'] for s in samples])
-    src_tokens = merge('source', left_pad=left_pad_source)
-    # sort by descending source length
+    # sort by descending source length before merging, so that the merged
+    # tensors do not need to be reordered
     src_lengths = torch.LongTensor([s['source'].numel() for s in samples])
     src_lengths, sort_order = src_lengths.sort(descending=True)
-    id = id.index_select(0, sort_order)
-    src_tokens = src_tokens.index_select(0, sort_order)
+    samples = [samples[i] for i in sort_order.tolist()]
+
+    id = torch.LongTensor([s['id'] for s in samples])
+    src_tokens = data_utils.collate_tokens(
+        [s['source'] for s in samples], pad_idx, eos_idx, left_pad_source, buffer_pool=buffer_pool,
+    )
 
     prev_output_tokens = None
     target = None
     if samples[0].get('target', None) is not None:
-        target = merge('target', left_pad=left_pad_target)
         # we create a shifted version of targets for feeding the
         # previous output token(s) into the next decoder step
-        prev_output_tokens = merge(
-            'target',
-            left_pad=left_pad_target,
-            move_eos_to_beginning=True,
+        target, prev_output_tokens = data_utils.collate_target_tokens(
+            [s['target'] for s in samples], pad_idx, eos_idx, left_pad_target, buffer_pool=buffer_pool,
         )
-        prev_output_tokens = prev_output_tokens.index_select(0, sort_order)
-        target = target.index_select(0, sort_order)
         ntokens = sum(len(s['target']) for s in samples)
     else:
         ntokens = sum(len(s['source']) for s in samples)
 
     return {
         'id': id,
+        'nsentences': len(samples),
         'ntokens': ntokens,
         'net_input': {
             'src_tokens': src_tokens,
@@ -58,15 +51,78 @@ def collate(samples, pad_idx, eos_idx, left_pad_source=True, left_pad_target=Fal
     }
 
 
+def collate_packed(samples, pad_idx, eos_idx, pack_length, buffer_pool=None):
+    """Merge samples into a batch in which each row holds several sentence
+    pairs (see :func:`~fairseq.data.data_utils.pack_sequences`).
+
+    The source and target of a pair occupy the same row of ``src_tokens`` and
+    ``target``. ``src_segments`` and ``tgt_segments`` give the number of the
+    pair of every token within its row (0 for padding), which models use to
+    reset positions and to restrict attention to the tokens of the same pair.
+    The decoder input of each pair starts with its own end-of-sentence symbol,
+    so no token is predicted from a previous pair."""
+    if len(samples) == 0:
+        return {}
+
+    # longest pairs first, so that first-fit packing leaves little room
+    has_target = samples[0].get('target', None) is not None
+    lengths = np.array([
+        [s['source'].numel(), s['target'].numel() if has_target else 0] for s in samples
+    ])
+    order = np.argsort(-lengths.max(axis=1), kind='mergesort')
+    samples = [samples[i] for i in order]
+    lengths = lengths[order]
+    rows, offsets, segments = data_utils.pack_sequences(lengths, pack_length)
+
+    src_tokens, src_segments = data_utils.collate_packed_tokens(
+        [s['source'] for s in samples], rows, offsets[:, 0], segments, pad_idx,
+        buffer_pool=buffer_pool, name='src_tokens',
+    )
+    prev_output_tokens = None
+    target = None
+    tgt_segments = None
+    if has_target:
+        target, prev_output_tokens, tgt_segments = data_utils.collate_packed_target_tokens(
+            [s['target'] for s in samples], rows, offsets[:, 1], segments, pad_idx, eos_idx,
+            buffer_pool=buffer_pool,
+        )
+        ntokens = int(lengths[:, 1].sum())
+    else:
+        ntokens = int(lengths[:, 0].sum())
+
+    return {
+        'id': torch.LongTensor([s['id'] for s in samples]),
+        'nsentences': len(samples),
+        'ntokens': ntokens,
+        'net_input': {
+            'src_tokens': src_tokens,
+            'src_lengths': src_tokens.ne(pad_idx).long().sum(dim=1),
+            'prev_output_tokens': prev_output_tokens,
+            'src_segments': src_segments,
+            'tgt_segments': tgt_segments,
+        },
+        'target': target,
+    }
+
+
 class LanguagePairDataset(FairseqDataset):
-    """A pair of torch.utils.data.Datasets."""
+    """A pair of torch.utils.data.Datasets.
+
+    If *buffer_pool* (a :class:`~fairseq.data.data_utils.BufferPool`) is
+    given, batches are collated into its reusable buffers.
+
+    If *pack_length* is given, the pairs of a batch are packed into rows of
+    up to *pack_length* source and target tokens instead of being padded to
+    the longest pair (see :func:`collate_packed`), which requires a model
+    that accepts ``src_segments`` and ``tgt_segments``.
+    """
 
     def __init__(
         self, src, src_sizes, src_dict,
         tgt=None, tgt_sizes=None, tgt_dict=None,
         left_pad_source=True, left_pad_target=False,
         max_source_positions=1024, max_target_positions=1024,
-        shuffle=True,
+        shuffle=True, buffer_pool=None, pack_length=None,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -83,6 +139,8 @@ class LanguagePairDataset(FairseqDataset):
         self.max_source_positions = max_source_positions
         self.max_target_positions = max_target_positions
         self.shuffle = shuffle
+        self.buffer_pool = buffer_pool
+        self.pack_length = pack_length
 
     def __getitem__(self, index):
         return {
@@ -91,14 +149,28 @@ class LanguagePairDataset(FairseqDataset):
             'target': self.tgt[index] if self.tgt is not None else None,
         }
 
+    def __getitems__(self, indices):
+        sources = data_utils.fetch_items(self.src, indices)
+        targets = data_utils.fetch_items(self.tgt, indices) if self.tgt is not None else [None] * len(sources)
+        return [
+            {'id': index, 'source': source, 'target': target}
+            for index, source, target in zip(indices, sources, targets)
+        ]
+
     def __len__(self):
         return len(self.src)
 
     def collater(self, samples):
         """Merge a list of samples to form a mini-batch."""
+        if self.pack_length is not None:
+            return collate_packed(
+                samples, pad_idx=self.src_dict.pad(), eos_idx=self.src_dict.eos(),
+                pack_length=self.pack_length, buffer_pool=self.buffer_pool,
+            )
         return collate(
             samples, pad_idx=self.src_dict.pad(), eos_idx=self.src_dict.eos(),
             left_pad_source=self.left_pad_source, left_pad_target=self.left_pad_target,
+            buffer_pool=self.buffer_pool,
         )
 
     def get_dummy_batch(self, num_tokens, max_positions, src_len=128, tgt_len=128):
@@ -116,7 +188,15 @@ class LanguagePairDataset(FairseqDataset):
 
     def num_tokens(self, index):
         """Return an example's length (number of tokens), used for batching."""
-        return max(self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
+        if self.tgt_sizes is None:
+            return self.src_sizes[index]
+        return np.maximum(self.src_sizes[index], self.tgt_sizes[index])
+
+    def size(self, index):
+        """Return an example's source and target lengths (0 without target)."""
+        src_sizes = self.src_sizes[index]
+        tgt_sizes = self.tgt_sizes[index] if self.tgt_sizes is not None else np.zeros_like(src_sizes)
+        return np.stack([src_sizes, tgt_sizes], axis=-1)
 
     def ordered_indices(self):
         """Ordered indices for batching."""
@@ -131,10 +211,10 @@ class LanguagePairDataset(FairseqDataset):
     def valid_size(self, index, max_positions):
         """Check if an example's size is valid according to max_positions."""
         max_source_positions, max_target_positions = self._get_max_positions(max_positions)
-        return (
-            self.src_sizes[index] <= max_source_positions
-            and (self.tgt_sizes is None or self.tgt_sizes[index] <= max_target_positions)
-        )
+        valid = self.src_sizes[index] <= max_source_positions
+        if self.tgt_sizes is not None:
+            valid &= self.tgt_sizes[index] <= max_target_positions
+        return valid
 
     def _get_max_positions(self, max_positions):
         if max_positions is None:
@@ -22,6 +22,7 @@ def collate(samples, pad_idx, eos_idx):
 
     return {
         'id': torch.LongTensor([s['id'] for s in samples]),
+        'nsentences': len(samples),
         'ntokens': sum(len(s['target']) for s in samples),
         'net_input': {
             'src_tokens': merge('source'),
@@ -43,6 +44,12 @@ class MonolingualDataset(FairseqDataset):
         source, target = self.dataset[index]
         return {'id': index, 'source': source, 'target': target}
 
+    def __getitems__(self, indices):
+        return [
+            {'id': index, 'source': source, 'target': target}
+            for index, (source, target) in zip(indices, data_utils.fetch_items(self.dataset, indices))
+        ]
+
     def __len__(self):
         return len(self.dataset)
 
@@ -63,8 +70,13 @@ class MonolingualDataset(FairseqDataset):
 
     def num_tokens(self, index):
         """Return an example's length (number of tokens), used for batching."""
-        source, target = self.dataset[index]
-        return len(source)
+        return self.sizes[index]
+
+    def size(self, index):
+        """Return an example's source and target lengths, the source being
+        empty (the decoder reads the target, shifted by one token)."""
+        sizes = self.sizes[index]
+        return np.stack([np.zeros_like(sizes), sizes], axis=-1)
 
     def ordered_indices(self):
         """Ordered indices for batching."""
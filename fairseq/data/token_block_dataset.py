@@ -5,19 +5,24 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
-import math
+import os
 
 import numpy as np
 import torch
 
+from . import data_utils
+
 
 class TokenBlockDataset(torch.utils.data.Dataset):
     """Break a 1d tensor of tokens into blocks.
 
     The blocks are fetched from the original tensor so no additional memory is allocated.
+    Only *sizes* are read to compute the blocks, so *tokens* may also be a
+    memory-mapped :class:`~fairseq.data.indexed_dataset.TokenStream`, of
+    which only the blocks that are fetched are read.
 
     Args:
-        tokens: 1d tensor of tokens to break into blocks
+        tokens: 1d tensor (or array-like) of tokens to break into blocks
         sizes: sentence lengths (required for 'complete' and 'eos')
         block_size: maximum block size (ignored in 'eos' break mode)
         break_mode: Mode used for breaking tokens. Values can be one of:
@@ -27,52 +32,28 @@ class TokenBlockDataset(torch.utils.data.Dataset):
                 exceeded if some sentences exceed block_size
             - 'eos': each block contains one sentence (block_size is ignored)
         include_targets: return next tokens as targets
+        cache_path: optional path of a ``.npy`` file in which the block
+            boundaries are cached; it must change whenever *tokens*, *sizes*,
+            *block_size* or *break_mode* do
     """
 
-    def __init__(self, tokens, sizes, block_size, break_mode=None, include_targets=False):
+    def __init__(self, tokens, sizes, block_size, break_mode=None, include_targets=False, cache_path=None):
         super().__init__()
 
         self.tokens = tokens
         self.total_size = len(tokens)
         self.include_targets = include_targets
-        self.slice_indices = []
-
-        if break_mode is None or break_mode == 'none':
-            length = math.ceil(len(tokens) / block_size)
-
-            def block_at(i):
-                start = i * block_size
-                end = min(start + block_size, len(tokens))
-                return (start, end)
-
-            self.slice_indices = [block_at(i) for i in range(length)]
-        elif break_mode == 'complete':
-            assert sizes is not None and sum(sizes) == len(tokens), '{} != {}'.format(sum(sizes), len(tokens))
-            tok_idx = 0
-            sz_idx = 0
-            curr_size = 0
-            while sz_idx < len(sizes):
-                if curr_size + sizes[sz_idx] <= block_size or curr_size == 0:
-                    curr_size += sizes[sz_idx]
-                    sz_idx += 1
-                else:
-                    self.slice_indices.append((tok_idx, tok_idx + curr_size))
-                    tok_idx += curr_size
-                    curr_size = 0
-            if curr_size > 0:
-                self.slice_indices.append((tok_idx, tok_idx + curr_size))
-        elif break_mode == 'eos':
-            assert sizes is not None and sum(sizes) == len(tokens), '{} != {}'.format(sum(sizes), len(tokens))
-            curr = 0
-            for sz in sizes:
-                # skip samples with just 1 example (which would be just the eos token)
-                if sz > 1:
-                    self.slice_indices.append((curr, curr + sz))
-                curr += sz
-        else:
-            raise ValueError('Invalid break_mode: ' + break_mode)
 
-        self.sizes = np.array([e - s for s, e in self.slice_indices])
+        if cache_path is not None and os.path.exists(cache_path):
+            self.slice_indices = np.load(cache_path, mmap_mode='r')
+        else:
+            self.slice_indices = block_slice_indices(len(tokens), sizes, block_size, break_mode)
+            if cache_path is not None:
+                try:
+                    data_utils.save_array(cache_path, self.slice_indices)
+                except OSError as e:
+                    print('| WARNING: could not cache blocks in {}: {}'.format(cache_path, e))
+        self.sizes = self.slice_indices[:, 1] - self.slice_indices[:, 0]
 
     def __getitem__(self, index):
         s, e = self.slice_indices[index]
@@ -89,5 +70,49 @@ class TokenBlockDataset(torch.utils.data.Dataset):
             return torch.LongTensor(source), item
         return item
 
+    def __getitems__(self, indices):
+        starts, ends = self.slice_indices[indices].T
+        flat_indices, lengths = data_utils.gather_ranges(starts, ends)
+        items = data_utils.split_items(np.asarray(self.tokens[flat_indices], dtype=np.int64), lengths)
+        if self.include_targets:
+            # index -1 wraps around to the last token, as in __getitem__
+            sources = data_utils.split_items(np.asarray(self.tokens[flat_indices - 1], dtype=np.int64), lengths)
+            return list(zip(sources, items))
+        return items
+
     def __len__(self):
         return len(self.slice_indices)
+
+
+def block_slice_indices(total_size, sizes, block_size, break_mode=None):
+    """Compute the ``[start, end)`` token offsets of the blocks of
+    :class:`TokenBlockDataset`, as an ``(N, 2)`` int64 array."""
+    if break_mode is None or break_mode == 'none':
+        starts = np.arange(0, total_size, block_size, dtype=np.int64)
+        return np.stack([starts, np.minimum(starts + block_size, total_size)], axis=1)
+
+    assert sizes is not None and np.sum(sizes) == total_size, '{} != {}'.format(np.sum(sizes), total_size)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    # sentence i spans tokens [offsets[i], offsets[i + 1])
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+
+    if break_mode == 'complete':
+        # a block starting at sentence i extends over as many sentences as fit
+        # into block_size, but contains at least sentence i
+        next_start = np.searchsorted(offsets, offsets[:-1] + block_size, side='right') - 1
+        np.maximum(next_start, np.arange(1, len(sizes) + 1), out=next_start)
+        # follow the chain of block starts from the first sentence
+        boundaries = [0]
+        while boundaries[-1] < len(sizes):
+            boundaries.append(next_start[boundaries[-1]])
+        boundaries = offsets[boundaries]
+        slice_indices = np.stack([boundaries[:-1], boundaries[1:]], axis=1)
+        # trailing empty sentences don't make a block
+        return slice_indices[slice_indices[:, 1] > slice_indices[:, 0]]
+    elif break_mode == 'eos':
+        # skip samples with just 1 example (which would be just the eos token)
+        keep = sizes > 1
+        return np.stack([offsets[:-1][keep], offsets[1:][keep]], axis=1)
+    else:
+        raise ValueError('Invalid break_mode: ' + break_mode)
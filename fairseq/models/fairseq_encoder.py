@@ -22,6 +22,17 @@ class FairseqEncoder(nn.Module):
         """Reorder encoder output according to new_order."""
         raise NotImplementedError
 
+    def expand_encoder_out(self, encoder_out, new_order):
+        """Expand encoder output for beam search, where new_order gives the
+        sentence of each hypothesis.
+
+        By default the output of each sentence is copied for each of its
+        hypotheses with :func:`reorder_encoder_out`. Encoders whose decoders
+        can share the output of a sentence across its hypotheses may return
+        it unchanged instead.
+        """
+        return self.reorder_encoder_out(encoder_out, new_order)
+
     def max_positions(self):
         """Maximum input length supported by the encoder."""
         raise NotImplementedError
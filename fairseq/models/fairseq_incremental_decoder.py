@@ -32,6 +32,18 @@ class FairseqIncrementalDecoder(FairseqDecoder):
                 )
         self.apply(apply_reorder_incremental_state)
 
+    def allocate_incremental_state(self, incremental_state, max_len):
+        """Preallocate incremental state for decoding up to *max_len* steps.
+
+        Modules that cache the outputs of previous time steps (e.g.,
+        :class:`~fairseq.modules.MultiheadAttention`) can then update their
+        state in place rather than growing it at every step.
+        """
+        def apply_allocate_incremental_state(module):
+            if module != self and hasattr(module, 'allocate_incremental_state'):
+                module.allocate_incremental_state(incremental_state, max_len)
+        self.apply(apply_allocate_incremental_state)
+
     def set_beam_size(self, beam_size):
         """Sets the beam size in the decoder and all children."""
         if getattr(self, '_beam_size', -1) != beam_size:
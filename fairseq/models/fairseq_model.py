@@ -14,6 +14,10 @@ from . import FairseqDecoder, FairseqEncoder
 class BaseFairseqModel(nn.Module):
     """Base class for fairseq models."""
 
+    # whether forward() accepts the src_segments and tgt_segments of packed
+    # batches (see LanguagePairDataset's pack_length)
+    supports_packed_batches = False
+
     def __init__(self):
         super().__init__()
         self._is_generation_fast = False
@@ -26,6 +26,8 @@ from . import (
 
 @register_model('transformer')
 class TransformerModel(FairseqModel):
+    supports_packed_batches = True
+
     def __init__(self, encoder, decoder):
         super().__init__(encoder, decoder)
 
@@ -125,6 +127,13 @@ class TransformerModel(FairseqModel):
         decoder = TransformerDecoder(args, tgt_dict, decoder_embed_tokens)
         return TransformerModel(encoder, decoder)
 
+    def forward(self, src_tokens, src_lengths, prev_output_tokens, src_segments=None, tgt_segments=None):
+        """Packed batches (see :func:`fairseq.data.language_pair_dataset.collate_packed`)
+        also pass the segment number of every source and target token."""
+        encoder_out = self.encoder(src_tokens, src_lengths, src_segments=src_segments)
+        decoder_out = self.decoder(prev_output_tokens, encoder_out, tgt_segments=tgt_segments)
+        return decoder_out
+
 
 @register_model('transformer_lm')
 class TransformerLanguageModel(FairseqLanguageModel):
@@ -205,24 +214,31 @@ class TransformerEncoder(FairseqEncoder):
         if self.normalize:
            self.layer_norm = LayerNorm(embed_dim)
 
-    def forward(self, src_tokens, src_lengths):
+    def forward(self, src_tokens, src_lengths, src_segments=None):
         # embed tokens and positions
         x = self.embed_scale * self.embed_tokens(src_tokens)
         if self.embed_positions is not None:
-            x += self.embed_positions(src_tokens)
+            x += self.embed_positions(src_tokens, segments=src_segments)
         x = F.dropout(x, p=self.dropout, training=self.training)
 
         # B x T x C -> T x B x C
         x = x.transpose(0, 1)
 
-        # compute padding mask
-        encoder_padding_mask = src_tokens.eq(self.padding_idx)
-        if not encoder_padding_mask.any():
+        if src_segments is not None:
+            # packed batch: only attend within each segment, which also
+            # excludes padding
             encoder_padding_mask = None
+            attn_mask = utils.make_segment_mask(src_segments, src_segments)
+        else:
+            # compute padding mask
+            encoder_padding_mask = src_tokens.eq(self.padding_idx)
+            if not encoder_padding_mask.any():
+                encoder_padding_mask = None
+            attn_mask = None
 
         # encoder layers
         for layer in self.layers:
-            x = layer(x, encoder_padding_mask)
+            x = layer(x, encoder_padding_mask, attn_mask=attn_mask)
 
         if self.normalize:
             x = self.layer_norm(x)
@@ -230,15 +246,32 @@ class TransformerEncoder(FairseqEncoder):
         return {
             'encoder_out': x,  # T x B x C
             'encoder_padding_mask': encoder_padding_mask,  # B x T
+            'encoder_segments': src_segments,  # B x T
         }
 
+    def expand_encoder_out(self, encoder_out, new_order):
+        """The attention layers of the decoder attend to the output of each
+        sentence with the queries of all its hypotheses, so the output is
+        shared rather than copied."""
+        encoder_out = dict(encoder_out)
+        encoder_out['beam_size'] = new_order.numel() // encoder_out['encoder_out'].size(1)
+        return encoder_out
+
     def reorder_encoder_out(self, encoder_out, new_order):
+        beam_size = encoder_out.get('beam_size', 1)
+        if beam_size > 1:
+            # the output is shared by the hypotheses of each sentence, see
+            # expand_encoder_out
+            new_order = new_order.view(-1, beam_size)[:, 0] // beam_size
         if encoder_out['encoder_out'] is not None:
             encoder_out['encoder_out'] = \
                 encoder_out['encoder_out'].index_select(1, new_order)
         if encoder_out['encoder_padding_mask'] is not None:
             encoder_out['encoder_padding_mask'] = \
                 encoder_out['encoder_padding_mask'].index_select(0, new_order)
+        if encoder_out['encoder_segments'] is not None:
+            encoder_out['encoder_segments'] = \
+                encoder_out['encoder_segments'].index_select(0, new_order)
         return encoder_out
 
     def max_positions(self):
@@ -302,11 +335,12 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         if self.normalize:
            self.layer_norm = LayerNorm(embed_dim)
 
-    def forward(self, prev_output_tokens, encoder_out=None, incremental_state=None):
+    def forward(self, prev_output_tokens, encoder_out=None, incremental_state=None, tgt_segments=None):
         # embed positions
         positions = self.embed_positions(
             prev_output_tokens,
             incremental_state=incremental_state,
+            segments=tgt_segments,
         ) if self.embed_positions is not None else None
 
         if incremental_state is not None:
@@ -324,6 +358,15 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         x = x.transpose(0, 1)
         attn = None
 
+        # packed batch: only attend within each segment
+        self_attn_mask = None
+        encoder_attn_mask = None
+        if tgt_segments is not None:
+            assert incremental_state is None, 'packed batches are not supported for incremental decoding'
+            self_attn_mask = utils.make_segment_mask(tgt_segments, tgt_segments)
+            if encoder_out is not None and encoder_out['encoder_segments'] is not None:
+                encoder_attn_mask = utils.make_segment_mask(tgt_segments, encoder_out['encoder_segments'])
+
         # decoder layers
         for layer in self.layers:
             x, attn = layer(
@@ -331,6 +374,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 encoder_out['encoder_out'] if encoder_out is not None else None,
                 encoder_out['encoder_padding_mask'] if encoder_out is not None else None,
                 incremental_state,
+                self_attn_mask=self_attn_mask,
+                encoder_attn_mask=encoder_attn_mask,
             )
 
         if self.normalize:
@@ -409,10 +454,12 @@ class TransformerEncoderLayer(nn.Module):
         self.fc2 = Linear(args.encoder_ffn_embed_dim, self.embed_dim)
         self.layer_norms = nn.ModuleList([LayerNorm(self.embed_dim) for i in range(2)])
 
-    def forward(self, x, encoder_padding_mask):
+    def forward(self, x, encoder_padding_mask, attn_mask=None):
         residual = x
         x = self.maybe_layer_norm(0, x, before=True)
-        x, _ = self.self_attn(query=x, key=x, value=x, key_padding_mask=encoder_padding_mask)
+        x, _ = self.self_attn(
+            query=x, key=x, value=x, key_padding_mask=encoder_padding_mask, attn_mask=attn_mask,
+        )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
         x = self.maybe_layer_norm(0, x, after=True)
@@ -467,7 +514,8 @@ class TransformerDecoderLayer(nn.Module):
         self.final_layer_norm = LayerNorm(self.embed_dim)
         self.need_attn = True
 
-    def forward(self, x, encoder_out, encoder_padding_mask, incremental_state):
+    def forward(self, x, encoder_out, encoder_padding_mask, incremental_state,
+                self_attn_mask=None, encoder_attn_mask=None):
         residual = x
         x = self.maybe_layer_norm(self.self_attn_layer_norm, x, before=True)
         x, _ = self.self_attn(
@@ -477,6 +525,7 @@ class TransformerDecoderLayer(nn.Module):
             mask_future_timesteps=True,
             incremental_state=incremental_state,
             need_weights=False,
+            attn_mask=self_attn_mask,
         )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
@@ -494,6 +543,7 @@ class TransformerDecoderLayer(nn.Module):
                 incremental_state=incremental_state,
                 static_kv=True,
                 need_weights=(not self.training and self.need_attn),
+                attn_mask=encoder_attn_mask,
             )
             x = F.dropout(x, p=self.dropout, training=self.training)
             x = residual + x
@@ -21,11 +21,16 @@ class LearnedPositionalEmbedding(nn.Embedding):
         super().__init__(num_embeddings, embedding_dim, padding_idx)
         self.left_pad = left_pad
 
-    def forward(self, input, incremental_state=None):
-        """Input is expected to be of size [bsz x seqlen]."""
+    def forward(self, input, incremental_state=None, segments=None):
+        """Input is expected to be of size [bsz x seqlen].
+
+        For packed batches, *segments* gives the segment number of every
+        token and positions restart at each segment."""
         if incremental_state is not None:
             # positions is the same for every token when decoding a single step
             positions = input.data.new(1, 1).fill_(self.padding_idx + input.size(1))
+        elif segments is not None:
+            positions = utils.make_segment_positions(segments.data, self.padding_idx)
         else:
             positions = utils.make_positions(input.data, self.padding_idx, self.left_pad)
         return super().forward(positions)
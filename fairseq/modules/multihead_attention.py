@@ -46,14 +46,17 @@ class MultiheadAttention(nn.Module):
 
     def forward(self, query, key, value, mask_future_timesteps=False,
                 key_padding_mask=None, incremental_state=None,
-                need_weights=True, static_kv=False):
+                need_weights=True, static_kv=False, attn_mask=None):
         """Input shape: Time x Batch x Channel
 
         Self-attention can be implemented by passing in the same arguments for
         query, key and value. Future timesteps can be masked with the
         `mask_future_timesteps` argument. Padding elements can be excluded from
         the key by passing a binary ByteTensor (`key_padding_mask`) with shape:
-        batch x src_len, where padding elements are indicated by 1s.
+        batch x src_len, where padding elements are indicated by 1s. Arbitrary
+        query-key pairs can be excluded by passing a binary tensor
+        (`attn_mask`) with shape: batch x tgt_len x src_len, e.g. the
+        block-diagonal mask of a packed batch (see `utils.make_segment_mask`).
         """
 
         qkv_same = query.data_ptr() == key.data_ptr() == value.data_ptr()
@@ -83,38 +86,59 @@ class MultiheadAttention(nn.Module):
             q = self.in_proj_q(query)
             if key is None:
                 assert value is None
-                # this will allow us to concat it with previous value and get
-                # just get the previous value
-                k = v = q.new(0)
+                # the static keys and values are taken from the saved state
+                k = v = None
             else:
                 k, v = self.in_proj_kv(key)
         else:
             q = self.in_proj_q(query)
             k = self.in_proj_k(key)
             v = self.in_proj_v(value)
-        q *= self.scaling
+        q = q * self.scaling
 
         if saved_state is not None:
-            if 'prev_key' in saved_state:
-                k = torch.cat((saved_state['prev_key'], k), dim=0)
-            if 'prev_value' in saved_state:
-                v = torch.cat((saved_state['prev_value'], v), dim=0)
+            if static_kv:
+                # static keys and values are computed once and reused as is
+                if k is None:
+                    k, v = saved_state['prev_key'], saved_state['prev_value']
+                saved_state['static_kv'] = True
+            elif 'cache_size' in saved_state:
+                k, v = self._append_to_kv_cache(saved_state, k, v)
+            else:
+                if 'prev_key' in saved_state:
+                    k = torch.cat((saved_state['prev_key'], k), dim=0)
+                if 'prev_value' in saved_state:
+                    v = torch.cat((saved_state['prev_value'], v), dim=0)
             saved_state['prev_key'] = k
             saved_state['prev_value'] = v
+            # number of hypotheses that share the keys and values of a sentence
+            saved_state['beam_size'] = bsz // k.size(1)
             self._set_input_buffer(incremental_state, saved_state)
 
         src_len = k.size(0)
 
+        # the keys and values of a sentence may be shared by its beam_size
+        # hypotheses (see TransformerEncoder.expand_encoder_out), in which
+        # case the queries of these hypotheses attend to them together
+        kv_bsz = k.size(1)
+        beam_size = bsz // kv_bsz
+        assert kv_bsz * beam_size == bsz
+        q_len = beam_size * tgt_len
+
         if key_padding_mask is not None:
-            assert key_padding_mask.size(0) == bsz
+            assert key_padding_mask.size(0) == kv_bsz
             assert key_padding_mask.size(1) == src_len
 
-        q = q.contiguous().view(tgt_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
-        k = k.contiguous().view(src_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
-        v = v.contiguous().view(src_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
+        if beam_size > 1:
+            q = q.contiguous().view(tgt_len, kv_bsz, beam_size, self.num_heads, self.head_dim)
+            q = q.permute(1, 3, 2, 0, 4).contiguous().view(kv_bsz*self.num_heads, q_len, self.head_dim)
+        else:
+            q = q.contiguous().view(tgt_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
+        k = k.contiguous().view(src_len, kv_bsz*self.num_heads, self.head_dim).transpose(0, 1)
+        v = v.contiguous().view(src_len, kv_bsz*self.num_heads, self.head_dim).transpose(0, 1)
 
         attn_weights = torch.bmm(q, k.transpose(1, 2))
-        assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
+        assert list(attn_weights.size()) == [kv_bsz * self.num_heads, q_len, src_len]
 
         # only apply masking at training time (when incremental state is None)
         if mask_future_timesteps and incremental_state is None:
@@ -123,24 +147,37 @@ class MultiheadAttention(nn.Module):
             attn_weights += self.buffered_mask(attn_weights).unsqueeze(0)
         if key_padding_mask is not None:
             # don't attend to padding symbols
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(kv_bsz, self.num_heads, q_len, src_len)
             attn_weights = attn_weights.float().masked_fill(
                 key_padding_mask.unsqueeze(1).unsqueeze(2),
                 float('-inf'),
             ).type_as(attn_weights)  # FP16 support: cast to float and back
+            attn_weights = attn_weights.view(kv_bsz * self.num_heads, q_len, src_len)
+        if attn_mask is not None:
+            # don't attend across segments of packed sequences
+            assert beam_size == 1 and list(attn_mask.size()) == [bsz, tgt_len, src_len]
+            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.float().masked_fill(
+                attn_mask.unsqueeze(1),
+                float('-inf'),
+            ).type_as(attn_weights)  # FP16 support: cast to float and back
             attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
         attn_weights = F.softmax(attn_weights.float(), dim=-1).type_as(attn_weights)
         attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
 
         attn = torch.bmm(attn_weights, v)
-        assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
-        attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        assert list(attn.size()) == [kv_bsz * self.num_heads, q_len, self.head_dim]
+        if beam_size > 1:
+            attn = attn.view(kv_bsz, self.num_heads, beam_size, tgt_len, self.head_dim)
+            attn = attn.permute(3, 0, 2, 1, 4).contiguous().view(tgt_len, bsz, embed_dim)
+        else:
+            attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
         attn = self.out_proj(attn)
 
         if need_weights:
             # average attention weights over heads
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights.sum(dim=1) / self.num_heads
+            attn_weights = attn_weights.view(kv_bsz, self.num_heads, q_len, src_len)
+            attn_weights = attn_weights.sum(dim=1).view(bsz, tgt_len, src_len) / self.num_heads
         else:
             attn_weights = None
 
@@ -182,14 +219,78 @@ class MultiheadAttention(nn.Module):
             self._mask = torch.triu(utils.fill_with_neg_inf(self._mask.resize_(dim, dim)), 1)
         return self._mask[:dim, :dim]
 
+    def allocate_incremental_state(self, incremental_state, max_len):
+        """Keep the keys and values of up to *max_len* time steps in buffers
+        that are allocated at the first step and updated in place, instead of
+        growing them at every step (for incremental generation). Static keys
+        and values (e.g., of encoder-decoder attention) are not affected."""
+        input_buffer = self._get_input_buffer(incremental_state)
+        input_buffer['cache_size'] = max_len
+        self._set_input_buffer(incremental_state, input_buffer)
+
+    def _append_to_kv_cache(self, saved_state, k, v):
+        """Write the keys and values of the current time steps into the
+        preallocated buffers and return views of all cached time steps."""
+        start = saved_state['prev_key'].size(0) if 'prev_key' in saved_state else 0
+        end = start + k.size(0)
+        if 'key_buffer' not in saved_state:
+            size = (saved_state['cache_size'], k.size(1), k.size(2))
+            saved_state['key_buffer'] = k.new_empty(size)
+            saved_state['value_buffer'] = v.new_empty(size)
+        key_buffer, value_buffer = saved_state['key_buffer'], saved_state['value_buffer']
+        assert end <= key_buffer.size(0), 'the key/value cache is full'
+        key_buffer[start:end] = k
+        value_buffer[start:end] = v
+        return key_buffer[:end], value_buffer[:end]
+
     def reorder_incremental_state(self, incremental_state, new_order):
-        """Reorder buffered internal state (for incremental generation)."""
+        """Reorder buffered internal state (for incremental generation).
+
+        *new_order* may move hypotheses within their sentences and drop whole
+        sentences, as :class:`SequenceGenerator` does, but it does not permute
+        the sentences themselves.
+        """
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
-            for k in input_buffer.keys():
-                input_buffer[k] = input_buffer[k].index_select(1, new_order)
+            if 'key_buffer' in input_buffer:
+                length = input_buffer['prev_key'].size(0)
+                for k in ['key_buffer', 'value_buffer']:
+                    input_buffer[k] = self._reorder_kv_cache(input_buffer[k], length, new_order)
+                input_buffer['prev_key'] = input_buffer['key_buffer'][:length]
+                input_buffer['prev_value'] = input_buffer['value_buffer'][:length]
+            elif self._needs_reorder(input_buffer, new_order):
+                beam_size = input_buffer.get('beam_size', 1)
+                if beam_size > 1:
+                    # keys and values shared by the hypotheses of each
+                    # sentence only follow the order of the sentences
+                    new_order = new_order.view(-1, beam_size)[:, 0] // beam_size
+                for k in input_buffer.keys():
+                    if torch.is_tensor(input_buffer[k]):
+                        input_buffer[k] = input_buffer[k].index_select(1, new_order)
             self._set_input_buffer(incremental_state, input_buffer)
 
+    def _needs_reorder(self, input_buffer, new_order):
+        if not input_buffer.get('static_kv', False):
+            return True
+        # static keys and values are identical for all the hypotheses of a
+        # sentence, so reordering the hypotheses within their sentences leaves
+        # them unchanged; they only follow sentences removed from the batch
+        bsz = input_buffer['prev_key'].size(1) * input_buffer['beam_size']
+        return new_order.numel() != bsz
+
+    def _reorder_kv_cache(self, buffer, length, new_order):
+        if new_order.numel() != buffer.size(1):
+            # sentences were removed from the batch, compact the buffer
+            new_buffer = buffer.new_empty(buffer.size(0), new_order.numel(), buffer.size(2))
+            new_buffer[:length] = buffer[:length].index_select(1, new_order)
+            return new_buffer
+        # only copy the history of the hypotheses whose parent changed
+        changed = new_order.ne(utils.buffered_arange(new_order.numel()).type_as(new_order)).nonzero().squeeze(-1)
+        if changed.numel() > 0:
+            history = buffer[:length]
+            history.index_copy_(1, changed, history.index_select(1, new_order[changed]))
+        return buffer
+
     def _get_input_buffer(self, incremental_state):
         return utils.get_incremental_state(
             self,
@@ -51,8 +51,11 @@ class SinusoidalPositionalEmbedding(nn.Module):
             emb[padding_idx, :] = 0
         return emb
 
-    def forward(self, input, incremental_state=None):
-        """Input is expected to be of size [bsz x seqlen]."""
+    def forward(self, input, incremental_state=None, segments=None):
+        """Input is expected to be of size [bsz x seqlen].
+
+        For packed batches, *segments* gives the segment number of every
+        token and positions restart at each segment."""
         # recompute/expand embeddings if needed
         bsz, seq_len = input.size()
         max_pos = self.padding_idx + 1 + seq_len
@@ -68,7 +71,10 @@ class SinusoidalPositionalEmbedding(nn.Module):
             # positions is the same for every token when decoding a single step
             return self.weights[self.padding_idx + seq_len, :].expand(bsz, 1, -1)
 
-        positions = utils.make_positions(input.data, self.padding_idx, self.left_pad)
+        if segments is not None:
+            positions = utils.make_segment_positions(segments.data, self.padding_idx)
+        else:
+            positions = utils.make_positions(input.data, self.padding_idx, self.left_pad)
         return self.weights.index_select(0, positions.view(-1)).view(bsz, seq_len, -1).detach()
 
     def max_positions(self):
@@ -10,6 +10,7 @@ import argparse
 import torch
 
 from fairseq.criterions import CRITERION_REGISTRY
+from fairseq.data.data_utils import BATCH_COSTS
 from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
 from fairseq.optim import OPTIMIZER_REGISTRY
 from fairseq.optim.lr_scheduler import LR_SCHEDULER_REGISTRY
@@ -143,6 +144,20 @@ def add_dataset_args(parser, train=False, gen=False):
                        help='maximum number of tokens in a batch')
     group.add_argument('--max-sentences', '--batch-size', type=int, metavar='N',
                        help='maximum number of sentences in a batch')
+    group.add_argument('--num-workers', default=0, type=int, metavar='N',
+                       help='how many subprocesses to use for data loading')
+    group.add_argument('--prefetch-factor', default=2, type=int, metavar='N',
+                       help='number of batches loaded in advance by each data loading worker')
+    group.add_argument('--cache-batches', action='store_true',
+                       help='cache the batches (and language modeling blocks) of each dataset in '
+                            'the data directory and reuse them in later runs with the same data '
+                            'and batching arguments')
+    group.add_argument('--batch-cost', default='max_tokens', metavar='COST',
+                       choices=BATCH_COSTS.keys(),
+                       help='cost that --max-tokens bounds for each batch: the number of tokens of '
+                            'the longest side (max_tokens), padded source plus target tokens '
+                            '(padded_tokens), or padded tokens plus the quadratic cost of '
+                            'attention in a transformer (transformer)')
     if train:
         group.add_argument('--train-subset', default='train', metavar='SPLIT',
                            choices=['train', 'valid', 'test'],
@@ -150,6 +165,15 @@ def add_dataset_args(parser, train=False, gen=False):
         group.add_argument('--valid-subset', default='valid', metavar='SPLIT',
                            help='comma separated list of data subsets to use for validation'
                                 ' (train, valid, valid1, test, test1)')
+        group.add_argument('--balance-shards', action='store_true',
+                           help='reorder the training batches of each epoch so that the batches that '
+                                'distributed workers process at the same step have similar numbers '
+                                'of tokens')
+        group.add_argument('--shard-sample-ratios', metavar='R1,R2,...',
+                           help='comma separated sampling ratio of each shard of the training data '
+                                '(train, train1, ...); shards are resampled without being copied, '
+                                'e.g., 3 upsamples a shard three times and 0.5 keeps a random half of it '
+                                '(the same half in every epoch, drawn with --seed)')
         group.add_argument('--max-sentences-valid', type=int, metavar='N',
                            help='maximum number of sentences in a validation batch'
                                 ' (defaults to --max-sentences)')
@@ -299,6 +323,10 @@ def add_generation_args(parser):
                        help='sample from top K likely next words instead of all words')
     group.add_argument('--sampling-temperature', default=1, type=float, metavar='N',
                        help='temperature for random sampling')
+    group.add_argument('--kv-cache', action='store_true',
+                       help='preallocate the attention keys and values of the decoder for the '
+                            'maximum output length and update them in place, instead of copying '
+                            'them at every step (faster, but uses more memory)')
     group.add_argument('--print-alignment', action='store_true',
                        help='if set, uses attention feedback to compute and print alignment to source tokens')
     group.add_argument('--model-overrides', default="{}", type=str, metavar='DICT',
@@ -17,7 +17,7 @@ class SequenceGenerator(object):
     def __init__(
         self, models, tgt_dict, beam_size=1, minlen=1, maxlen=None, stop_early=True,
         normalize_scores=True, len_penalty=1, unk_penalty=0, retain_dropout=False,
-        sampling=False, sampling_topk=-1, sampling_temperature=1,
+        sampling=False, sampling_topk=-1, sampling_temperature=1, kv_cache=False,
     ):
         """Generates translations of a given source sentence.
         Args:
@@ -27,6 +27,10 @@ class SequenceGenerator(object):
                 hypotheses, even though longer hypotheses might have better
                 normalized scores.
             normalize_scores: Normalize scores by the length of the output.
+            kv_cache: Preallocate the incremental state of the decoders for
+                maxlen steps (see FairseqIncrementalDecoder.allocate_incremental_state),
+                which avoids copying the cached keys and values of attention
+                layers at every step at the cost of more memory.
         """
         self.models = models
         self.pad = tgt_dict.pad()
@@ -46,6 +50,7 @@ class SequenceGenerator(object):
         self.sampling = sampling
         self.sampling_topk = sampling_topk
         self.sampling_temperature = sampling_temperature
+        self.kv_cache = kv_cache
 
     def cuda(self):
         for model in self.models:
@@ -103,22 +108,7 @@ class SequenceGenerator(object):
         beam_size = beam_size if beam_size is not None else self.beam_size
         beam_size = min(beam_size, self.vocab_size - 1)
 
-        encoder_outs = []
-        incremental_states = {}
-        for model in self.models:
-            if not self.retain_dropout:
-                model.eval()
-            if isinstance(model.decoder, FairseqIncrementalDecoder):
-                incremental_states[model] = {}
-            else:
-                incremental_states[model] = None
-
-            # compute the encoder output for each beam
-            encoder_out = model.encoder(
-                src_tokens.repeat(1, beam_size).view(-1, srclen),
-                src_lengths.expand(beam_size, src_lengths.numel()).t().contiguous().view(-1),
-            )
-            encoder_outs.append(encoder_out)
+        encoder_outs, incremental_states = self._encode(src_tokens, src_lengths, beam_size, maxlen)
 
         # initialize buffers
         scores = src_tokens.data.new(bsz * beam_size, maxlen + 1).float().fill_(0)
@@ -129,12 +119,17 @@ class SequenceGenerator(object):
         attn, attn_buf = None, None
         nonpad_idxs = None
 
-        # list of completed sentences
-        finalized = [[] for i in range(bsz)]
-        finished = [False for i in range(bsz)]
-        worst_finalized = [{'idx': None, 'score': -math.inf} for i in range(bsz)]
+        # finalized hypotheses are kept in beam_size slots per sentence, with
+        # the bookkeeping of each sentence held in tensors
+        num_finalized = tokens.new(bsz).fill_(0)
+        finished = tokens.new_zeros(bsz, dtype=torch.bool)
+        worst_finalized_idx = tokens.new(bsz).fill_(-1)  # -1 until known
+        finalized_bufs = {}
         num_remaining_sent = bsz
 
+        # the sentence of each row of the (shrinking) batch
+        sent_idxs = torch.arange(0, bsz).type_as(tokens)
+
         # number of candidate hypos per step
         cand_size = 2 * beam_size  # 2 x beam size in case half are EOS
 
@@ -150,25 +145,6 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
-        def is_finished(sent, step, unfinalized_scores=None):
-            """
-            Check whether we've finished generation for a given sentence, by
-            comparing the worst score among finalized hypotheses to the best
-            possible score among unfinalized hypotheses.
-            """
-            assert len(finalized[sent]) <= beam_size
-            if len(finalized[sent]) == beam_size:
-                if self.stop_early or step == maxlen or unfinalized_scores is None:
-                    return True
-                # stop if the best unfinalized score is worse than the worst
-                # finalized one
-                best_unfinalized_score = unfinalized_scores[sent].max()
-                if self.normalize_scores:
-                    best_unfinalized_score /= maxlen ** self.len_penalty
-                if worst_finalized[sent]['score'] >= best_unfinalized_score:
-                    return True
-            return False
-
         def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None):
             """
             Finalize the given hypotheses at this step, while keeping the total
@@ -184,6 +160,8 @@ class SequenceGenerator(object):
                     scores for each hypothesis
                 unfinalized_scores: A vector containing scores for all
                     unfinalized hypotheses
+            Returns:
+                the batch indices of the sentences that are now finished
             """
             assert bbsz_idx.numel() == eos_scores.numel()
 
@@ -203,61 +181,80 @@ class SequenceGenerator(object):
             if self.normalize_scores:
                 eos_scores /= (step + 1) ** self.len_penalty
 
-            cum_unfin = []
-            prev = 0
-            for f in finished:
-                if f:
-                    prev += 1
-                else:
-                    cum_unfin.append(prev)
-
-            sents_seen = set()
-            for i, (idx, score) in enumerate(zip(bbsz_idx.tolist(), eos_scores.tolist())):
-                unfin_idx = idx // beam_size
-                sent = unfin_idx + cum_unfin[unfin_idx]
-
-                sents_seen.add((sent, unfin_idx))
-
-                def get_hypo():
-
-                    if attn_clone is not None:
-                        # remove padding tokens from attn scores
-                        hypo_attn = attn_clone[i][nonpad_idxs[sent]]
-                        _, alignment = hypo_attn.max(dim=0)
-                    else:
-                        hypo_attn = None
-                        alignment = None
-
-                    return {
-                        'tokens': tokens_clone[i],
-                        'score': score,
-                        'attention': hypo_attn,  # src_len x tgt_len
-                        'alignment': alignment,
-                        'positional_scores': pos_scores[i],
-                    }
-
-                if len(finalized[sent]) < beam_size:
-                    finalized[sent].append(get_hypo())
-                elif not self.stop_early and score > worst_finalized[sent]['score']:
-                    # replace worst hypo for this sentence with new/better one
-                    worst_idx = worst_finalized[sent]['idx']
-                    if worst_idx is not None:
-                        finalized[sent][worst_idx] = get_hypo()
-
-                    # find new worst finalized hypo for this sentence
-                    idx, s = min(enumerate(finalized[sent]), key=lambda r: r[1]['score'])
-                    worst_finalized[sent] = {
-                        'score': s['score'],
-                        'idx': idx,
-                    }
-
-            newly_finished = []
-            for sent, unfin_idx in sents_seen:
-                # check termination conditions for this sentence
-                if not finished[sent] and is_finished(sent, step, unfinalized_scores):
-                    finished[sent] = True
-                    newly_finished.append(unfin_idx)
-            return newly_finished
+            if len(finalized_bufs) == 0:
+                num_sents = num_finalized.numel()
+                finalized_bufs['tokens'] = tokens.new(num_sents, beam_size, maxlen + 1)
+                finalized_bufs['positional_scores'] = scores.new(num_sents, beam_size, maxlen + 1)
+                finalized_bufs['length'] = tokens.new(num_sents, beam_size)
+                finalized_bufs['score'] = scores.new(num_sents, beam_size).fill_(-math.inf)
+                finalized_bufs['worst_score'] = scores.new(num_sents).fill_(-math.inf)
+                if attn is not None:
+                    finalized_bufs['attention'] = attn.new(num_sents, beam_size, attn.size(1), maxlen + 1)
+
+            def store_hypos(idx, sents, slots):
+                finalized_bufs['tokens'][sents, slots, :step + 1] = tokens_clone[idx]
+                finalized_bufs['positional_scores'][sents, slots, :step + 1] = pos_scores[idx]
+                finalized_bufs['length'][sents, slots] = step + 1
+                finalized_bufs['score'][sents, slots] = eos_scores[idx]
+                if attn_clone is not None:
+                    finalized_bufs['attention'][sents, slots, :, :step + 1] = attn_clone[idx]
+
+            unfin_idx = bbsz_idx // beam_size
+            sents = sent_idxs[unfin_idx]
+
+            # rank of each hypothesis among the hypotheses of its sentence
+            num_hypos = bbsz_idx.numel()
+            hypo_range = torch.arange(0, num_hypos).type_as(sents)
+            _, order = (sents * num_hypos + hypo_range).sort()
+            counts = sents.new(num_finalized.numel()).fill_(0).index_add_(0, sents, torch.ones_like(sents))
+            ranks = torch.empty_like(sents)
+            ranks[order] = hypo_range - (counts.cumsum(0) - counts)[sents[order]]
+
+            # fill the free slots of each sentence
+            slots = num_finalized[sents] + ranks
+            free = slots < beam_size
+            store_hypos(free.nonzero().squeeze(-1), sents[free], slots[free])
+            num_finalized.index_add_(0, sents, free.type_as(num_finalized))
+
+            if not self.stop_early:
+                # replace the worst hypothesis of full sentences with a better
+                # one, one hypothesis per sentence at a time. The worst
+                # hypothesis of a sentence is only looked up once a hypothesis
+                # does not fit in it anymore.
+                worst_score = finalized_bufs['worst_score']
+                first = torch.arange(beam_size, 0, -1).type_as(sents)
+                overflow = (~free).nonzero().squeeze(-1)
+                for rank in ranks[overflow].unique().tolist():
+                    idx = overflow[ranks[overflow] == rank]
+                    idx_sents = sents[idx]
+                    better = eos_scores[idx] > worst_score[idx_sents]
+                    replace = better & worst_finalized_idx[idx_sents].ge(0)
+                    store_hypos(idx[replace], idx_sents[replace], worst_finalized_idx[idx_sents[replace]])
+
+                    # find the new worst finalized hypothesis (the first one
+                    # in case of ties)
+                    better_sents = idx_sents[better]
+                    sent_scores = finalized_bufs['score'][better_sents]
+                    is_worst = sent_scores.eq(sent_scores.min(dim=1, keepdim=True)[0])
+                    worst_finalized_idx[better_sents] = (is_worst.type_as(sents) * first).max(dim=1)[1]
+                    worst_score[better_sents] = sent_scores.gather(
+                        1, worst_finalized_idx[better_sents].unsqueeze(1),
+                    ).squeeze(1)
+
+            # check termination conditions for the sentences seen at this step:
+            # a sentence is finished once it has beam_size finalized hypotheses
+            # (and, without early stopping, the best unfinalized hypothesis
+            # cannot beat the worst finalized one)
+            unfin_seen = unfin_idx.unique()
+            seen = sent_idxs[unfin_seen]
+            newly_finished = ~finished[seen] & num_finalized[seen].eq(beam_size)
+            if not (self.stop_early or step == maxlen or unfinalized_scores is None):
+                best_unfinalized_score = unfinalized_scores[unfin_seen].max(dim=1)[0]
+                if self.normalize_scores:
+                    best_unfinalized_score /= maxlen ** self.len_penalty
+                newly_finished &= finalized_bufs['worst_score'][seen] >= best_unfinalized_score
+            finished[seen[newly_finished]] = True
+            return unfin_seen[newly_finished]
 
         reorder_state = None
         batch_idxs = None
@@ -268,10 +265,13 @@ class SequenceGenerator(object):
                     # update beam indices to take into account removed sentences
                     corr = batch_idxs - torch.arange(batch_idxs.numel()).type_as(batch_idxs)
                     reorder_state.view(-1, beam_size).add_(corr.unsqueeze(-1) * beam_size)
-                for i, model in enumerate(self.models):
+                    # the hypotheses of a sentence share the same encoder
+                    # output, which only changes when sentences are removed
+                    for i, model in enumerate(self.models):
+                        encoder_outs[i] = model.encoder.reorder_encoder_out(encoder_outs[i], reorder_state)
+                for model in self.models:
                     if isinstance(model.decoder, FairseqIncrementalDecoder):
                         model.decoder.reorder_incremental_state(incremental_states[model], reorder_state)
-                    encoder_outs[i] = model.encoder.reorder_encoder_out(encoder_outs[i], reorder_state)
 
             probs, avg_attn_scores = self._decode(tokens[:, :step + 1], encoder_outs, incremental_states)
             if step == 0:
@@ -356,7 +356,7 @@ class SequenceGenerator(object):
                         k=min(cand_size, probs.view(bsz, -1).size(1) - 1),  # -1 so we never select pad
                         out=(cand_scores, cand_indices),
                     )
-                    torch.div(cand_indices, self.vocab_size, out=cand_beams)
+                    torch.floor_divide(cand_indices, self.vocab_size, out=cand_beams)
                     cand_indices.fmod_(self.vocab_size)
             else:
                 # finalize all active hypotheses once we hit maxlen
@@ -379,7 +379,7 @@ class SequenceGenerator(object):
             # finalize hypotheses that end in eos
             eos_mask = cand_indices.eq(self.eos)
 
-            finalized_sents = set()
+            finalized_sents = sent_idxs.new(0)
             if step >= self.minlen:
                 # only consider eos when it's among the top beam_size indices
                 torch.masked_select(
@@ -407,8 +407,9 @@ class SequenceGenerator(object):
 
                 # construct batch_idxs which holds indices of batches to keep for the next pass
                 batch_mask = torch.ones(bsz).type_as(cand_indices)
-                batch_mask[cand_indices.new(finalized_sents)] = 0
+                batch_mask[finalized_sents] = 0
                 batch_idxs = batch_mask.nonzero().squeeze(-1)
+                sent_idxs = sent_idxs[batch_idxs]
 
                 eos_mask = eos_mask[batch_idxs]
                 cand_beams = cand_beams[batch_idxs]
@@ -496,10 +497,69 @@ class SequenceGenerator(object):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
-        # sort by score descending
-        for sent in range(len(finalized)):
-            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
+        return self._collect_finalized(finalized_bufs, num_finalized, nonpad_idxs)
+
+    def _encode(self, src_tokens, src_lengths, beam_size, maxlen):
+        """Run the encoder of each model once per sentence and expand its
+        output to *beam_size* hypotheses. Returns the encoder outputs and the
+        initial incremental states of the models."""
+        # the sentence of each hypothesis
+        bsz = src_tokens.size(0)
+        expand_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1).type_as(src_tokens.data)
 
+        encoder_outs = []
+        incremental_states = {}
+        for model in self.models:
+            if not self.retain_dropout:
+                model.eval()
+            if isinstance(model.decoder, FairseqIncrementalDecoder):
+                incremental_states[model] = {}
+                if self.kv_cache:
+                    # one extra step for EOS marker
+                    model.decoder.allocate_incremental_state(incremental_states[model], maxlen + 1)
+            else:
+                incremental_states[model] = None
+
+            # compute the encoder output once per sentence and expand it
+            # along the beam dimension
+            encoder_out = model.encoder(src_tokens, src_lengths)
+            encoder_outs.append(model.encoder.expand_encoder_out(encoder_out, expand_order))
+        return encoder_outs, incremental_states
+
+    def _collect_finalized(self, finalized_bufs, num_finalized, nonpad_idxs):
+        """Convert the finalized hypotheses of each sentence to a list of
+        dicts, sorted by score descending."""
+        _, beam_size, max_length = finalized_bufs['tokens'].size()
+        lengths = finalized_bufs['length'].tolist()
+        sent_scores = finalized_bufs['score'].tolist()
+        # views of the finalized hypotheses, one per slot
+        tokens = finalized_bufs['tokens'].view(-1, max_length).unbind(0)
+        pos_scores = finalized_bufs['positional_scores'].view(-1, max_length).unbind(0)
+        attn = finalized_bufs.get('attention')
+        if attn is not None:
+            # align each target token to its most attended source token,
+            # counting only non-padding source positions
+            pad_mask = ~nonpad_idxs
+            _, alignment = attn.masked_fill(pad_mask.unsqueeze(1).unsqueeze(-1), -math.inf).max(dim=2)
+            num_pads_before = pad_mask.long().cumsum(dim=1).gather(1, alignment.view(alignment.size(0), -1))
+            alignment = (alignment - num_pads_before.view_as(alignment)).view(-1, max_length).unbind(0)
+
+        finalized = []
+        for sent, num_hypos in enumerate(num_finalized.tolist()):
+            if attn is not None:
+                # remove padding tokens from attn scores
+                sent_attn = attn[sent, :num_hypos][:, nonpad_idxs[sent]]
+            hypos = []
+            for slot in range(num_hypos):
+                i, length = sent * beam_size + slot, lengths[sent][slot]
+                hypos.append({
+                    'tokens': tokens[i][:length],
+                    'score': sent_scores[sent][slot],
+                    'attention': sent_attn[slot, :, :length] if attn is not None else None,  # src_len x tgt_len
+                    'alignment': alignment[i][:length] if attn is not None else None,
+                    'positional_scores': pos_scores[i][:length],
+                })
+            finalized.append(sorted(hypos, key=lambda r: r['score'], reverse=True))
         return finalized
 
     def _decode(self, tokens, encoder_outs, incremental_states):
@@ -537,3 +597,124 @@ class SequenceGenerator(object):
                 attn = attn[:, -1, :]
         probs = model.get_normalized_probs(decoder_out, log_probs=log_probs)
         return probs, attn
+
+
+class GreedySequenceGenerator(SequenceGenerator):
+    """Generates translations by greedy decoding, i.e., beam search with a
+    beam size of 1 and early stopping, without the beam search machinery.
+
+    At every step the most likely token of each sentence is written in place
+    into the token buffer. Finished sentences are removed from the batch by
+    moving the remaining ones to the front of the buffers, which only copies
+    the steps decoded so far.
+
+    Takes the same arguments as :class:`SequenceGenerator`, except that
+    *beam_size* must be 1, *stop_early* must be set and *sampling* is not
+    supported.
+    """
+
+    def __init__(self, models, tgt_dict, **kwargs):
+        super().__init__(models, tgt_dict, **kwargs)
+        assert self.beam_size == 1, 'greedy decoding requires beam_size=1'
+        assert self.stop_early, 'greedy decoding requires stop_early'
+        assert not self.sampling, 'greedy decoding does not support sampling'
+
+    def _generate(self, src_tokens, src_lengths, beam_size=None, maxlen=None, prefix_tokens=None):
+        assert beam_size is None or beam_size == 1, 'greedy decoding requires beam_size=1'
+        bsz = src_tokens.size(0)
+        maxlen = min(maxlen, self.maxlen) if maxlen is not None else self.maxlen
+
+        encoder_outs, incremental_states = self._encode(src_tokens, src_lengths, 1, maxlen)
+
+        # tokens and cumulative scores of the sentences that are not finished
+        tokens = src_tokens.data.new(bsz, maxlen + 2).fill_(self.pad)
+        tokens[:, 0] = self.eos
+        scores = None
+        attn = None
+        # the sentence of each row of the (shrinking) batch
+        sent_idxs = torch.arange(0, bsz).type_as(tokens)
+
+        # finished sentences, in the format of SequenceGenerator._collect_finalized
+        finalized_bufs = {
+            'tokens': tokens.new(bsz, 1, maxlen + 1),
+            'length': tokens.new(bsz, 1),
+        }
+
+        for step in range(maxlen + 1):  # one extra step for EOS marker
+            lprobs, avg_attn_scores = self._decode(tokens[:, :step + 1], encoder_outs, incremental_states)
+            if scores is None:
+                scores = lprobs.new(bsz, maxlen + 1)
+                finalized_bufs['positional_scores'] = scores.new(bsz, 1, maxlen + 1)
+                finalized_bufs['score'] = scores.new(bsz, 1)
+            if avg_attn_scores is not None and attn is None:
+                attn = avg_attn_scores.new(bsz, src_tokens.size(1), maxlen + 1)
+                finalized_bufs['attention'] = attn.new(bsz, 1, src_tokens.size(1), maxlen + 1)
+
+            lprobs[:, self.pad] = -math.inf  # never select pad
+            lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+
+            if step == maxlen:
+                # finish all sentences once we hit maxlen
+                next_tokens = tokens.new(tokens.size(0)).fill_(self.eos)
+                next_scores = lprobs[:, self.eos]
+            elif prefix_tokens is not None and step < prefix_tokens.size(1):
+                next_tokens = prefix_tokens[:, step]
+                next_scores = lprobs.gather(1, next_tokens.unsqueeze(1)).squeeze(1)
+            else:
+                if step < self.minlen:
+                    lprobs[:, self.eos] = -math.inf
+                next_scores, next_tokens = lprobs.max(dim=1)
+            tokens[:, step + 1] = next_tokens
+            scores[:, step] = next_scores
+            if step > 0:
+                scores[:, step] += scores[:, step - 1]
+            if attn is not None:
+                attn[:, :, step] = avg_attn_scores
+
+            eos_mask = next_tokens.eq(self.eos)
+            if (step >= self.minlen or step == maxlen) and eos_mask.any():
+                done = eos_mask.nonzero().squeeze(-1)
+                self._finalize(
+                    finalized_bufs, step, sent_idxs[done], tokens[done, :step + 2], scores[done, :step + 1],
+                    attn[done, :, :step + 1] if attn is not None else None,
+                )
+                if done.numel() == tokens.size(0):
+                    break
+
+                # move the remaining sentences to the front of the buffers
+                keep = (~eos_mask).nonzero().squeeze(-1)
+                new_bsz = keep.numel()
+                tokens[:new_bsz, :step + 2] = tokens[keep, :step + 2]
+                tokens = tokens[:new_bsz]
+                scores[:new_bsz, :step + 1] = scores[keep, :step + 1]
+                scores = scores[:new_bsz]
+                if attn is not None:
+                    attn[:new_bsz, :, :step + 1] = attn[keep, :, :step + 1]
+                    attn = attn[:new_bsz]
+                sent_idxs = sent_idxs[keep]
+                if prefix_tokens is not None:
+                    prefix_tokens = prefix_tokens[keep]
+                for i, model in enumerate(self.models):
+                    encoder_outs[i] = model.encoder.reorder_encoder_out(encoder_outs[i], keep)
+                    if isinstance(model.decoder, FairseqIncrementalDecoder):
+                        model.decoder.reorder_incremental_state(incremental_states[model], keep)
+
+        num_finalized = tokens.new(bsz).fill_(1)
+        return self._collect_finalized(finalized_bufs, num_finalized, src_tokens.ne(self.pad))
+
+    def _finalize(self, finalized_bufs, step, sents, tokens, scores, attn):
+        """Store the hypotheses of the sentences *sents*, which end at this
+        step."""
+        length = step + 1
+        finalized_bufs['tokens'][sents, 0, :length] = tokens[:, 1:length + 1]
+        finalized_bufs['length'][sents, 0] = length
+        # convert from cumulative to per-position scores
+        pos_scores = scores[:, :length].clone()
+        pos_scores[:, 1:] = pos_scores[:, 1:] - pos_scores[:, :-1]
+        finalized_bufs['positional_scores'][sents, 0, :length] = pos_scores
+        sent_scores = scores[:, step]
+        if self.normalize_scores:
+            sent_scores = sent_scores / length ** self.len_penalty
+        finalized_bufs['score'][sents, 0] = sent_scores
+        if attn is not None:
+            finalized_bufs['attention'][sents, 0, :, :length] = attn[:, :, :length]
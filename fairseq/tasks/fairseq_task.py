@@ -20,6 +20,7 @@ class FairseqTask(object):
     def __init__(self, args):
         self.args = args
         self.datasets = {}
+        self.dataset_files = {}
 
     @classmethod
     def setup_task(cls, args, **kwargs):
@@ -28,6 +29,18 @@ class FairseqTask(object):
     def load_dataset(self, split, combine=False):
         raise NotImplementedError
 
+    def shard_sample_ratios(self, num_shards):
+        """Return the sampling ratio of each of the *num_shards* shards of a
+        combined dataset split (``--shard-sample-ratios``), or None if every
+        shard is used once."""
+        from fairseq import options
+        ratios = options.eval_str_list(getattr(self.args, 'shard_sample_ratios', None), type=float)
+        if ratios is not None and len(ratios) != num_shards:
+            raise ValueError('--shard-sample-ratios has {} ratios, but the data has {} shards'.format(
+                len(ratios), num_shards,
+            ))
+        return ratios
+
     def dataset(self, split):
         """Return a dataset split."""
         from fairseq.data import FairseqDataset
@@ -37,6 +50,12 @@ class FairseqTask(object):
             raise TypeError('Datasets are expected to be of type FairseqDataset')
         return self.datasets[split]
 
+    def dataset_fingerprint(self, split):
+        """Return a string identifying the files and settings a dataset split
+        was loaded with, used to cache its batches on disk. Returns None if
+        the split can't be identified, which disables caching."""
+        return None
+
     def build_model(self, args):
         from fairseq import models
         return models.build_model(args, self)
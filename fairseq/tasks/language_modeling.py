@@ -6,13 +6,11 @@
 # can be found in the PATENTS file in the same directory.
 
 import itertools
-import numpy as np
 import os
-
-from torch.utils.data import ConcatDataset
+import torch
 
 from fairseq.data import (
-    Dictionary, IndexedInMemoryDataset, IndexedRawTextDataset,
+    ConcatDataset, data_utils, Dictionary, IndexedInMemoryDataset, IndexedMMapDataset, IndexedRawTextDataset,
     MonolingualDataset, TokenBlockDataset,
 )
 
@@ -36,6 +34,13 @@ class LanguageModelingTask(FairseqTask):
                             help='max number of tokens per sample for LM dataset')
         parser.add_argument('--raw-text', default=False, action='store_true',
                             help='load raw text dataset')
+        parser.add_argument('--mmap-dataset', default=False, action='store_true',
+                            help='memory-map the binary dataset and read blocks from it as they are '
+                                 'sampled, instead of reading it into memory')
+        parser.add_argument('--shared-memory-dataset', default=False, action='store_true',
+                            help='copy the binary dataset to shared memory (/dev/shm) and memory-map '
+                                 'it from there, so that all processes of a node share one copy '
+                                 '(implies --mmap-dataset; the copy is removed when the last process exits)')
         parser.add_argument('--shuffle', default=False, action='store_true',
                             help='shuffle')
 
@@ -53,6 +58,9 @@ class LanguageModelingTask(FairseqTask):
         """Load a dataset split."""
 
         loaded_datasets = []
+        self.dataset_files[split] = []
+        mmap = getattr(self.args, 'mmap_dataset', False)
+        shared_memory = getattr(self.args, 'shared_memory_dataset', False)
 
         for k in itertools.count():
             split_k = split + (str(k) if k > 0 else '')
@@ -60,7 +68,12 @@ class LanguageModelingTask(FairseqTask):
 
             if self.args.raw_text and IndexedRawTextDataset.exists(path):
                 ds = IndexedRawTextDataset(path, self.dictionary)
-                tokens = [t for l in ds.tokens_list for t in l]
+                tokens = torch.cat(ds.tokens_list).numpy()
+            elif (
+                not self.args.raw_text and (mmap or shared_memory) and IndexedMMapDataset.exists(path)
+            ):
+                ds = IndexedMMapDataset(path, fix_lua_indexing=True, shared_memory=shared_memory)
+                tokens = ds.buffer
             elif not self.args.raw_text and IndexedInMemoryDataset.exists(path):
                 ds = IndexedInMemoryDataset(path, fix_lua_indexing=True)
                 tokens = ds.buffer
@@ -70,10 +83,19 @@ class LanguageModelingTask(FairseqTask):
                 else:
                     raise FileNotFoundError('Dataset not found: {} ({})'.format(split, self.args.data))
 
+            files = data_utils.dataset_files(path, self.args.raw_text)
+            self.dataset_files[split].extend(files)
+            if getattr(self.args, 'cache_batches', False):
+                # cache the block boundaries next to the batches
+                cache_path = os.path.join(self.args.data, 'blocks.{}.npy'.format(data_utils.fingerprint(
+                    files, self.args.tokens_per_sample, self.args.sample_break_mode,
+                )))
+            else:
+                cache_path = None
             loaded_datasets.append(
                 TokenBlockDataset(
                     tokens, ds.sizes, self.args.tokens_per_sample, self.args.sample_break_mode,
-                    include_targets=True
+                    include_targets=True, cache_path=cache_path,
                 ))
 
             print('| {} {} {} examples'.format(self.args.data, split_k, len(loaded_datasets[-1])))
@@ -81,14 +103,23 @@ class LanguageModelingTask(FairseqTask):
             if not combine:
                 break
 
-        if len(loaded_datasets) == 1:
+        sample_ratios = self.shard_sample_ratios(len(loaded_datasets)) if combine else None
+        if len(loaded_datasets) == 1 and sample_ratios is None:
             dataset = loaded_datasets[0]
-            sizes = dataset.sizes
         else:
-            dataset = ConcatDataset(loaded_datasets)
-            sizes = np.concatenate([ds.sizes for ds in loaded_datasets])
-
-        self.datasets[split] = MonolingualDataset(dataset, sizes, self.dictionary, shuffle=self.args.shuffle)
+            dataset = ConcatDataset(loaded_datasets, sample_ratios or 1, seed=self.args.seed)
+
+        self.datasets[split] = MonolingualDataset(
+            dataset, dataset.sizes, self.dictionary, shuffle=self.args.shuffle,
+        )
+
+    def dataset_fingerprint(self, split):
+        if split not in self.dataset_files:
+            return None
+        return data_utils.fingerprint(
+            self.dataset_files[split], self.args.tokens_per_sample, self.args.sample_break_mode,
+            self.args.shuffle, getattr(self.args, 'shard_sample_ratios', None),
+        )
 
     @property
     def target_dictionary(self):
@@ -6,15 +6,12 @@
 # can be found in the PATENTS file in the same directory.
 
 import itertools
-import numpy as np
 import os
 
-from torch.utils.data import ConcatDataset
-
 from fairseq import options
 from fairseq.data import (
-    data_utils, Dictionary, LanguagePairDataset, IndexedInMemoryDataset,
-    IndexedRawTextDataset,
+    ConcatDataset, data_utils, Dictionary, LanguagePairDataset, IndexedInMemoryDataset,
+    IndexedLazyRawTextDataset, IndexedMMapDataset, IndexedRawTextDataset,
 )
 
 from . import FairseqTask, register_task
@@ -33,10 +30,22 @@ class TranslationTask(FairseqTask):
                             help='target language')
         parser.add_argument('--raw-text', action='store_true',
                             help='load raw text dataset')
+        parser.add_argument('--raw-text-cache-size', default=0, type=int, metavar='N',
+                            help='keep the last N tokenized lines of each raw text dataset in memory')
+        parser.add_argument('--mmap-dataset', action='store_true',
+                            help='memory-map the binary dataset instead of reading it into memory')
+        parser.add_argument('--shared-memory-dataset', action='store_true',
+                            help='copy the binary dataset to shared memory (/dev/shm) and memory-map '
+                                 'it from there, so that all processes of a node share one copy '
+                                 '(implies --mmap-dataset; the copy is removed when the last process exits)')
         parser.add_argument('--left-pad-source', default='True', type=str, metavar='BOOL',
                             help='pad the source on the left (default: True)')
         parser.add_argument('--left-pad-target', default='False', type=str, metavar='BOOL',
                             help='pad the target on the left (default: False)')
+        parser.add_argument('--pack-length', type=int, metavar='N',
+                            help='pack several sentence pairs into each row of a batch, with up to N '
+                                 'source and N target tokens per row, instead of padding every pair '
+                                 'to the longest one (training of transformer models only)')
         parser.add_argument('--max-source-positions', default=1024, type=int, metavar='N',
                             help='max number of tokens in the source sequence')
         parser.add_argument('--max-target-positions', default=1024, type=int, metavar='N',
@@ -80,15 +89,23 @@ class TranslationTask(FairseqTask):
                 return True
             return False
 
+        mmap = getattr(self.args, 'mmap_dataset', False)
+        shared_memory = getattr(self.args, 'shared_memory_dataset', False)
+
         def indexed_dataset(path, dictionary):
             if self.args.raw_text:
-                return IndexedRawTextDataset(path, dictionary)
+                return IndexedLazyRawTextDataset(
+                    path, dictionary, cache_size=getattr(self.args, 'raw_text_cache_size', 0),
+                )
+            elif (mmap or shared_memory) and IndexedMMapDataset.exists(path):
+                return IndexedMMapDataset(path, fix_lua_indexing=True, shared_memory=shared_memory)
             elif IndexedInMemoryDataset.exists(path):
                 return IndexedInMemoryDataset(path, fix_lua_indexing=True)
             return None
 
         src_datasets = []
         tgt_datasets = []
+        self.dataset_files[split] = []
 
         for k in itertools.count():
             split_k = split + (str(k) if k > 0 else '')
@@ -107,6 +124,8 @@ class TranslationTask(FairseqTask):
 
             src_datasets.append(indexed_dataset(prefix + src, self.src_dict))
             tgt_datasets.append(indexed_dataset(prefix + tgt, self.tgt_dict))
+            self.dataset_files[split].extend(data_utils.dataset_files(prefix + src, self.args.raw_text))
+            self.dataset_files[split].extend(data_utils.dataset_files(prefix + tgt, self.args.raw_text))
 
             print('| {} {} {} examples'.format(self.args.data, split_k, len(src_datasets[-1])))
 
@@ -115,16 +134,14 @@ class TranslationTask(FairseqTask):
 
         assert len(src_datasets) == len(tgt_datasets)
 
-        if len(src_datasets) == 1:
+        sample_ratios = self.shard_sample_ratios(len(src_datasets)) if combine else None
+        if len(src_datasets) == 1 and sample_ratios is None:
             src_dataset, tgt_dataset = src_datasets[0], tgt_datasets[0]
-            src_sizes = src_dataset.sizes
-            tgt_sizes = tgt_dataset.sizes
         else:
-            src_dataset = ConcatDataset(src_datasets)
-            tgt_dataset = ConcatDataset(tgt_datasets)
-            src_sizes = np.concatenate([ds.sizes for ds in src_datasets])
-            tgt_sizes = np.concatenate([ds.sizes for ds in tgt_datasets])
-
+            src_dataset = ConcatDataset(src_datasets, sample_ratios or 1, seed=self.args.seed)
+            tgt_dataset = ConcatDataset(tgt_datasets, sample_ratios or 1, seed=self.args.seed)
+        src_sizes = src_dataset.sizes
+        tgt_sizes = tgt_dataset.sizes
 
         self.datasets[split] = LanguagePairDataset(
             src_dataset, src_sizes, self.src_dict,
@@ -133,6 +150,24 @@ class TranslationTask(FairseqTask):
             left_pad_target=self.args.left_pad_target,
             max_source_positions=self.args.max_source_positions,
             max_target_positions=self.args.max_target_positions,
+            pack_length=getattr(self.args, 'pack_length', None),
+        )
+
+    def build_model(self, args):
+        from fairseq import models
+        model_cls = models.ARCH_MODEL_REGISTRY[args.arch]
+        if getattr(args, 'pack_length', None) is not None and not model_cls.supports_packed_batches:
+            raise ValueError('--pack-length is not supported by --arch {} ({}), only by transformer models'.format(
+                args.arch, model_cls.__name__,
+            ))
+        return super().build_model(args)
+
+    def dataset_fingerprint(self, split):
+        if split not in self.dataset_files:
+            return None
+        return data_utils.fingerprint(
+            self.dataset_files[split], self.args.max_source_positions, self.args.max_target_positions,
+            getattr(self.args, 'shard_sample_ratios', None),
         )
 
     @property
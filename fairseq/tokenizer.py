@@ -6,6 +6,8 @@
 # can be found in the PATENTS file in the same directory.
 
 from collections import Counter
+from multiprocessing import Pool
+import os
 import re
 
 import torch
@@ -20,19 +22,79 @@ def tokenize_line(line):
     return line.split()
 
 
+def safe_readline(f):
+    pos = f.tell()
+    while True:
+        try:
+            return f.readline()
+        except UnicodeDecodeError:
+            pos -= 1
+            f.seek(pos)  # search where this character begins
+
+
 class Tokenizer:
 
     @staticmethod
-    def add_file_to_dictionary(filename, dict, tokenize):
+    def add_file_to_dictionary_single_worker(filename, dict, tokenize, offset=0, end=-1):
+        """Count the words of the lines of *filename* which start in the byte
+        range ``[offset, end)`` into *dict* and return it."""
         with open(filename, 'r') as f:
-            for line in f:
+            f.seek(offset)
+            # next(f) breaks f.tell(), hence readline() must be used
+            line = safe_readline(f)
+            while line:
+                if end > 0 and f.tell() > end:
+                    break
                 for word in tokenize(line):
                     dict.add_symbol(word)
                 dict.add_symbol(dict.eos_word)
+                line = f.readline()
+        return dict
+
+    @staticmethod
+    def add_file_to_dictionary(filename, dict, tokenize, num_workers=1):
+        if num_workers == 1:
+            Tokenizer.add_file_to_dictionary_single_worker(filename, dict, tokenize)
+            return
+
+        # count chunks of the file into empty dictionaries and merge them in
+        # file order, which gives the same symbol order (and therefore the
+        # same tie-breaking in Dictionary.finalize) as a single worker
+        offsets = Tokenizer.find_offsets(filename, num_workers)
+        pool = Pool(processes=num_workers)
+        results = []
+        for worker_id in range(num_workers):
+            empty_dict = dict.__class__(pad=dict.pad_word, eos=dict.eos_word, unk=dict.unk_word)
+            results.append(pool.apply_async(
+                Tokenizer.add_file_to_dictionary_single_worker,
+                (filename, empty_dict, tokenize, offsets[worker_id], offsets[worker_id + 1]),
+            ))
+        pool.close()
+        pool.join()
+        for result in results:
+            dict.update(result.get())
+
+    @staticmethod
+    def find_offsets(filename, num_chunks):
+        """Split a file into *num_chunks* byte ranges that start at line
+        boundaries. Returns a list of ``num_chunks + 1`` offsets, chunk ``i``
+        covers ``[offsets[i], offsets[i + 1])``."""
+        with open(filename, 'r') as f:
+            size = os.fstat(f.fileno()).st_size
+            chunk_size = size // num_chunks
+            offsets = [0 for _ in range(num_chunks + 1)]
+            for i in range(1, num_chunks):
+                f.seek(chunk_size * i)
+                safe_readline(f)
+                offsets[i] = f.tell()
+            offsets[num_chunks] = size
+            return offsets
 
     @staticmethod
     def binarize(filename, dict, consumer, tokenize=tokenize_line,
-                 append_eos=True, reverse_order=False):
+                 append_eos=True, reverse_order=False, offset=0, end=-1):
+        """Binarize the lines of *filename* which start in the byte range
+        ``[offset, end)`` (the whole file by default)."""
         nseq, ntok = 0, 0
         replaced = Counter()
 
@@ -41,7 +103,12 @@ class Tokenizer:
                 replaced.update([word])
 
         with open(filename, 'r') as f:
-            for line in f:
+            f.seek(offset)
+            # next(f) breaks f.tell(), hence readline() must be used
+            line = safe_readline(f)
+            while line:
+                if end > 0 and f.tell() > end:
+                    break
                 ids = Tokenizer.tokenize(
                     line=line,
                     dict=dict,
@@ -55,7 +122,8 @@ class Tokenizer:
 
                 consumer(ids)
                 ntok += len(ids)
-        return {'nseq': nseq, 'nunk': sum(replaced.values()), 'ntok': ntok, 'replaced': len(replaced)}
+                line = f.readline()
+        return {'nseq': nseq, 'nunk': sum(replaced.values()), 'ntok': ntok, 'replaced': replaced}
 
     @staticmethod
     def tokenize(line, dict, tokenize=tokenize_line, add_if_not_exist=True,
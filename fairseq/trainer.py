@@ -189,7 +189,7 @@ class Trainer(object):
         sample_size = 0
         logging_output = {
             'ntokens': sample['ntokens'] if sample is not None else 0,
-            'nsentences': sample['target'].size(0) if sample is not None else 0,
+            'nsentences': sample['nsentences'] if sample is not None else 0,
         }
         oom = 0
         try:
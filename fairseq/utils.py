@@ -319,6 +319,36 @@ def make_positions(tensor, padding_idx, left_pad):
     return tensor.clone().masked_scatter_(mask, positions[mask])
 
 
+def make_segment_positions(segments, padding_idx):
+    """Number the tokens of each segment of a packed batch from
+    padding_idx+1, i.e., restart the positions at every segment.
+
+    *segments* holds the segment number of every token, which increases along
+    each row and is 0 for padding (see
+    :func:`fairseq.data.data_utils.pack_sequences`). Padding positions are set
+    to padding_idx.
+    """
+    bsz, seq_len = segments.size()
+    # tokens of each segment, and the number of tokens before each segment
+    counts = segments.new_zeros(bsz, int(segments.max()) + 1).scatter_add_(1, segments, torch.ones_like(segments))
+    counts[:, 0] = 0
+    starts = counts.cumsum(dim=1) - counts
+    positions = buffered_arange(seq_len).type_as(segments).unsqueeze(0) - starts.gather(1, segments)
+    return (positions + padding_idx + 1).masked_fill_(segments.eq(0), padding_idx)
+
+
+def make_segment_mask(query_segments, key_segments):
+    """Block-diagonal attention mask for packed batches, of shape
+    bsz x query_len x key_len, in which 1s mark the keys of other segments.
+
+    Padding queries (segment 0) are not masked, so that their attention
+    weights stay finite; their outputs are never attended to by the tokens of
+    a segment, since padding keys are masked for every other query.
+    """
+    query_segments = query_segments.unsqueeze(2)
+    return query_segments.ne(key_segments.unsqueeze(1)) & query_segments.ne(0)
+
+
 def strip_pad(tensor, pad):
     return tensor[tensor.ne(pad)]
 
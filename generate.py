@@ -10,7 +10,7 @@ import torch
 
 from fairseq import bleu, data, options, progress_bar, tasks, tokenizer, utils
 from fairseq.meters import StopwatchMeter, TimeMeter
-from fairseq.sequence_generator import SequenceGenerator
+from fairseq.sequence_generator import GreedySequenceGenerator, SequenceGenerator
 from fairseq.sequence_scorer import SequenceScorer
 
 
@@ -20,6 +20,8 @@ def main(args):
         '--sampling requires --nbest to be equal to --beam'
     assert args.replace_unk is None or args.raw_text, \
         '--replace-unk requires a raw text dataset (--raw-text)'
+    assert getattr(args, 'pack_length', None) is None, \
+        '--pack-length is only supported for training'
 
     if args.max_tokens is None and args.max_sentences is None:
         args.max_tokens = 12000
@@ -38,7 +40,7 @@ def main(args):
 
     # Load ensemble
     print('| loading model(s) from {}'.format(args.path))
-    models, _ = utils.load_ensemble_for_inference(args.path.split(':'), task, model_arg_overrides=eval(args.model_overrides))
+    models, model_args = utils.load_ensemble_for_inference(args.path.split(':'), task, model_arg_overrides=eval(args.model_overrides))
 
     # Optimize ensemble for generation
     for model in models:
@@ -63,6 +65,11 @@ def main(args):
         required_batch_size_multiple=8,
         num_shards=args.num_shards,
         shard_id=args.shard_id,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        cache_dir=args.data if args.cache_batches else None,
+        batch_cost=data.batch_cost_from_args(args, model_args),
+        fingerprint=task.dataset_fingerprint(args.gen_subset),
     ).next_epoch_itr(shuffle=False)
 
     # Initialize generator
@@ -70,11 +77,17 @@ def main(args):
     if args.score_reference:
         translator = SequenceScorer(models, task.target_dictionary)
     else:
-        translator = SequenceGenerator(
+        # greedy decoding does not need the beam search machinery
+        if args.beam == 1 and not args.sampling and not args.no_early_stop:
+            generator_cls = GreedySequenceGenerator
+        else:
+            generator_cls = SequenceGenerator
+        translator = generator_cls(
             models, task.target_dictionary, beam_size=args.beam,
             stop_early=(not args.no_early_stop), normalize_scores=(not args.unnormalized),
             len_penalty=args.lenpen, unk_penalty=args.unkpen,
             sampling=args.sampling, sampling_topk=args.sampling_topk, minlen=args.min_len,
+            kv_cache=args.kv_cache,
         )
 
     if use_cuda:
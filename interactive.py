@@ -13,7 +13,7 @@ import sys
 import torch
 
 from fairseq import data, options, tasks, tokenizer, utils
-from fairseq.sequence_generator import SequenceGenerator
+from fairseq.sequence_generator import GreedySequenceGenerator, SequenceGenerator
 
 
 Batch = namedtuple('Batch', 'srcs tokens lengths')
@@ -89,11 +89,17 @@ def main(args):
             model.half()
 
     # Initialize generator
-    translator = SequenceGenerator(
+    # greedy decoding does not need the beam search machinery
+    if args.beam == 1 and not args.sampling and not args.no_early_stop:
+        generator_cls = GreedySequenceGenerator
+    else:
+        generator_cls = SequenceGenerator
+    translator = generator_cls(
         models, tgt_dict, beam_size=args.beam, stop_early=(not args.no_early_stop),
         normalize_scores=(not args.unnormalized), len_penalty=args.lenpen,
         unk_penalty=args.unkpen, sampling=args.sampling, sampling_topk=args.sampling_topk,
-        minlen=args.min_len, sampling_temperature=args.sampling_temperature
+        minlen=args.min_len, sampling_temperature=args.sampling_temperature,
+        kv_cache=args.kv_cache,
     )
 
     if use_cuda:
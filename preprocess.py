@@ -8,10 +8,14 @@
 #
 
 import argparse
+from collections import Counter
 from itertools import zip_longest
+from multiprocessing import Pool
 import os
 import shutil
 
+import numpy as np
+
 from fairseq.data import indexed_dataset, dictionary
 from fairseq.tokenizer import Tokenizer, tokenize_line
 
@@ -40,6 +44,10 @@ def get_parser():
     parser.add_argument('--only-source', action='store_true', help='Only process the source language')
     parser.add_argument('--padding-factor', metavar='N', default=8, type=int,
                         help='Pad dictionary size to be multiple of N')
+    parser.add_argument('--index-version', metavar='N', default=2, type=int, choices=[1, 2],
+                        help='binary dataset version: 2 stores 0-based ids in the smallest dtype '
+                             'fitting the dictionary, 1 is readable by older versions of fairseq')
+    parser.add_argument('--workers', metavar='N', default=1, type=int, help='number of parallel workers')
     return parser
 
 
@@ -51,7 +59,7 @@ def main(args):
     def build_dictionary(filenames):
         d = dictionary.Dictionary()
         for filename in filenames:
-            Tokenizer.add_file_to_dictionary(filename, d, tokenize_line)
+            Tokenizer.add_file_to_dictionary(filename, d, tokenize_line, args.workers)
         return d
 
     def train_path(lang):
@@ -69,10 +77,13 @@ def main(args):
     def dict_path(lang):
         return dest_path('dict', lang) + '.txt'
 
-    def dataset_dest_path(output_prefix, lang, extension):
+    def dataset_dest_prefix(output_prefix, lang):
         base = f'{args.destdir}/{output_prefix}'
         lang_part = f'.{args.source_lang}-{args.target_lang}.{lang}' if lang is not None else ''
-        return f'{base}{lang_part}.{extension}'
+        return f'{base}{lang_part}'
+
+    def dataset_dest_path(output_prefix, lang, extension):
+        return f'{dataset_dest_prefix(output_prefix, lang)}.{extension}'
 
     if args.joined_dictionary:
         assert not args.srcdict, 'cannot combine --srcdict and --joined-dictionary'
@@ -114,17 +125,50 @@ def main(args):
         dict = dictionary.Dictionary.load(dict_path(lang))
         print('| [{}] Dictionary: {} types'.format(lang, len(dict) - 1))
 
-        ds = indexed_dataset.IndexedDatasetBuilder(dataset_dest_path(output_prefix, lang, 'bin'))
+        n_seq_tok = [0, 0]
+        replaced = Counter()
 
-        def consumer(tensor):
-            ds.add_item(tensor)
+        def merge_result(worker_result):
+            replaced.update(worker_result['replaced'])
+            n_seq_tok[0] += worker_result['nseq']
+            n_seq_tok[1] += worker_result['ntok']
 
         input_file = '{}{}'.format(input_prefix, ('.' + lang) if lang is not None else '')
-        res = Tokenizer.binarize(input_file, dict, consumer)
-        print('| [{}] {}: {} sents, {} tokens, {:.3}% replaced by {}'.format(
-            lang, input_file, res['nseq'], res['ntok'],
-            100 * res['nunk'] / res['ntok'], dict.unk_word))
+        offsets = Tokenizer.find_offsets(input_file, args.workers)
+
+        # the first chunk is binarized by this process, the others in a pool of
+        # workers which write temporary datasets that are merged in order below
+        def temp_prefix(worker_id):
+            return '{}.tmp{}'.format(dataset_dest_prefix(output_prefix, lang), worker_id)
+
+        pool = None
+        worker_results = []
+        if args.workers > 1:
+            pool = Pool(processes=args.workers - 1)
+            for worker_id in range(1, args.workers):
+                worker_results.append(pool.apply_async(
+                    binarize,
+                    (args, input_file, dict, temp_prefix(worker_id), offsets[worker_id], offsets[worker_id + 1]),
+                ))
+            pool.close()
+
+        ds = make_builder(args, dataset_dest_prefix(output_prefix, lang), dict)
+        merge_result(Tokenizer.binarize(
+            input_file, dict, lambda t: ds.add_item(t), offset=0, end=offsets[1],
+        ))
+
+        if pool is not None:
+            pool.join()
+            for worker_id, worker_result in enumerate(worker_results, start=1):
+                merge_result(worker_result.get())
+                ds.merge_file_(temp_prefix(worker_id))
+                os.remove(indexed_dataset.data_file_path(temp_prefix(worker_id)))
+                os.remove(indexed_dataset.index_file_path(temp_prefix(worker_id)))
+
         ds.finalize(dataset_dest_path(output_prefix, lang, 'idx'))
+        print('| [{}] {}: {} sents, {} tokens, {:.3}% replaced by {}'.format(
+            lang, input_file, n_seq_tok[0], n_seq_tok[1],
+            100 * sum(replaced.values()) / n_seq_tok[1], dict.unk_word))
 
     def make_dataset(input_prefix, output_prefix, lang):
         if args.output_format == 'binary':
@@ -195,6 +239,24 @@ def main(args):
                 print('{} {}'.format(src_dict[k], tgt_dict[v]), file=f)
 
 
+def make_builder(args, output_prefix, dict):
+    return indexed_dataset.IndexedDatasetBuilder(
+        indexed_dataset.data_file_path(output_prefix),
+        dtype=indexed_dataset.best_fitting_dtype(len(dict)) if args.index_version == 2 else np.int32,
+        version=args.index_version,
+        vocab_size=len(dict),
+    )
+
+
+def binarize(args, filename, dict, output_prefix, offset, end):
+    """Binarize the lines of *filename* in ``[offset, end)`` into a
+    (temporary) dataset at *output_prefix*."""
+    ds = make_builder(args, output_prefix, dict)
+    res = Tokenizer.binarize(filename, dict, lambda t: ds.add_item(t), offset=offset, end=end)
+    ds.finalize(indexed_dataset.index_file_path(output_prefix))
+    return res
+
+
 if __name__ == '__main__':
     parser = get_parser()
     args = parser.parse_args()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Measure the decoding speed (steps/sec) of SequenceGenerator with a randomly
+initialized model, e.g.:
+
+    python scripts/benchmark_generation.py --arch transformer_wmt_en_de --beam 5
+"""
+
+import argparse
+import time
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models import ARCH_CONFIG_REGISTRY, ARCH_MODEL_REGISTRY
+from fairseq.sequence_generator import GreedySequenceGenerator, SequenceGenerator
+
+
+def build_model(arch, dictionary):
+    args = argparse.Namespace(arch=arch, max_source_positions=1024, max_target_positions=1024)
+    ARCH_CONFIG_REGISTRY[arch](args)
+    task = argparse.Namespace(source_dictionary=dictionary, target_dictionary=dictionary)
+    return ARCH_MODEL_REGISTRY[arch].build_model(args, task)
+
+
+def benchmark(generator, src_tokens, src_lengths, steps, repeat):
+    """Return the number of decoding steps per second, over *repeat* runs
+    after a warm-up run."""
+    generator.generate(src_tokens, src_lengths, maxlen=steps)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        generator.generate(src_tokens, src_lengths, maxlen=steps)
+    # one extra step for EOS marker
+    return repeat * (steps + 1) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark beam search decoding speed.')
+    parser.add_argument('--arch', default='transformer_wmt_en_de', help='model architecture')
+    parser.add_argument('--vocab-size', default=32000, type=int, help='size of the (joined) dictionary')
+    parser.add_argument('--beam', default=5, type=int, help='beam size')
+    parser.add_argument('--batch-size', default=16, type=int, help='number of source sentences')
+    parser.add_argument('--src-len', default=30, type=int, help='length of the source sentences')
+    parser.add_argument('--steps', default=30, type=int, help='number of decoding steps')
+    parser.add_argument('--repeat', default=3, type=int, help='number of timed runs')
+    parser.add_argument('--threads', type=int, help='number of CPU threads')
+    parser.add_argument('--cuda', action='store_true', help='decode on the GPU')
+    parser.add_argument('--seed', default=1, type=int, help='random seed')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dictionary = Dictionary()
+    for i in range(args.vocab_size):
+        dictionary.add_symbol(str(i))
+    model = build_model(args.arch, dictionary)
+    src_tokens = torch.randint(dictionary.nspecial, len(dictionary), (args.batch_size, args.src_len))
+    src_tokens[:, -1] = dictionary.eos()
+    src_lengths = torch.full((args.batch_size,), args.src_len, dtype=torch.long)
+    if args.cuda:
+        model.cuda()
+        src_tokens, src_lengths = src_tokens.cuda(), src_lengths.cuda()
+
+    print('| {}, beam {}, {} sentences of {} tokens, {} steps'.format(
+        args.arch, args.beam, args.batch_size, args.src_len, args.steps))
+    configs = [
+        ('default', SequenceGenerator, {}),
+        ('kv cache', SequenceGenerator, {'kv_cache': True}),
+    ]
+    if args.beam == 1:
+        configs += [
+            ('greedy', GreedySequenceGenerator, {}),
+            ('greedy+kv', GreedySequenceGenerator, {'kv_cache': True}),
+        ]
+    for name, generator_cls, kwargs in configs:
+        # decode for exactly --steps steps
+        generator = generator_cls(
+            [model], dictionary, beam_size=args.beam, minlen=args.steps, **kwargs
+        )
+        steps_per_sec = benchmark(generator, src_tokens, src_lengths, args.steps, args.repeat)
+        print('| {:<10} {:8.2f} steps/sec'.format(name, steps_per_sec))
+
+
+if __name__ == '__main__':
+    main()
@@ -131,6 +131,31 @@ class TestLanguageModeling(unittest.TestCase):
                 eval_lm_main(data_dir)
 
 
+class TestPreprocessing(unittest.TestCase):
+
+    def test_workers(self):
+        with contextlib.redirect_stdout(StringIO()) as stdout:
+            with tempfile.TemporaryDirectory('test_workers') as data_dir:
+                create_dummy_data(data_dir)
+                serial_dir = os.path.join(data_dir, 'serial')
+                parallel_dir = os.path.join(data_dir, 'parallel')
+                preprocess_translation_data(data_dir, ['--destdir', serial_dir])
+                serial_log = stdout.getvalue()
+                preprocess_translation_data(data_dir, ['--destdir', parallel_dir, '--workers', '3'])
+                parallel_log = stdout.getvalue()[len(serial_log):]
+
+                self.assertEqual(sorted(os.listdir(serial_dir)), sorted(os.listdir(parallel_dir)))
+                for filename in os.listdir(serial_dir):
+                    with open(os.path.join(serial_dir, filename), 'rb') as serial_file:
+                        with open(os.path.join(parallel_dir, filename), 'rb') as parallel_file:
+                            self.assertEqual(serial_file.read(), parallel_file.read(), filename)
+
+                # aggregate statistics are identical as well
+                def stats(log):
+                    return [l for l in log.splitlines() if 'sents' in l]
+                self.assertEqual(stats(serial_log), stats(parallel_log))
+
+
 def create_dummy_data(data_dir, num_examples=1000, maxlen=20):
 
     def _create_dummy_data(filename):
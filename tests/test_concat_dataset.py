@@ -0,0 +1,94 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import ConcatDataset, data_utils, LanguagePairDataset
+
+import tests.utils as test_utils
+
+
+class SizedDataset(test_utils.TestDataset):
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.sizes = np.array([len(item) for item in data])
+
+
+def dummy_datasets():
+    return [
+        SizedDataset([torch.LongTensor([4 + i] * i + [2]) for i in range(start, start + n)])
+        for start, n in [(0, 3), (5, 1), (8, 4)]
+    ]
+
+
+class TestConcatDataset(unittest.TestCase):
+
+    def assertConcatenates(self, ds, expected):
+        self.assertEqual(len(ds), len(expected))
+        self.assertEqual([ds[i].tolist() for i in range(len(ds))], [item.tolist() for item in expected])
+        indices = np.random.RandomState(0).permutation(len(ds))
+        self.assertEqual(
+            [item.tolist() for item in ds.__getitems__(indices)],
+            [expected[i].tolist() for i in indices],
+        )
+        self.assertEqual(ds.sizes.tolist(), [len(item) for item in expected])
+
+    def test_concat(self):
+        datasets = dummy_datasets()
+        ds = ConcatDataset(datasets)
+        self.assertConcatenates(ds, [item for d in datasets for item in d.data])
+        for index in [-1, len(ds)]:
+            with self.assertRaises(IndexError):
+                ds[index]
+
+    def test_sample_ratios(self):
+        datasets = dummy_datasets()
+        ds = ConcatDataset(datasets, sample_ratios=[0.5, 3, 1.5])
+        # fractional ratios add a seeded random subset of the dataset
+        subsets = [ds.partial_indices[offset:] for offset in ds.partial_offsets]
+        subsets = [sorted(subsets[0][:1].tolist()), sorted(subsets[2].tolist())]
+        self.assertEqual(len(set(subsets[1])), 2)
+        expected = (
+            [datasets[0].data[i] for i in subsets[0]] + datasets[1].data * 3 +
+            datasets[2].data + [datasets[2].data[i] for i in subsets[1]]
+        )
+        self.assertConcatenates(ds, expected)
+        # upsampled items are not copied
+        self.assertIs(ds[2], ds[3])
+        # the subsets only depend on the seed
+        same = ConcatDataset(dummy_datasets(), sample_ratios=[0.5, 3, 1.5])
+        self.assertEqual(same.partial_indices.tolist(), ds.partial_indices.tolist())
+        self.assertNotEqual(
+            [ConcatDataset(datasets, sample_ratios=[0.5, 1, 1], seed=seed)[0].tolist() for seed in range(10)],
+            [datasets[0][0].tolist()] * 10,
+        )
+        self.assertEqual(len(ConcatDataset(datasets, sample_ratios=0)), 0)
+        with self.assertRaises(ValueError):
+            ConcatDataset(datasets, sample_ratios=[1, 2])
+
+    def test_language_pair(self):
+        d = test_utils.dummy_dictionary(20)
+        src, tgt = dummy_datasets(), dummy_datasets()
+        src_ds, tgt_ds = ConcatDataset(src, [2, 1, 1]), ConcatDataset(tgt, [2, 1, 1])
+        dataset = LanguagePairDataset(src_ds, src_ds.sizes, d, tgt_ds, tgt_ds.sizes, d)
+        itr = data_utils.EpochBatchIterator(dataset, max_tokens=10)
+        samples = list(itr.next_epoch_itr(shuffle=False))
+        self.assertEqual(
+            sorted(i for sample in samples for i in sample['id'].tolist()),
+            list(range(len(src_ds))),
+        )
+        for sample in samples:
+            for i, src_tokens in zip(sample['id'].tolist(), sample['net_input']['src_tokens']):
+                self.assertEqual(src_tokens[src_tokens != d.pad()].tolist(), src_ds[i].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
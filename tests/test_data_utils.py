@@ -5,9 +5,92 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import argparse
+import os
+import tempfile
 import unittest
 
-from fairseq.data import data_utils
+import numpy as np
+import torch
+
+from fairseq.data import data_utils, LanguagePairDataset, MonolingualDataset
+
+import tests.utils as test_utils
+
+
+def dummy_language_pair_dataset(num_examples=100, maxlen=20, seed=0):
+    rng = np.random.RandomState(seed)
+    d = test_utils.dummy_dictionary(10)
+    src_sizes = rng.randint(1, maxlen, size=num_examples)
+    tgt_sizes = rng.randint(1, maxlen, size=num_examples)
+
+    def sentences(sizes):
+        return [
+            torch.LongTensor(rng.randint(d.nspecial, len(d), size=sz - 1).tolist() + [d.eos()])
+            for sz in sizes
+        ]
+
+    return LanguagePairDataset(
+        sentences(src_sizes), src_sizes, d,
+        sentences(tgt_sizes), tgt_sizes, d,
+    )
+
+
+def legacy_collate_tokens(values, pad_idx, eos_idx, left_pad, move_eos_to_beginning=False):
+    """Reference implementation of data_utils.collate_tokens, which copies
+    one sequence at a time."""
+    size = max(v.size(0) for v in values)
+    res = values[0].new(len(values), size).fill_(pad_idx)
+    for i, v in enumerate(values):
+        dst = res[i][size - len(v):] if left_pad else res[i][:len(v)]
+        if move_eos_to_beginning:
+            assert v[-1] == eos_idx
+            dst[0] = eos_idx
+            dst[1:] = v[:-1]
+        else:
+            dst.copy_(v)
+    return res
+
+
+def legacy_batch_generator(dataset, max_tokens, max_sentences, max_positions, bsz_mult, batch_cost=None):
+    """Reference implementation of EpochBatchIterator._batch_generator,
+    which processes one example at a time."""
+    batch = []
+
+    def is_batch_full(num_tokens):
+        if len(batch) == 0:
+            return False
+        if len(batch) == max_sentences:
+            return True
+        if num_tokens > max_tokens:
+            return True
+        return False
+
+    def example_sizes(idx):
+        if batch_cost is None:
+            return np.array([dataset.num_tokens(idx)])
+        return dataset.size(idx)
+
+    sample_len = 0
+    sample_lens = []
+    for idx in dataset.ordered_indices():
+        if not dataset.valid_size(idx, max_positions):
+            continue
+        sample_lens.append(example_sizes(idx))
+        sample_len = np.maximum(sample_len, sample_lens[-1])
+        if batch_cost is None:
+            num_tokens = (len(batch) + 1) * sample_len[0]
+        else:
+            num_tokens = batch_cost(len(batch) + 1, *sample_len)
+        if is_batch_full(num_tokens):
+            mod_len = max(bsz_mult * (len(batch) // bsz_mult), len(batch) % bsz_mult)
+            yield batch[:mod_len]
+            batch = batch[mod_len:]
+            sample_lens = sample_lens[mod_len:]
+            sample_len = np.max(sample_lens, axis=0) if len(sample_lens) > 0 else 0
+        batch.append(idx)
+    if len(batch) > 0:
+        yield batch
 
 
 class TestDataUtils(unittest.TestCase):
@@ -24,6 +107,369 @@ class TestDataUtils(unittest.TestCase):
         self.assertEqual(next(itr), 9)
         self.assertFalse(itr.has_next())
 
+        # the iterable (e.g., a DataLoader and its workers) is only iterated
+        # once, from the first element on
+        class Iterable(object):
+            num_iters = 0
+
+            def __len__(self):
+                return len(x)
+
+            def __iter__(self):
+                self.num_iters += 1
+                return iter(x)
+
+        iterable = Iterable()
+        itr = data_utils.CountingIterator(iterable)
+        self.assertTrue(itr.has_next())
+        self.assertEqual(iterable.num_iters, 0)
+        self.assertEqual(list(itr.skip(2)), x[2:])
+        self.assertEqual(iterable.num_iters, 1)
+
+    def test_collate_tokens(self):
+        dataset = dummy_language_pair_dataset(num_examples=50)
+        pool = data_utils.BufferPool(num_slots=2)
+        for bsz in [1, 7, 50]:
+            values = [dataset.tgt[i] for i in range(bsz)]
+            for left_pad in [True, False]:
+                for move_eos_to_beginning in [True, False]:
+                    self.assertTrue(torch.equal(
+                        data_utils.collate_tokens(values, 1, 2, left_pad, move_eos_to_beginning),
+                        legacy_collate_tokens(values, 1, 2, left_pad, move_eos_to_beginning),
+                    ))
+                target, prev_output_tokens = data_utils.collate_target_tokens(
+                    values, 1, 2, left_pad, buffer_pool=pool,
+                )
+                self.assertTrue(target.is_contiguous())
+                self.assertTrue(torch.equal(target, legacy_collate_tokens(values, 1, 2, left_pad)))
+                self.assertTrue(torch.equal(prev_output_tokens, legacy_collate_tokens(values, 1, 2, left_pad, True)))
+
+    def test_collate_packed(self):
+        dataset = dummy_language_pair_dataset(num_examples=50)
+        pad, eos = dataset.src_dict.pad(), dataset.src_dict.eos()
+        samples = [dataset[i] for i in range(50)]
+        for pack_length in [1, 20, 64]:
+            dataset.pack_length = pack_length
+            batch = dataset.collater(samples)
+            self.assertEqual(batch['nsentences'], 50)
+            self.assertEqual(batch['ntokens'], sum(len(s['target']) for s in samples))
+            self.assertEqual(sorted(batch['id'].tolist()), list(range(50)))
+            net_input = batch['net_input']
+            src_segments, tgt_segments = net_input['src_segments'], net_input['tgt_segments']
+            num_rows = src_segments.size(0)
+            self.assertLessEqual(num_rows, 50)
+            if pack_length >= 20:
+                self.assertLessEqual(net_input['src_tokens'].size(1), pack_length)
+                self.assertLessEqual(batch['target'].size(1), pack_length)
+                self.assertLess(num_rows, 50)
+            self.assertTrue(torch.equal(src_segments.eq(0), net_input['src_tokens'].eq(pad)))
+            self.assertTrue(torch.equal(tgt_segments.eq(0), batch['target'].eq(pad)))
+            self.assertTrue(torch.equal(net_input['src_lengths'], src_segments.ne(0).long().sum(1)))
+
+            # every pair occupies one segment of the same row on both sides,
+            # and its decoder input starts with its own eos
+            num_segments = src_segments.max(dim=1)[0]
+            packed = []
+            for row in range(num_rows):
+                for segment in range(1, int(num_segments[row]) + 1):
+                    src_mask, tgt_mask = src_segments[row].eq(segment), tgt_segments[row].eq(segment)
+                    packed.append((
+                        net_input['src_tokens'][row][src_mask].tolist(),
+                        batch['target'][row][tgt_mask].tolist(),
+                        net_input['prev_output_tokens'][row][tgt_mask].tolist(),
+                    ))
+            expected = [
+                (s['source'].tolist(), s['target'].tolist(), [eos] + s['target'][:-1].tolist())
+                for s in samples
+            ]
+            self.assertEqual(sorted(packed), sorted(expected))
+
+    def test_pack_sequences(self):
+        lengths = np.array([[5, 4], [3, 5], [4, 2], [2, 2], [9, 1]])
+        rows, offsets, segments = data_utils.pack_sequences(lengths, 8)
+        self.assertEqual(rows.tolist(), [0, 1, 1, 0, 2])
+        self.assertEqual(offsets.tolist(), [[0, 0], [0, 0], [3, 5], [5, 4], [0, 0]])
+        self.assertEqual(segments.tolist(), [1, 1, 2, 2, 1])
+
+    def test_buffer_pool(self):
+        pool = data_utils.BufferPool(num_slots=2)
+        a = pool.get('tokens', (3, 5), torch.int64)
+        b = pool.get('tokens', (4, 4), torch.int64)
+        self.assertEqual(a.size(), (3, 5))
+        self.assertNotEqual(a.data_ptr(), b.data_ptr())
+        # every num_slots-th request of a bucket reuses a buffer
+        self.assertEqual(pool.get('tokens', (2, 8), torch.int64).data_ptr(), a.data_ptr())
+        self.assertNotEqual(pool.get('target', (3, 5), torch.int64).data_ptr(), b.data_ptr())
+        self.assertNotEqual(pool.get('tokens', (3, 6), torch.int64).data_ptr(), b.data_ptr())
+
+    def test_compact_batches(self):
+        batches = data_utils.CompactBatches.from_batches([np.array([3, 1]), np.array([0]), np.array([2, 4, 5])])
+        self.assertEqual(batches.indices.tolist(), [3, 1, 0, 2, 4, 5])
+        self.assertEqual(batches.offsets.tolist(), [0, 2, 3, 6])
+        permuted = batches.permute(np.array([2, 0, 1]))
+        self.assertEqual([b.tolist() for b in permuted], [[2, 4, 5], [3, 1], [0]])
+        self.assertEqual([b.tolist() for b in permuted.permute(np.array([1, 2]))], [[3, 1], [0]])
+        # batches are views of the flat index array
+        self.assertIs(permuted[1].base, batches.indices)
+
+        shards = [
+            [list(b) for b in data_utils.ShardedIterator(permuted, 2, shard_id, fill_value=[])]
+            for shard_id in range(2)
+        ]
+        self.assertEqual(shards, [[[2, 4, 5], [0]], [[3, 1], []]])
+
+    def test_epoch_batch_iterator_workers(self):
+        dataset = dummy_language_pair_dataset()
+
+        def epoch_batch_itr(**kwargs):
+            return data_utils.EpochBatchIterator(dataset, max_tokens=50, seed=3, **kwargs)
+
+        def ids(itr):
+            return [sample['id'].tolist() for sample in itr]
+
+        serial = epoch_batch_itr()
+        parallel = epoch_batch_itr(num_workers=2)
+        for _ in range(3):
+            self.assertEqual(ids(serial.next_epoch_itr()), ids(parallel.next_epoch_itr()))
+
+        # batches are shuffled exactly as with the seeded global PRNG
+        with data_utils.numpy_seed(3 + 4):
+            batches = list(serial.frozen_batches)
+            np.random.shuffle(batches)
+        self.assertEqual(
+            [sorted(b) for b in ids(parallel.next_epoch_itr())],
+            [sorted(b) for b in batches],
+        )
+
+        # resume in the middle of an epoch
+        itr = parallel.next_epoch_itr()
+        expected = ids(itr)
+        itr = epoch_batch_itr(num_workers=2)
+        itr.load_state_dict({'epoch': 5, 'iterations_in_epoch': 4})
+        self.assertEqual(ids(itr.next_epoch_itr()), expected[4:])
+
+    def test_epoch_batch_iterator_resume(self):
+        dataset = dummy_language_pair_dataset()
+        fetched = []
+
+        class RecordingDataset(type(dataset)):
+            def __getitem__(self, index):
+                fetched.append(index)
+                return super().__getitem__(index)
+
+            def __getitems__(self, indices):
+                fetched.extend(indices)
+                return super().__getitems__(indices)
+
+        dataset.__class__ = RecordingDataset
+
+        for num_shards, shard_id in [(1, 0), (3, 1)]:
+            def epoch_batch_itr():
+                return data_utils.EpochBatchIterator(
+                    dataset, max_tokens=50, seed=3, num_shards=num_shards, shard_id=shard_id,
+                )
+
+            itr = epoch_batch_itr()
+            itr.next_epoch_itr()
+            epoch_itr = itr.next_epoch_itr()
+            expected = [sample['id'].tolist() for sample in epoch_itr]
+            expected_batches = list(itr._get_shuffled_batches(2))[shard_id::num_shards]
+
+            for itr_pos in [1, len(expected) - 1, len(expected)]:
+                itr = epoch_batch_itr()
+                itr.load_state_dict({'epoch': 2, 'iterations_in_epoch': itr_pos})
+                del fetched[:]
+                epoch_itr = itr.next_epoch_itr()
+                self.assertEqual(len(epoch_itr), len(expected))
+                self.assertEqual(epoch_itr.count, itr_pos if itr_pos < len(expected) else 0)
+                resumed = [sample['id'].tolist() for sample in epoch_itr]
+                if itr_pos < len(expected):
+                    self.assertEqual(resumed, expected[itr_pos:])
+                    # only the remaining batches are loaded
+                    self.assertEqual(
+                        sorted(fetched),
+                        sorted(np.concatenate(expected_batches[itr_pos:]).tolist()),
+                    )
+                else:
+                    # resuming at the end of an epoch starts the next one
+                    self.assertEqual(itr.epoch, 3)
+
+    def test_balance_shards(self):
+        dataset = dummy_language_pair_dataset(num_examples=2000, maxlen=100)
+        num_shards = 4
+
+        def epoch_batch_itr(shard_id, **kwargs):
+            return data_utils.EpochBatchIterator(
+                dataset, max_sentences=8, seed=2, num_shards=num_shards, shard_id=shard_id, **kwargs
+            )
+
+        plain = epoch_batch_itr(0)
+        plain.next_epoch_itr()
+        balanced = [epoch_batch_itr(shard_id, balance_shards=True) for shard_id in range(num_shards)]
+        def ids(itr):
+            # the last step is padded with empty batches
+            return [sample['id'].tolist() if len(sample) > 0 else [] for sample in itr]
+
+        shards = [ids(itr.next_epoch_itr()) for itr in balanced]
+
+        # every batch is processed exactly once, and all shards agree on the imbalance
+        self.assertEqual(
+            sorted(i for shard in shards for batch in shard for i in batch),
+            sorted(i for batch in plain.frozen_batches for i in batch.tolist()),
+        )
+        for itr in balanced[1:]:
+            self.assertEqual(itr.step_imbalance.tolist(), balanced[0].step_imbalance.tolist())
+        self.assertEqual(len(balanced[0].step_imbalance), len(shards[0]))
+        self.assertLess(balanced[0].step_imbalance[:-1].mean(), plain.step_imbalance[:-1].mean())
+        self.assertLess(balanced[0].step_imbalance[:-1].mean(), 1.1)
+
+        # resuming reproduces the same order
+        itr = epoch_batch_itr(1, balance_shards=True)
+        itr.load_state_dict({'epoch': 1, 'iterations_in_epoch': 5})
+        self.assertEqual(ids(itr.next_epoch_itr()), shards[1][5:])
+
+    def test_balance_batches(self):
+        costs = np.array([5, 1, 4, 2, 3, 6, 7])
+        order = data_utils.balance_batches(costs, 2, np.random.RandomState(0), window=2)
+        self.assertEqual(sorted(order.tolist()), list(range(len(costs))))
+        steps = [sorted(costs[order[i:i + 2]].tolist()) for i in range(0, 4, 2)]
+        self.assertEqual(sorted(steps), [[1, 2], [4, 5]])
+        # the incomplete last step stays last
+        self.assertEqual(sorted(costs[order[4:6]].tolist()), [6, 7])
+        self.assertEqual(costs[order[6]], 3)
+        self.assertEqual(data_utils.shard_imbalance(costs, 2).tolist(), [5 / 3, 4 / 3, 6 / 4.5, 2])
+
+    def test_batching_does_not_fetch_items(self):
+        dataset = dummy_language_pair_dataset(num_examples=200)
+        dataset.src = test_utils.UnfetchableDataset(dataset.src)
+        dataset.tgt = test_utils.UnfetchableDataset(dataset.tgt)
+        itr = data_utils.EpochBatchIterator(
+            dataset, max_tokens=50, max_positions=(15, 15), ignore_invalid_inputs=True,
+        )
+        valid = (dataset.src_sizes <= 15) & (dataset.tgt_sizes <= 15)
+        self.assertEqual(sorted(np.concatenate(list(itr.frozen_batches)).tolist()), np.flatnonzero(valid).tolist())
+
+    def test_batch_generator(self):
+        for seed in range(5):
+            dataset = dummy_language_pair_dataset(num_examples=500, maxlen=50, seed=seed)
+            for max_tokens, max_sentences, bsz_mult, max_positions in [
+                (None, None, 1, None),
+                (100, None, 1, None),
+                (100, 7, 8, None),
+                (300, 16, 8, (40, 30)),
+                (1, None, 1, None),
+                (None, 3, 8, (10, 1024)),
+            ]:
+                itr = data_utils.EpochBatchIterator(
+                    dataset, max_tokens=max_tokens, max_sentences=max_sentences,
+                    max_positions=max_positions, ignore_invalid_inputs=True,
+                    required_batch_size_multiple=bsz_mult, seed=seed,
+                )
+                with data_utils.numpy_seed(seed):
+                    expected = list(legacy_batch_generator(
+                        dataset, itr.max_tokens, itr.max_sentences, max_positions, bsz_mult,
+                    ))
+                self.assertEqual([list(b) for b in itr.frozen_batches], expected)
+
+    def test_batch_cost(self):
+        dataset = dummy_language_pair_dataset(num_examples=500, maxlen=50)
+        for batch_cost in ['padded_tokens', 'transformer']:
+            cost_fn = data_utils.BATCH_COSTS[batch_cost]
+            for max_tokens, max_sentences, bsz_mult in [(200, None, 1), (400, 7, 8), (1, None, 1)]:
+                itr = data_utils.EpochBatchIterator(
+                    dataset, max_tokens=max_tokens, max_sentences=max_sentences,
+                    required_batch_size_multiple=bsz_mult, batch_cost=batch_cost,
+                )
+                with data_utils.numpy_seed(1):
+                    expected = list(legacy_batch_generator(
+                        dataset, max_tokens, itr.max_sentences, None, bsz_mult, batch_cost=cost_fn,
+                    ))
+                self.assertEqual([list(b) for b in itr.frozen_batches], expected)
+
+                # batches of several examples stay within the budget
+                costs = itr.batch_costs()
+                sizes = np.array([len(b) for b in itr.frozen_batches])
+                self.assertTrue((costs[sizes > 1] <= max_tokens).all())
+                for batch, cost in zip(itr.frozen_batches, costs):
+                    src_len, tgt_len = dataset.size(batch).max(axis=0)
+                    self.assertAlmostEqual(cost, cost_fn(len(batch), src_len, tgt_len))
+
+        # the transformer cost penalizes long sequences
+        self.assertLess(
+            data_utils.transformer_cost(8, 16, 16) / data_utils.padded_tokens_cost(8, 16, 16),
+            data_utils.transformer_cost(1, 128, 128) / data_utils.padded_tokens_cost(1, 128, 128),
+        )
+
+        # ... less so for wider models
+        args = argparse.Namespace(batch_cost='transformer', encoder_embed_dim=1024, decoder_embed_dim=1024)
+        cost_fn = data_utils.batch_cost_from_args(args)
+        self.assertLess(cost_fn(1, 128, 128), data_utils.transformer_cost(1, 128, 128))
+        self.assertEqual(cost_fn(1, 128, 128), data_utils.transformer_cost(1, 128, 128, 1024, 1024))
+        args.batch_cost = 'padded_tokens'
+        self.assertEqual(data_utils.batch_cost_from_args(args), 'padded_tokens')
+
+    def test_batch_cost_language_model(self):
+        sizes = np.random.RandomState(0).randint(1, 50, size=500)
+        dataset = MonolingualDataset(
+            [None] * len(sizes), sizes, test_utils.dummy_dictionary(10), shuffle=False,
+        )
+        batches = {
+            batch_cost: [
+                list(b) for b in
+                data_utils.EpochBatchIterator(
+                    dataset, max_tokens=200, max_positions=50, batch_cost=batch_cost,
+                ).frozen_batches
+            ]
+            for batch_cost in data_utils.BATCH_COSTS
+        }
+        # the tokens of a language model are only counted once, and there is
+        # no encoder attention
+        self.assertEqual(batches['padded_tokens'], batches['max_tokens'])
+        self.assertEqual(
+            data_utils.transformer_cost(4, 0, 32),
+            data_utils.padded_tokens_cost(4, 0, 32) + 4 * 32 * 32 / (6 * 512),
+        )
+        self.assertLessEqual(len(batches['max_tokens']), len(batches['transformer']))
+
+    def test_batch_generator_no_examples(self):
+        dataset = dummy_language_pair_dataset()
+        for batch_cost in data_utils.BATCH_COSTS:
+            # every example is filtered out
+            itr = data_utils.EpochBatchIterator(
+                dataset, max_tokens=50, max_positions=(1, 1), ignore_invalid_inputs=True,
+                batch_cost=batch_cost,
+            )
+            self.assertEqual(len(itr), 0)
+            self.assertEqual(list(itr.next_epoch_itr(shuffle=False)), [])
+        self.assertEqual(list(data_utils.batch_by_size(np.array([], dtype=np.int64), [], max_tokens=50)), [])
+
+    def test_batch_generator_invalid_inputs(self):
+        dataset = dummy_language_pair_dataset()
+        with self.assertRaises(Exception):
+            data_utils.EpochBatchIterator(dataset, max_positions=(5, 5))
+
+    def test_batch_cache(self):
+        dataset = dummy_language_pair_dataset()
+        with tempfile.TemporaryDirectory('test_batch_cache') as cache_dir:
+            def epoch_batch_itr(max_tokens=50, fingerprint='dataset'):
+                return data_utils.EpochBatchIterator(
+                    dataset, max_tokens=max_tokens, seed=3,
+                    cache_dir=cache_dir, fingerprint=fingerprint,
+                )
+
+            expected = data_utils.EpochBatchIterator(dataset, max_tokens=50, seed=3).frozen_batches
+            built = epoch_batch_itr()
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            loaded = epoch_batch_itr()
+            self.assertIsInstance(loaded.frozen_batches[0], np.memmap)
+            for batches in [built.frozen_batches, loaded.frozen_batches]:
+                self.assertEqual([list(b) for b in batches], [list(b) for b in expected])
+
+            # different batching arguments or data use different cache files
+            epoch_batch_itr(max_tokens=100)
+            epoch_batch_itr(fingerprint='other')
+            self.assertEqual(len(os.listdir(cache_dir)), 6)
+
 
 if __name__ == '__main__':
     unittest.main()
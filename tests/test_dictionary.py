@@ -11,7 +11,7 @@ import unittest
 import torch
 
 from fairseq.data import Dictionary
-from fairseq.tokenizer import Tokenizer
+from fairseq.tokenizer import Tokenizer, tokenize_line
 
 
 class TestDictionary(unittest.TestCase):
@@ -68,6 +68,28 @@ class TestDictionary(unittest.TestCase):
             assertMatch(reload_ids, ref_ids2)
             assertMatch(finalized_ids, reload_ids)
 
+    def test_add_file_to_dictionary_workers(self):
+        txt = ['A B C D', 'B C D', 'C D', 'D', 'E F A', 'G', 'F E', ''] * 7
+
+        with tempfile.NamedTemporaryFile(mode='w') as tmp_txt:
+            tmp_txt.write('\n'.join(txt) + '\n')
+            tmp_txt.flush()
+
+            def build(num_workers):
+                d = Dictionary()
+                Tokenizer.add_file_to_dictionary(tmp_txt.name, d, tokenize_line, num_workers)
+                return d
+
+            def assertDictEqual(d1, d2):
+                self.assertEqual(d1.symbols, d2.symbols)
+                self.assertEqual(d1.count[d1.nspecial:], d2.count[d2.nspecial:])
+
+            for num_workers in [2, 3, 16]:
+                serial, parallel = build(1), build(num_workers)
+                assertDictEqual(serial, parallel)
+                serial.finalize()
+                parallel.finalize()
+                assertDictEqual(serial, parallel)
 
 if __name__ == '__main__':
     unittest.main()
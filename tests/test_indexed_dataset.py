@@ -0,0 +1,229 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import (
+    Dictionary, IndexedDataset, IndexedInMemoryDataset, IndexedLazyRawTextDataset,
+    IndexedMMapDataset, IndexedRawTextDataset,
+)
+from fairseq.data import indexed_dataset
+
+import tests.utils as test_utils
+
+
+class TestIndexedDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.items = [
+            torch.IntTensor([4, 5, 6, 2]),
+            torch.IntTensor([7, 2]),
+            torch.IntTensor([8, 9, 10, 11, 12, 2]),
+        ]
+
+    def assertItemsEqual(self, ds):
+        self.assertEqual(len(ds), len(self.items))
+        self.assertEqual(list(ds.sizes), [len(item) for item in self.items])
+        for i, ref in enumerate(self.items):
+            self.assertEqual(ds[i].dtype, torch.int64)
+            self.assertEqual(ds[i].tolist(), ref.tolist())
+
+    def test_mmap(self):
+        with tempfile.TemporaryDirectory('test_mmap') as data_dir:
+            prefix = os.path.join(data_dir, 'train')
+            test_utils.write_dummy_dataset(prefix, self.items)
+
+            ds = IndexedMMapDataset(prefix, fix_lua_indexing=True)
+            self.assertIsInstance(ds.sizes, np.memmap)
+            self.assertItemsEqual(ds)
+            self.assertEqual(
+                ds.buffer[0:len(ds.buffer)].tolist(),
+                IndexedInMemoryDataset(prefix, fix_lua_indexing=True).buffer.tolist(),
+            )
+            with self.assertRaises(IndexError):
+                ds[len(self.items)]
+
+            # datasets are sent to data loading workers by pickling
+            self.assertItemsEqual(pickle.loads(pickle.dumps(ds)))
+            del ds
+
+    def test_shared_memory(self):
+        with tempfile.TemporaryDirectory('test_shared_memory') as data_dir:
+            prefix = os.path.join(data_dir, 'train')
+            test_utils.write_dummy_dataset(prefix, self.items)
+            shm_dir = os.path.join(data_dir, 'shm')
+            os.mkdir(shm_dir)
+            data_path = indexed_dataset.data_file_path(prefix)
+
+            copy = indexed_dataset.SharedMemoryCopy(data_path, shm_dir=shm_dir)
+            self.assertEqual(open(copy.path, 'rb').read(), open(data_path, 'rb').read())
+            # later users (e.g., other ranks) reuse the copy
+            mtime = os.stat(copy.path).st_mtime_ns
+            other = indexed_dataset.SharedMemoryCopy(data_path, shm_dir=shm_dir)
+            self.assertEqual(other.path, copy.path)
+            self.assertEqual(os.stat(copy.path).st_mtime_ns, mtime)
+            # the last user removes the copy and its lock file
+            copy.close()
+            self.assertTrue(os.path.exists(other.path))
+            other.close()
+            self.assertEqual(os.listdir(shm_dir), [])
+
+            # the copy is made again after it was removed, and the partial
+            # copies of killed processes are cleaned up
+            with open(copy.path + '.1234.tmp', 'w') as f:
+                f.write('partial')
+            copy = indexed_dataset.SharedMemoryCopy(data_path, shm_dir=shm_dir)
+            self.assertEqual(sorted(os.listdir(shm_dir)), sorted([
+                os.path.basename(copy.path), os.path.basename(copy.path) + '.lock',
+            ]))
+            del copy
+            self.assertEqual(os.listdir(shm_dir), [])
+
+            if os.path.isdir('/dev/shm'):
+                ds = IndexedMMapDataset(prefix, fix_lua_indexing=True, shared_memory=True)
+                shm_path = ds.buffer.path
+                self.assertTrue(shm_path.startswith('/dev/shm/'))
+                self.assertItemsEqual(ds)
+                copy = pickle.loads(pickle.dumps(ds))
+                self.assertItemsEqual(copy)
+                # the token stream of a dataset keeps the copy alive
+                buffer = ds.buffer
+                copy.close()
+                del ds
+                self.assertTrue(os.path.exists(shm_path))
+                self.assertEqual(buffer[:3].tolist(), self.items[0][:3].tolist())
+                del buffer
+                self.assertFalse(os.path.exists(shm_path))
+                self.assertFalse(os.path.exists(shm_path + '.lock'))
+
+    def test_version2(self):
+        with tempfile.TemporaryDirectory('test_version2') as data_dir:
+            v1_prefix = os.path.join(data_dir, 'v1')
+            test_utils.write_dummy_dataset(v1_prefix, self.items)
+            v2_prefix = os.path.join(data_dir, 'v2')
+            test_utils.write_dummy_dataset(
+                v2_prefix, self.items, dtype=indexed_dataset.best_fitting_dtype(16),
+                version=2, vocab_size=16,
+            )
+            self.assertEqual(
+                2 * os.path.getsize(indexed_dataset.data_file_path(v2_prefix)),
+                os.path.getsize(indexed_dataset.data_file_path(v1_prefix)),
+            )
+
+            for cls in [IndexedDataset, IndexedInMemoryDataset, IndexedMMapDataset]:
+                ds = cls(v2_prefix, fix_lua_indexing=True)
+                self.assertEqual(ds.version, 2)
+                self.assertEqual(ds.dtype, np.uint16)
+                self.assertEqual(ds.vocab_size, 16)
+                self.assertEqual(ds.total_tokens, sum(len(item) for item in self.items))
+                self.assertItemsEqual(ds)
+                self.assertItemsEqual(cls(v1_prefix, fix_lua_indexing=True))
+
+    def test_getitems(self):
+        with tempfile.TemporaryDirectory('test_getitems') as data_dir:
+            v1_prefix = os.path.join(data_dir, 'v1')
+            test_utils.write_dummy_dataset(v1_prefix, self.items)
+            v2_prefix = os.path.join(data_dir, 'v2')
+            test_utils.write_dummy_dataset(v2_prefix, self.items, dtype=np.uint16, version=2, vocab_size=16)
+
+            for prefix in [v1_prefix, v2_prefix]:
+                for cls in [IndexedInMemoryDataset, IndexedMMapDataset]:
+                    ds = cls(prefix, fix_lua_indexing=True)
+                    indices = [2, 0, 2, 1]
+                    items = ds.__getitems__(indices)
+                    self.assertEqual([item.tolist() for item in items], [ds[i].tolist() for i in indices])
+                    self.assertTrue(all(item.dtype == torch.int64 for item in items))
+                    self.assertEqual(ds.__getitems__(np.array([], dtype=np.int64)), [])
+                    with self.assertRaises(IndexError):
+                        ds.__getitems__([0, len(self.items)])
+
+    def test_best_fitting_dtype(self):
+        self.assertEqual(indexed_dataset.best_fitting_dtype(40000), np.uint16)
+        self.assertEqual(indexed_dataset.best_fitting_dtype(2 ** 16), np.uint16)
+        self.assertEqual(indexed_dataset.best_fitting_dtype(2 ** 16 + 1), np.int32)
+
+    def test_lazy_raw_text(self):
+        lines = ['a b c', '', '  d\te  a ', 'f \u00e9 b', 'c\xa0d']
+        d = Dictionary()
+        for word in 'abcdef':
+            d.add_symbol(word)
+        with tempfile.TemporaryDirectory('test_lazy_raw_text') as data_dir:
+            path = os.path.join(data_dir, 'train.en')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+
+            ref = IndexedRawTextDataset(path, d)
+            for cache_size in [0, 2]:
+                ds = IndexedLazyRawTextDataset(path, d, cache_size=cache_size)
+                self.assertEqual(len(ds), len(lines))
+                self.assertEqual(ds.sizes.tolist(), ref.sizes.tolist())
+                for i in [0, 1, 3, 2, 0, 4, 3]:
+                    self.assertEqual(ds[i].tolist(), ref[i].tolist())
+                    self.assertEqual(ds.get_original_text(i), lines[i])
+                self.assertLessEqual(len(ds.cache), cache_size)
+                with self.assertRaises(IndexError):
+                    ds[len(lines)]
+
+                # datasets are sent to data loading workers by pickling
+                copy = pickle.loads(pickle.dumps(ds))
+                self.assertEqual(copy[2].tolist(), ref[2].tolist())
+
+            # the line index is cached until the file changes
+            self.assertTrue(os.path.exists(indexed_dataset.lines_index_path(path)))
+            ds = IndexedLazyRawTextDataset(path, d, append_eos=False)
+            self.assertEqual(ds.sizes.tolist(), [3, 0, 3, 3, 2])
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('a\n')
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(IndexedLazyRawTextDataset(path, d).sizes.tolist(), [4, 1, 4, 4, 3, 2])
+
+    def test_lazy_raw_text_line_endings(self):
+        d = Dictionary()
+        for word in 'abcdef':
+            d.add_symbol(word)
+        with tempfile.TemporaryDirectory('test_lazy_raw_text_line_endings') as data_dir:
+            path = os.path.join(data_dir, 'train.en')
+            # lines are split like in text mode, as in IndexedRawTextDataset
+            for text in [b'a b\r\nc\r\n\r\nd', b'a\rb c\r\r\nd\n\re\r']:
+                with open(path, 'wb') as f:
+                    f.write(text)
+                os.utime(path, ns=(0, len(text)))
+                ref = IndexedRawTextDataset(path, d)
+                ds = IndexedLazyRawTextDataset(path, d)
+                self.assertEqual(ds.sizes.tolist(), ref.sizes.tolist())
+                for i in range(len(ref)):
+                    self.assertEqual(ds[i].tolist(), ref[i].tolist())
+                    self.assertEqual(ds.get_original_text(i), ref.get_original_text(i))
+
+    def test_lazy_raw_text_corrupt_index(self):
+        d = Dictionary()
+        d.add_symbol('a')
+        with tempfile.TemporaryDirectory('test_lazy_raw_text_corrupt_index') as data_dir:
+            path = os.path.join(data_dir, 'train.en')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('a a\na\n')
+            cache_path = indexed_dataset.lines_index_path(path)
+            IndexedLazyRawTextDataset(path, d)
+            with open(cache_path, 'rb') as f:
+                index = f.read()
+            # the index is rebuilt from a truncated, invalid or empty cache
+            for corrupt in [index[:len(index) // 2], b'not an index', b'']:
+                with open(cache_path, 'wb') as f:
+                    f.write(corrupt)
+                self.assertEqual(IndexedLazyRawTextDataset(path, d).sizes.tolist(), [3, 2])
+                with open(cache_path, 'rb') as f:
+                    self.assertEqual(f.read(), index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import (
+    data_utils, IndexedInMemoryDataset, IndexedMMapDataset, MonolingualDataset, TokenBlockDataset,
+)
+
+import tests.utils as test_utils
+
+
+def dummy_token_stream(num_sentences=50, maxlen=12, seed=0):
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(1, maxlen, size=num_sentences)
+    tokens = np.concatenate([
+        np.append(rng.randint(4, 20, size=sz - 1), 2) for sz in sizes
+    ]).astype(np.int64)
+    return tokens, sizes
+
+
+def legacy_slice_indices(tokens, sizes, block_size, break_mode):
+    """Reference implementation of the block computation of
+    TokenBlockDataset, which loops over the sentences."""
+    slice_indices = []
+    if break_mode == 'none':
+        length = -(-len(tokens) // block_size)
+        for i in range(length):
+            start = i * block_size
+            slice_indices.append((start, min(start + block_size, len(tokens))))
+    elif break_mode == 'complete':
+        tok_idx = 0
+        sz_idx = 0
+        curr_size = 0
+        while sz_idx < len(sizes):
+            if curr_size + sizes[sz_idx] <= block_size or curr_size == 0:
+                curr_size += sizes[sz_idx]
+                sz_idx += 1
+            else:
+                slice_indices.append((tok_idx, tok_idx + curr_size))
+                tok_idx += curr_size
+                curr_size = 0
+        if curr_size > 0:
+            slice_indices.append((tok_idx, tok_idx + curr_size))
+    elif break_mode == 'eos':
+        curr = 0
+        for sz in sizes:
+            if sz > 1:
+                slice_indices.append((curr, curr + sz))
+            curr += sz
+    return slice_indices
+
+
+class TestTokenBlockDataset(unittest.TestCase):
+
+    def test_slice_indices(self):
+        for seed in range(5):
+            tokens, sizes = dummy_token_stream(num_sentences=300, maxlen=40, seed=seed)
+            if seed == 1:
+                sizes[[0, 5, 6, -1]] = 0  # empty sentences
+                tokens = tokens[:sizes.sum()]
+            for break_mode in ['none', 'complete', 'eos']:
+                for block_size in [1, 7, 16, 512, 100000]:
+                    ds = TokenBlockDataset(tokens, sizes, block_size, break_mode)
+                    self.assertEqual(ds.slice_indices.dtype, np.int64)
+                    self.assertEqual(ds.slice_indices.shape, (len(ds), 2))
+                    self.assertEqual(
+                        [tuple(block) for block in ds.slice_indices.tolist()],
+                        legacy_slice_indices(tokens, sizes, block_size, break_mode),
+                    )
+                    self.assertEqual(ds.sizes.tolist(), [e - s for s, e in ds.slice_indices.tolist()])
+        for break_mode in ['none', 'complete', 'eos']:
+            self.assertEqual(len(TokenBlockDataset(np.array([], dtype=np.int64), [], 16, break_mode)), 0)
+
+    def test_mmap_token_stream(self):
+        tokens, sizes = dummy_token_stream(num_sentences=100)
+        sentences = np.split(tokens, np.cumsum(sizes)[:-1])
+        with tempfile.TemporaryDirectory('test_mmap_token_stream') as data_dir:
+            for version in [1, 2]:
+                prefix = os.path.join(data_dir, 'train{}'.format(version))
+                test_utils.write_dummy_dataset(
+                    prefix, [torch.IntTensor(s) for s in sentences], version=version, vocab_size=32,
+                )
+                in_memory = IndexedInMemoryDataset(prefix, fix_lua_indexing=True)
+                mmap = IndexedMMapDataset(prefix, fix_lua_indexing=True)
+                for break_mode in ['none', 'complete', 'eos']:
+                    # blocks are computed without reading any token
+                    TokenBlockDataset(test_utils.UnfetchableDataset(mmap.buffer), mmap.sizes, 16, break_mode)
+
+                    ref = TokenBlockDataset(in_memory.buffer, in_memory.sizes, 16, break_mode, include_targets=True)
+                    ds = TokenBlockDataset(mmap.buffer, mmap.sizes, 16, break_mode, include_targets=True)
+                    # pickling (e.g., for data loading workers) doesn't copy the tokens
+                    self.assertLess(len(pickle.dumps(ds.tokens)), 1000)
+                    ds = pickle.loads(pickle.dumps(ds))
+                    indices = np.arange(len(ref))
+                    self.assertItemsEqual([ds[i] for i in indices], [ref[i] for i in indices])
+                    self.assertItemsEqual(ds.__getitems__(indices), [ref[i] for i in indices])
+                del mmap
+
+    def test_cache(self):
+        tokens, sizes = dummy_token_stream()
+        with tempfile.TemporaryDirectory('test_cache') as data_dir:
+            cache_path = os.path.join(data_dir, 'blocks.npy')
+            ds = TokenBlockDataset(tokens, sizes, 16, 'complete', cache_path=cache_path)
+            self.assertTrue(os.path.exists(cache_path))
+            cached = TokenBlockDataset(tokens, None, 16, 'complete', cache_path=cache_path)
+            self.assertIsInstance(cached.slice_indices, np.memmap)
+            self.assertEqual(cached.slice_indices.tolist(), ds.slice_indices.tolist())
+            self.assertEqual(cached.sizes.tolist(), ds.sizes.tolist())
+            self.assertEqual(cached[3].tolist(), ds[3].tolist())
+            del cached
+
+    def assertItemsEqual(self, items, ref):
+        self.assertEqual(len(items), len(ref))
+        for item, ref_item in zip(items, ref):
+            if isinstance(ref_item, tuple):
+                self.assertEqual([t.tolist() for t in item], [t.tolist() for t in ref_item])
+            else:
+                self.assertEqual(item.tolist(), ref_item.tolist())
+
+    def test_getitems(self):
+        tokens, sizes = dummy_token_stream()
+        for break_mode in ['none', 'complete', 'eos']:
+            for include_targets in [False, True]:
+                ds = TokenBlockDataset(tokens, sizes, 16, break_mode, include_targets=include_targets)
+                indices = np.array([3, 0, len(ds) - 1, 3])
+                self.assertItemsEqual(ds.__getitems__(indices), [ds[i] for i in indices])
+                self.assertEqual(ds.__getitems__([]), [])
+
+    def test_monolingual_batches(self):
+        tokens, sizes = dummy_token_stream(num_sentences=200)
+        d = test_utils.dummy_dictionary(20)
+        block_ds = TokenBlockDataset(tokens, sizes, 16, 'complete', include_targets=True)
+        dataset = MonolingualDataset(block_ds, block_ds.sizes, d, shuffle=True)
+
+        class ItemByItemDataset(MonolingualDataset):
+            __getitems__ = None
+
+        reference = ItemByItemDataset(block_ds, block_ds.sizes, d, shuffle=True)
+        for num_workers in [0, 1]:
+            itr = data_utils.EpochBatchIterator(
+                dataset, max_tokens=64, max_positions=1024, seed=1, num_workers=num_workers,
+            )
+            ref_itr = data_utils.EpochBatchIterator(reference, max_tokens=64, max_positions=1024, seed=1)
+            for sample, ref_sample in zip(itr.next_epoch_itr(), ref_itr.next_epoch_itr()):
+                self.assertTrue(torch.equal(sample['id'], ref_sample['id']))
+                self.assertTrue(torch.equal(sample['net_input']['src_tokens'], ref_sample['net_input']['src_tokens']))
+                self.assertTrue(torch.equal(sample['target'], ref_sample['target']))
+
+    def test_batching_does_not_fetch_items(self):
+        tokens, sizes = dummy_token_stream(num_sentences=200)
+        d = test_utils.dummy_dictionary(20)
+        for break_mode in ['none', 'complete', 'eos']:
+            block_ds = TokenBlockDataset(tokens, sizes, 16, break_mode, include_targets=True)
+            dataset = MonolingualDataset(test_utils.UnfetchableDataset(block_ds), block_ds.sizes, d, shuffle=True)
+            itr = data_utils.EpochBatchIterator(
+                dataset, max_tokens=64, max_positions=12, seed=1, ignore_invalid_inputs=True,
+            )
+            self.assertEqual(
+                sorted(np.concatenate(list(itr.frozen_batches)).tolist()),
+                np.flatnonzero(block_ds.sizes <= 12).tolist(),
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
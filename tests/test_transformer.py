@@ -0,0 +1,238 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import argparse
+import unittest
+
+import torch
+
+from fairseq.criterions.cross_entropy import CrossEntropyCriterion
+from fairseq.data.language_pair_dataset import collate, collate_packed
+from fairseq.models import ARCH_CONFIG_REGISTRY, transformer
+from fairseq.modules import MultiheadAttention
+from fairseq.sequence_generator import GreedySequenceGenerator, SequenceGenerator
+from fairseq.tasks.translation import TranslationTask
+
+import tests.utils as test_utils
+from tests.test_data_utils import dummy_language_pair_dataset
+
+
+def dummy_transformer(dictionary, learned_pos=False):
+    args = argparse.Namespace(
+        encoder_embed_dim=16, encoder_ffn_embed_dim=32, encoder_layers=2, encoder_attention_heads=2,
+        decoder_layers=2, decoder_attention_heads=2, encoder_learned_pos=learned_pos,
+        decoder_learned_pos=learned_pos, max_source_positions=64, max_target_positions=64,
+    )
+    transformer.base_architecture(args)
+    embed_tokens = transformer.Embedding(len(dictionary), args.encoder_embed_dim, dictionary.pad())
+    model = transformer.TransformerModel(
+        transformer.TransformerEncoder(args, dictionary, embed_tokens),
+        transformer.TransformerDecoder(args, dictionary, embed_tokens),
+    )
+    model.eval()
+    return model
+
+
+def pair_scores(sample, lprobs, pad):
+    """Map the source and target of every sentence pair of a padded or packed
+    batch to the log-probabilities of its target tokens."""
+    src_segments = sample['net_input'].get('src_segments')
+    if src_segments is None:
+        # one pair per row
+        src_segments = sample['net_input']['src_tokens'].ne(pad).long()
+        tgt_segments = sample['target'].ne(pad).long()
+    else:
+        tgt_segments = sample['net_input']['tgt_segments']
+    scores = lprobs.gather(-1, sample['target'].unsqueeze(-1)).squeeze(-1)
+    pairs = {}
+    for row in range(src_segments.size(0)):
+        for segment in range(1, int(src_segments[row].max()) + 1):
+            src_mask, tgt_mask = src_segments[row].eq(segment), tgt_segments[row].eq(segment)
+            key = (
+                tuple(sample['net_input']['src_tokens'][row][src_mask].tolist()),
+                tuple(sample['target'][row][tgt_mask].tolist()),
+            )
+            pairs[key] = scores[row][tgt_mask]
+    return pairs
+
+
+class TestTransformer(unittest.TestCase):
+
+    def test_packed_batch(self):
+        dataset = dummy_language_pair_dataset(num_examples=12)
+        d = dataset.src_dict
+        samples = [dataset[i] for i in range(12)]
+        padded = collate(samples, d.pad(), d.eos())
+        packed = collate_packed(samples, d.pad(), d.eos(), pack_length=24)
+        self.assertLess(packed['target'].numel(), padded['target'].numel())
+
+        for learned_pos in [False, True]:
+            torch.manual_seed(learned_pos)
+            model = dummy_transformer(d, learned_pos)
+            with torch.no_grad():
+                lprobs = model.get_normalized_probs(model(**padded['net_input']), log_probs=True)
+                packed_lprobs = model.get_normalized_probs(model(**packed['net_input']), log_probs=True)
+
+            # each pair is scored as if it were alone in the row
+            expected = pair_scores(padded, lprobs, d.pad())
+            scores = pair_scores(packed, packed_lprobs, d.pad())
+            self.assertEqual(sorted(scores.keys()), sorted(expected.keys()))
+            for key, score in scores.items():
+                self.assertTrue(torch.allclose(score, expected[key], atol=1e-5))
+
+            # the criterion only counts the real tokens and sentences
+            args = argparse.Namespace(sentence_avg=False)
+            criterion = CrossEntropyCriterion(args, test_utils.TestTranslationTask(args, d, d, model))
+            with torch.no_grad():
+                loss, sample_size, _ = criterion(model, padded)
+                packed_loss, packed_sample_size, _ = criterion(model, packed)
+            self.assertEqual(sample_size, packed_sample_size)
+            self.assertAlmostEqual(loss.item(), packed_loss.item(), places=3)
+            args.sentence_avg = True
+            self.assertEqual(criterion(model, packed)[1], 12)
+
+            # padding does not produce NaNs in the gradients
+            model.train()
+            criterion(model, packed)[0].backward()
+            for p in model.parameters():
+                self.assertTrue(torch.isfinite(p.grad).all())
+
+    def test_pack_length_requires_transformer(self):
+        d = test_utils.dummy_dictionary(10)
+        for arch in ['lstm', 'fconv', 'transformer_iwslt_de_en']:
+            args = argparse.Namespace(
+                arch=arch, pack_length=64, max_source_positions=64, max_target_positions=64,
+            )
+            ARCH_CONFIG_REGISTRY[arch](args)
+            task = TranslationTask(args, d, d)
+            if arch.startswith('transformer'):
+                self.assertTrue(task.build_model(args).supports_packed_batches)
+            else:
+                with self.assertRaisesRegex(ValueError, '--pack-length is not supported by --arch ' + arch):
+                    task.build_model(args)
+
+    def test_kv_cache(self):
+        torch.manual_seed(0)
+        attn = MultiheadAttention(8, 2)
+        state, cached_state = {}, {}
+        attn.allocate_incremental_state(cached_state, max_len=6)
+        bsz = 6
+        for step in range(6):
+            x = torch.randn(1, bsz, 8)
+            out = attn(x, x, x, incremental_state=state)[0]
+            cached_out = attn(x, x, x, incremental_state=cached_state)[0]
+            self.assertTrue(torch.allclose(out, cached_out, atol=1e-6))
+            if step == 3:
+                # drop a finished sentence
+                bsz = 4
+                new_order = torch.LongTensor([0, 1, 5, 5])
+            else:
+                new_order = torch.LongTensor([0, 0, 2, 1, 4, 5][:bsz])
+            attn.reorder_incremental_state(state, new_order)
+            attn.reorder_incremental_state(cached_state, new_order)
+        buffer = attn._get_input_buffer(cached_state)
+        self.assertEqual(list(buffer['key_buffer'].size()), [6, 4, 8])
+        with self.assertRaises(AssertionError):
+            attn(x, x, x, incremental_state=cached_state)
+
+    def test_static_kv(self):
+        torch.manual_seed(0)
+        attn = MultiheadAttention(8, 2)
+        state = {}
+        # 3 sentences with 2 hypotheses each, sharing the encoder output
+        encoder_out = torch.randn(5, 3, 8)
+        for new_order in [[1, 0, 2, 2, 5, 4], [0, 0, 3, 2, 4, 5], [3, 2, 5, 5], None]:
+            bsz = 2 * encoder_out.size(1)
+            x = torch.randn(1, bsz, 8)
+            out = attn(x, encoder_out, encoder_out, incremental_state=state, static_kv=True)[0]
+            expanded = encoder_out.unsqueeze(2).repeat(1, 1, 2, 1).view(5, bsz, 8)
+            self.assertTrue(torch.allclose(out, attn(x, expanded, expanded)[0], atol=1e-6))
+            if new_order is None:
+                break
+            prev_key = attn._get_input_buffer(state)['prev_key']
+            attn.reorder_incremental_state(state, torch.LongTensor(new_order))
+            if len(new_order) == bsz:
+                # reordering the hypotheses of a sentence does not copy
+                self.assertIs(attn._get_input_buffer(state)['prev_key'], prev_key)
+            else:
+                # the first sentence was dropped
+                encoder_out = encoder_out[:, 1:]
+                self.assertEqual(attn._get_input_buffer(state)['prev_key'].size(1), 2)
+
+    def test_generate_with_kv_cache(self):
+        dataset = dummy_language_pair_dataset(num_examples=6)
+        d = dataset.src_dict
+        sample = collate([dataset[i] for i in range(6)], d.pad(), d.eos())
+        torch.manual_seed(0)
+        model = dummy_transformer(d)
+        # make eos likely enough that sentences finish at different steps
+        model.decoder.embed_tokens.weight.data[d.eos()] *= 4
+        hypos = [
+            SequenceGenerator([model], d, beam_size=3, kv_cache=kv_cache).generate(
+                sample['net_input']['src_tokens'], sample['net_input']['src_lengths'], maxlen=12,
+            )
+            for kv_cache in [False, True]
+        ]
+        for ref_hypos, cached_hypos in zip(*hypos):
+            self.assertEqual(len(ref_hypos), len(cached_hypos))
+            for ref, hypo in zip(ref_hypos, cached_hypos):
+                self.assertEqual(ref['tokens'].tolist(), hypo['tokens'].tolist())
+                self.assertAlmostEqual(ref['score'], hypo['score'], places=4)
+
+    def test_generate_with_shared_encoder_out(self):
+        dataset = dummy_language_pair_dataset(num_examples=6)
+        d = dataset.src_dict
+        sample = collate([dataset[i] for i in range(6)], d.pad(), d.eos())
+        torch.manual_seed(0)
+        model = dummy_transformer(d)
+        model.decoder.embed_tokens.weight.data[d.eos()] *= 4
+        copied_model = dummy_transformer(d)
+        copied_model.load_state_dict(model.state_dict())
+        # copy the encoder output for every hypothesis, as other models do
+        copied_model.encoder.expand_encoder_out = copied_model.encoder.reorder_encoder_out
+        for kv_cache in [False, True]:
+            hypos = [
+                SequenceGenerator([m], d, beam_size=3, kv_cache=kv_cache).generate(
+                    sample['net_input']['src_tokens'], sample['net_input']['src_lengths'], maxlen=12,
+                )
+                for m in [copied_model, model]
+            ]
+            for ref_hypos, shared_hypos in zip(*hypos):
+                self.assertEqual(len(ref_hypos), len(shared_hypos))
+                for ref, hypo in zip(ref_hypos, shared_hypos):
+                    self.assertEqual(ref['tokens'].tolist(), hypo['tokens'].tolist())
+                    self.assertAlmostEqual(ref['score'], hypo['score'], places=4)
+                    self.assertTrue(torch.allclose(ref['attention'], hypo['attention'], atol=1e-5))
+
+    def test_greedy_generate(self):
+        dataset = dummy_language_pair_dataset(num_examples=6)
+        d = dataset.src_dict
+        sample = collate([dataset[i] for i in range(6)], d.pad(), d.eos())
+        torch.manual_seed(0)
+        model = dummy_transformer(d)
+        model.decoder.embed_tokens.weight.data[d.eos()] *= 4
+        for kwargs in [{}, {'kv_cache': True}, {'minlen': 3, 'len_penalty': 0.5}]:
+            hypos = [
+                generator_cls([model], d, beam_size=1, **kwargs).generate(
+                    sample['net_input']['src_tokens'], sample['net_input']['src_lengths'], maxlen=12,
+                )
+                for generator_cls in [SequenceGenerator, GreedySequenceGenerator]
+            ]
+            # sentences finish at different steps
+            self.assertGreater(len(set(len(h[0]['tokens']) for h in hypos[0])), 1)
+            for ref_hypos, greedy_hypos in zip(*hypos):
+                self.assertEqual(len(greedy_hypos), 1)
+                ref, hypo = ref_hypos[0], greedy_hypos[0]
+                self.assertEqual(ref['tokens'].tolist(), hypo['tokens'].tolist())
+                self.assertAlmostEqual(ref['score'], hypo['score'], places=4)
+                self.assertTrue(torch.allclose(ref['positional_scores'], hypo['positional_scores'], atol=1e-5))
+                self.assertTrue(torch.allclose(ref['attention'], hypo['attention'], atol=1e-5))
+                self.assertEqual(ref['alignment'].tolist(), hypo['alignment'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -76,6 +76,30 @@ class TestUtils(unittest.TestCase):
             utils.make_positions(right_pad_input, pad, left_pad=False),
         )
 
+    def test_make_segment_positions(self):
+        pad = 1
+        segments = torch.LongTensor([
+            [1, 1, 1, 2, 2, 3],
+            [1, 1, 2, 2, 2, 0],
+            [1, 1, 1, 0, 0, 0],
+        ])
+        expected = torch.LongTensor([
+            [2, 3, 4, 2, 3, 2],
+            [2, 3, 2, 3, 4, 1],
+            [2, 3, 4, 1, 1, 1],
+        ])
+        self.assertAlmostEqual(expected, utils.make_segment_positions(segments, pad))
+
+    def test_make_segment_mask(self):
+        query_segments = torch.LongTensor([[1, 2, 0]])
+        key_segments = torch.LongTensor([[1, 1, 2, 0]])
+        expected = torch.LongTensor([[
+            [0, 0, 1, 1],
+            [1, 1, 0, 1],
+            [0, 0, 0, 0],
+        ]])
+        self.assertAlmostEqual(expected, utils.make_segment_mask(query_segments, key_segments).long())
+
     def assertAlmostEqual(self, t1, t2):
         self.assertEqual(t1.size(), t2.size(), "size mismatch")
         self.assertLess(utils.item((t1 - t2).abs().max()), 1e-4)
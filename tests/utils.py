@@ -8,7 +8,7 @@
 import torch
 
 from fairseq import utils
-from fairseq.data import Dictionary
+from fairseq.data import Dictionary, indexed_dataset
 from fairseq.data.language_pair_dataset import collate
 from fairseq.models import (
     FairseqEncoder,
@@ -27,6 +27,13 @@ def dummy_dictionary(vocab_size, prefix='token_'):
     return d
 
 
+def write_dummy_dataset(prefix, items, **kwargs):
+    builder = indexed_dataset.IndexedDatasetBuilder(indexed_dataset.data_file_path(prefix), **kwargs)
+    for item in items:
+        builder.add_item(item)
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
 def dummy_dataloader(
     samples,
     padding_idx=1,
@@ -64,6 +71,22 @@ class TestDataset(torch.utils.data.Dataset):
         return len(self.data)
 
 
+class UnfetchableDataset(torch.utils.data.Dataset):
+    """Wraps a dataset, failing if any of its items is fetched."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        raise AssertionError('item {} was fetched'.format(index))
+
+    def __getitems__(self, indices):
+        raise AssertionError('items {} were fetched'.format(indices))
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 class TestTranslationTask(FairseqTask):
 
     def __init__(self, args, src_dict, tgt_dict, model):
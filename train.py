@@ -65,6 +65,12 @@ def main(args):
         seed=args.seed,
         num_shards=args.distributed_world_size,
         shard_id=args.distributed_rank,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        cache_dir=args.data if args.cache_batches else None,
+        batch_cost=data.batch_cost_from_args(args),
+        fingerprint=task.dataset_fingerprint(args.train_subset),
+        balance_shards=args.balance_shards,
     )
 
     # Load the latest checkpoint if one is available
@@ -117,6 +123,10 @@ def train(args, trainer, task, epoch_itr):
     max_update = args.max_update or math.inf
     num_batches = len(epoch_itr)
     for i, sample in enumerate(progress, start=epoch_itr.iterations_in_epoch):
+        if epoch_itr.step_imbalance is not None:
+            # ratio between the largest and the mean number of tokens of the
+            # batches processed by the distributed workers at this step
+            extra_meters['imbalance'].update(epoch_itr.step_imbalance[i])
         if i < num_batches - 1 and (i + 1) % update_freq > 0:
             # buffer updates according to --update-freq
             trainer.train_step(sample, update_params=False)
@@ -134,6 +144,8 @@ def train(args, trainer, task, epoch_itr):
             else:
                 extra_meters[k].update(v)
             stats[k] = extra_meters[k].avg
+        if epoch_itr.step_imbalance is not None:
+            stats['imbalance'] = '{:.3f}'.format(epoch_itr.step_imbalance[i])
         progress.log(stats)
 
         # ignore the first mini-batch in words-per-second calculation
@@ -200,6 +212,11 @@ def validate(args, trainer, task, epoch_itr, subsets):
             seed=args.seed,
             num_shards=args.distributed_world_size,
             shard_id=args.distributed_rank,
+            num_workers=args.num_workers,
+            prefetch_factor=args.prefetch_factor,
+            cache_dir=args.data if args.cache_batches else None,
+            batch_cost=data.batch_cost_from_args(args),
+            fingerprint=task.dataset_fingerprint(subset),
         ).next_epoch_itr(shuffle=False)
         progress = progress_bar.build_progress_bar(
             args, itr, epoch_itr.epoch,